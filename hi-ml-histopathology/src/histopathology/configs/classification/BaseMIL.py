@@ -24,6 +24,7 @@ from histopathology.models.deepmil import DeepMILModule
 from histopathology.models.encoders import (HistoSSLEncoder, IdentityEncoder,
                                             ImageNetEncoder, ImageNetSimCLREncoder,
                                             SSLEncoder, TileEncoder)
+from histopathology.models.feature_store import TileFeatureStore
 
 
 class BaseMIL(LightningContainer):
@@ -36,9 +37,30 @@ class BaseMIL(LightningContainer):
          of encoding layers.")
     num_transformer_pool_heads: int = param.Integer(4, doc="If transformer pooling is chosen, this defines the number\
          of attention heads.")
+    transformer_pool_memory_efficient: bool = param.Boolean(False, doc="If transformer pooling is chosen and this is \
+        True, compute self-attention in chunks of tiles so that memory grows linearly with the bag size, both at \
+        inference and when training (at the cost of recomputing the attention in the backward pass).")
     is_finetune: bool = param.Boolean(False, doc="If True, fine-tune the encoder during training. If False (default), "
                                                  "keep the encoder frozen.")
     dropout_rate: Optional[float] = param.Number(None, bounds=(0, 1), doc="Pre-classifier dropout rate.")
+    batched_forward: bool = param.Boolean(False, doc="If True, encode and pool all bags in a batch at once, "
+                                                     "instead of one bag at a time.")
+    inference_top_k: Optional[int] = param.Integer(None, bounds=(1, None), allow_None=True,
+                                                   doc="If set, at test time only encode and pool the given number "
+                                                       "of tiles per slide, selected by a cheap first pass scoring "
+                                                       "tiles by attention (with transformer pooling, the attention "
+                                                       "of the cls token in the first layer only). If None "
+                                                       "(default), use all tiles.")
+    screening_downscale: int = param.Integer(1, bounds=(1, None), doc="Factor by which to downscale tile images "
+                                                                      "in the first pass of top-k inference. Only "
+                                                                      "supported with is_finetune, as tiles are "
+                                                                      "otherwise encoded in the datamodule.")
+    report_pruning_deviation: bool = param.Boolean(False, doc="If True and inference_top_k is set, also run "
+                                                              "full-bag inference at test time, and report how far "
+                                                              "top-k predictions deviate from it.")
+    raster_heatmaps: bool = param.Boolean(False, doc="If True, draw the attention heatmaps of the test report as a "
+                                                     "single image of the tile grid, which is much faster for "
+                                                     "large slides. If False (default), draw one patch per tile.")
     # l_rate, weight_decay, adam_betas are already declared in OptimizerParams superclass
 
     # Encoder parameters:
@@ -62,8 +84,33 @@ class BaseMIL(LightningContainer):
                                                  "`none` (default),`cpu`, `gpu`")
     encoding_chunk_size: int = param.Integer(0, doc="If > 0 performs encoding in chunks, by loading"
                                                     "enconding_chunk_size tiles per chunk")
+    pipelined_encoding: bool = param.Boolean(False, doc="If True, copy and preprocess the next chunk of tiles "
+                                                        "while encoding the current one.")
+    encoding_threads: int = param.Integer(0, bounds=(0, None),
+                                          doc="Number of intra-op threads used by PyTorch while encoding tiles. "
+                                              "If 0 (default), the current setting is kept.")
+    tile_loading_threads: int = param.Integer(0, bounds=(0, None),
+                                              doc="Number of threads decoding the tiles of each bag concurrently. "
+                                                  "If 0 (default), tiles are decoded sequentially.")
+    cache_workers: int = param.Integer(0, bounds=(0, None),
+                                       doc="Number of worker processes loading bags in parallel when filling the "
+                                           "cache. If 0 (default), bags are loaded in the main process.")
+    cache_full_bags: bool = param.Boolean(False, doc="If True, cache complete bags and subsample them down to "
+                                                     "`max_bag_size` in every epoch, instead of caching a fixed "
+                                                     "subsample of each bag.")
+    feature_store_dir: Optional[Path] = param.ClassSelector(class_=Path, default=None, allow_None=True,
+                                                            doc="Root directory of the persistent tile feature "
+                                                                "store, shared by experiments using the same "
+                                                                "encoder on the same dataset. If None (default), "
+                                                                "tile features are not stored.")
     # local_dataset (used as data module root_path) is declared in DatasetParams superclass
 
+    def validate(self) -> None:
+        super().validate()
+        if self.screening_downscale > 1 and not self.is_finetune:
+            raise ValueError("screening_downscale requires is_finetune, as tiles are otherwise encoded in the "
+                             "datamodule at full resolution")
+
     @property
     def cache_dir(self) -> Path:
         raise NotImplementedError
@@ -76,6 +123,13 @@ class BaseMIL(LightningContainer):
         if not self.is_finetune:
             self.encoder.eval()
 
+    def get_feature_store(self) -> Optional[TileFeatureStore]:
+        """Get the store of the features computed by the frozen encoder for this dataset, if enabled."""
+        if self.feature_store_dir is None:
+            return None
+        return TileFeatureStore.for_encoder(self.feature_store_dir, self.encoder,
+                                            tiles_signature=Path(self.local_datasets[0]).name)
+
     def get_encoder(self) -> TileEncoder:
         if self.encoder_type == ImageNetEncoder.__name__:
             return ImageNetEncoder(feature_extraction_model=resnet18,
@@ -112,7 +166,8 @@ class BaseMIL(LightningContainer):
         elif self.pool_type == TransformerPooling.__name__:
             pooling_layer = TransformerPooling(self.num_transformer_pool_layers,
                                                self.num_transformer_pool_heads,
-                                               num_encoding)
+                                               num_encoding,
+                                               memory_efficient=self.transformer_pool_memory_efficient)
             self.pool_out_dim = 1  # currently this is hardcoded in forward of the TransformerPooling
         else:
             raise ValueError(f"Unsupported pooling type: {self.pooling_type}")
@@ -143,7 +198,12 @@ class BaseMIL(LightningContainer):
                              class_weights=self.data_module.class_weights,
                              l_rate=self.l_rate,
                              weight_decay=self.weight_decay,
-                             adam_betas=self.adam_betas)
+                             adam_betas=self.adam_betas,
+                             batched_forward=self.batched_forward,
+                             inference_top_k=self.inference_top_k,
+                             screening_downscale=self.screening_downscale,
+                             report_pruning_deviation=self.report_pruning_deviation,
+                             raster_heatmaps=self.raster_heatmaps)
 
     def get_data_module(self) -> TilesDataModule:
         raise NotImplementedError
@@ -112,8 +112,11 @@ class DeepSMILECrck(BaseMIL):
         image_key = TcgaCrck_TilesDataset.IMAGE_COLUMN
         transform = Compose(
             [
-                LoadTilesBatchd(image_key, progress=True),
-                EncodeTilesBatchd(image_key, self.encoder),
+                LoadTilesBatchd(image_key, progress=True, num_workers=self.tile_loading_threads, as_uint8=True),
+                EncodeTilesBatchd(image_key, self.encoder, chunk_size=self.encoding_chunk_size,
+                                  feature_store=self.get_feature_store(),
+                                  tile_id_key=TcgaCrck_TilesDataset.TILE_ID_COLUMN,
+                                  pipelined=self.pipelined_encoding, num_threads=self.encoding_threads),
             ]
         )
         return TcgaCrckTilesDataModule(
@@ -124,8 +127,11 @@ class DeepSMILECrck(BaseMIL):
             cache_mode=self.cache_mode,
             precache_location=self.precache_location,
             cache_dir=self.cache_dir,
+            cache_workers=self.cache_workers,
+            cache_full_bags=self.cache_full_bags,
             crossval_count=self.crossval_count,
             crossval_index=self.crossval_index,
+            num_workers=0,  # tiles are encoded on GPU within the transform
         )
 
     def get_callbacks(self) -> List[Callback]:
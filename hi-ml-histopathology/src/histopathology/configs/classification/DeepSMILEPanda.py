@@ -112,11 +112,16 @@ class DeepSMILEPanda(BaseMIL):
     def get_data_module(self) -> PandaTilesDataModule:
         image_key = PandaTilesDataset.IMAGE_COLUMN
         if self.is_finetune:
-            transform = Compose([LoadTilesBatchd(image_key, progress=True)])
+            transform = Compose([LoadTilesBatchd(image_key, progress=True, num_workers=self.tile_loading_threads)])
         else:
             transform = Compose([
-                                LoadTilesBatchd(image_key, progress=True),
-                                EncodeTilesBatchd(image_key, self.encoder, chunk_size=self.encoding_chunk_size)
+                                LoadTilesBatchd(image_key, progress=True, num_workers=self.tile_loading_threads,
+                                                as_uint8=True),
+                                EncodeTilesBatchd(image_key, self.encoder, chunk_size=self.encoding_chunk_size,
+                                                  feature_store=self.get_feature_store(),
+                                                  tile_id_key=PandaTilesDataset.TILE_ID_COLUMN,
+                                                  pipelined=self.pipelined_encoding,
+                                                  num_threads=self.encoding_threads)
                                 ])
 
         return PandaTilesDataModule(
@@ -127,6 +132,8 @@ class DeepSMILEPanda(BaseMIL):
             cache_mode=self.cache_mode,
             precache_location=self.precache_location,
             cache_dir=self.cache_dir,
+            cache_workers=self.cache_workers,
+            cache_full_bags=self.cache_full_bags,
             # crossval_count=self.crossval_count,
             # crossval_index=self.crossval_index,
         )
@@ -157,7 +164,12 @@ class DeepSMILEPanda(BaseMIL):
                              tile_size=self.tile_size,
                              level=self.level,
                              class_names=self.class_names,
-                             is_finetune=self.is_finetune)
+                             is_finetune=self.is_finetune,
+                             batched_forward=self.batched_forward,
+                             inference_top_k=self.inference_top_k,
+                             screening_downscale=self.screening_downscale,
+                             report_pruning_deviation=self.report_pruning_deviation,
+                             raster_heatmaps=self.raster_heatmaps)
 
     def get_slide_dataset(self) -> PandaDataset:
         return PandaDataset(root=self.extra_local_dataset_paths[0])                             # type: ignore
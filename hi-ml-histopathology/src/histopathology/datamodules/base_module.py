@@ -3,20 +3,24 @@
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
 
+import os
 import torch
 from enum import Enum
 from pathlib import Path
-from typing import Any, Callable, Optional, Sequence, Tuple, Union
+from typing import Any, Callable, Dict, Iterator, Optional, Sequence, Tuple, Union
 
-from monai.data.dataset import CacheDataset, Dataset, PersistentDataset
+from monai.data.dataset import Dataset
+from monai.transforms import Compose
 from pytorch_lightning import LightningDataModule
 from torch.utils.data import DataLoader
 
 from health_ml.utils.bag_utils import BagDataset, multibag_collate
 from health_ml.utils.common_utils import _create_generator
 
+from histopathology.datamodules.cache_warmup import ParallelCacheDataset, ParallelPersistentDataset
+from histopathology.datamodules.sharded_cache import ShardedCacheDataset, is_sharded_cache, save_sharded_cache
 from histopathology.datasets.base_dataset import TilesDataset
-from histopathology.models.transforms import LoadTilesBatchd
+from histopathology.models.transforms import LoadTilesBatchd, Subsampled
 
 
 class CacheMode(Enum):
@@ -31,6 +35,25 @@ class CacheLocation(Enum):
     SAME = 'same'
 
 
+# Maximum number of data loader workers chosen by default when loading uncached bags
+DEFAULT_MAX_WORKERS = 4
+
+
+class BagDataLoader(DataLoader):
+    """A `DataLoader` of bags that draws a new bag shuffling seed from its generator whenever iterated.
+
+    The seed is set on the underlying `BagDataset` before any worker processes are started, so the
+    instances in each bag are shuffled identically for a given generator seed regardless of the
+    number of workers, while still varying from one epoch to the next.
+    """
+
+    def __iter__(self) -> Iterator:
+        bag_dataset = getattr(self.dataset, 'data', None)
+        if isinstance(bag_dataset, BagDataset) and self.generator is not None:
+            bag_dataset.set_shuffle_seed(int(torch.randint(2**62, size=(), generator=self.generator)))
+        return super().__iter__()
+
+
 class TilesDataModule(LightningDataModule):
     """Base class to load the tiles of a dataset as train, val, test sets"""
 
@@ -40,7 +63,13 @@ class TilesDataModule(LightningDataModule):
                  precache_location: CacheLocation = CacheLocation.NONE,
                  cache_dir: Optional[Path] = None,
                  crossval_count: int = 0,
-                 crosval_index: int = 0) -> None:
+                 crosval_index: int = 0,
+                 num_workers: Optional[int] = None,
+                 prefetch_factor: Optional[int] = None,
+                 persistent_workers: Optional[bool] = None,
+                 pin_memory: Optional[bool] = None,
+                 cache_workers: int = 0,
+                 cache_full_bags: bool = False) -> None:
         """
         :param root_path: Root directory of the source dataset.
         :param max_bag_size: Upper bound on number of tiles in each loaded bag. If 0 (default),
@@ -65,10 +94,31 @@ class TilesDataModule(LightningDataModule):
           - `CPU`: each transformed sample is saved to disk and, if cache_mode is `MEMORY`, reloaded into CPU;
           - `SAME`: each transformed sample is saved to disk and, if cache_mode is `MEMORY`, reloaded on the same
           device it was saved from;
-        If cache_mode is `DISK` precache_location `CPU` and `GPU` are equivalent.
+        If cache_mode is `DISK` precache_location `CPU` and `GPU` are equivalent. If cache_mode is `MEMORY`, the
+        cache is saved in sharded format (see `sharded_cache`) and reloaded lazily from memory-mapped files,
+        so that processes on the same node share the cached data in the OS page cache.
         :param cache_dir: The directory onto which to cache data if caching is enabled.
         :param crossval_count: Number of folds to perform.
         :param crosval_index: Index of the cross validation split to be performed.
+        :param num_workers: Number of data loader worker processes. By default (`None`), bags are loaded in
+        up to `DEFAULT_MAX_WORKERS` workers if `cache_mode` is `NONE`, and in the main process otherwise, as
+        cached data is readily available and may already be on GPU. Transforms running on GPU (e.g.
+        `EncodeTilesBatchd` with a GPU encoder) require `num_workers=0` without caching.
+        :param prefetch_factor: Number of batches loaded in advance by each worker (default: 2). Only used
+        if `num_workers > 0`.
+        :param persistent_workers: Whether to keep worker processes alive across epochs (default: `False`).
+        Note that persistent workers keep shuffling the instances in each bag as in the first epoch.
+        :param pin_memory: Whether to copy loaded tensors into pinned memory for faster transfer to GPU.
+        Defaults to `True` if `cache_mode` is `NONE` and CUDA is available, `False` otherwise, as cached data
+        may already be on GPU.
+        :param cache_workers: Number of worker processes loading bags in parallel when filling a `MEMORY`
+        cache or pre-caching to `DISK`, while any `EncodeTilesBatchd` runs in the main process (see
+        `cache_warmup`). If 0 (default), bags are loaded serially in the main process. The cached data is
+        identical in both cases.
+        :param cache_full_bags: If `True` and caching is enabled, complete bags are cached and subsampled down
+        to `max_bag_size` after loading from the cache, with `Subsampled`, drawing fresh subsets in every
+        epoch and making the cache independent of `max_bag_size`. If `False` (default), bags are subsampled
+        before loading, so a single subset of each bag is cached and reused in every epoch.
         """
         if precache_location is not CacheLocation.NONE and cache_mode is CacheMode.NONE:
             raise ValueError("Can only pre-cache if caching is enabled")
@@ -90,6 +140,12 @@ class TilesDataModule(LightningDataModule):
         self.train_dataset, self.val_dataset, self.test_dataset = self.get_splits()
         self.class_weights = self.train_dataset.get_class_weights()
         self.seed = seed
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.persistent_workers = persistent_workers
+        self.pin_memory = pin_memory
+        self.cache_workers = cache_workers
+        self.cache_full_bags = cache_full_bags
 
     def get_splits(self) -> Tuple[TilesDataset, TilesDataset, TilesDataset]:
         """Create the training, validation, and test datasets"""
@@ -102,69 +158,116 @@ class TilesDataModule(LightningDataModule):
             self._load_dataset(self.test_dataset, stage='test', shuffle=True)
 
     def _dataset_pickle_path(self, stage: str) -> Optional[Path]:
-        if self.cache_dir is None or self.cache_mode == CacheMode.NONE:
+        if self.cache_dir is None or self.cache_mode != CacheMode.DISK:
             return None
         return self.cache_dir / f"{stage}_dataset.pt"
 
+    def _sharded_cache_dir(self, stage: str) -> Optional[Path]:
+        if self.cache_dir is None or self.cache_mode != CacheMode.MEMORY:
+            return None
+        return self.cache_dir / f"{stage}_dataset"
+
     def _load_dataset(self, tiles_dataset: TilesDataset, stage: str, shuffle: bool) -> Dataset:
         dataset_pickle_path = self._dataset_pickle_path(stage)
+        sharded_cache_dir = self._sharded_cache_dir(stage)
+        if self.precache_location == CacheLocation.CPU:
+            memory_location = torch.device('cpu')
+        else:
+            # by default cached tensors are reloaded on the same device they were saved from
+            memory_location = None  # type: ignore
 
         if dataset_pickle_path and dataset_pickle_path.is_file():
-            if self.precache_location == CacheLocation.CPU:
-                memory_location = torch.device('cpu')
-                print(f"Loading dataset from {dataset_pickle_path} into {memory_location}")
-            else:
-                # by default torch.load will reload on the same device it was saved from
-                memory_location = None  # type: ignore
-
+            print(f"Loading dataset from {dataset_pickle_path} into {memory_location or 'original device'}")
             with dataset_pickle_path.open('rb') as f:
                 return torch.load(f, map_location=memory_location)
 
+        subsample_after_cache = self.cache_full_bags and self.cache_mode is not CacheMode.NONE \
+            and self.max_bag_size > 0
         generator = _create_generator(self.seed)
         bag_dataset = BagDataset(tiles_dataset,  # type: ignore
                                  bag_ids=tiles_dataset.slide_ids,
-                                 max_bag_size=self.max_bag_size,
+                                 max_bag_size=0 if subsample_after_cache else self.max_bag_size,
                                  shuffle_samples=shuffle,
                                  generator=generator)
         transform = self.transform or LoadTilesBatchd(tiles_dataset.IMAGE_COLUMN)
+        if subsample_after_cache:
+            transform = self._append_subsampling(transform, tiles_dataset)
+
+        if sharded_cache_dir and is_sharded_cache(sharded_cache_dir):
+            print(f"Loading dataset from {sharded_cache_dir} into {memory_location or 'original device'}")
+            return ShardedCacheDataset(bag_dataset, transform, sharded_cache_dir,  # type: ignore
+                                       map_location=memory_location)
 
         # Save and restore PRNG state for consistency across (pre-)caching options
         generator_state = generator.get_state()
         transformed_bag_dataset = self._get_transformed_dataset(bag_dataset, transform)  # type: ignore
         generator.set_state(generator_state)
 
-        # Dataset is saved if cache_dir is True, regardless of CacheMode
-        if dataset_pickle_path:
+        # Dataset is saved if cache_dir is set: in-memory caches as lazily loaded shards, since a single
+        # pickle would have to be loaded entirely by every process, and on-disk caches as a pickle
+        # referring to their per-bag cache files
+        if sharded_cache_dir:
+            save_sharded_cache(transformed_bag_dataset.cached_items, sharded_cache_dir)  # type: ignore
+        elif dataset_pickle_path:
             dataset_pickle_path.parent.mkdir(parents=True, exist_ok=True)
             with dataset_pickle_path.open('wb') as f:
                 torch.save(transformed_bag_dataset, f)
 
         return transformed_bag_dataset
 
+    def _append_subsampling(self, transform: Callable, tiles_dataset: TilesDataset) -> Compose:
+        """Append random subsampling of all tile fields of a bag down to `max_bag_size` to a transform.
+
+        The transforms are flattened into a single `Compose`, as MONAI datasets would otherwise regard a
+        nested `Compose` as random and not cache its results.
+        """
+        transforms = list(transform.transforms) if isinstance(transform, Compose) else [transform]
+        tile_keys = list(dict.fromkeys([tiles_dataset.TILE_ID_COLUMN, *tiles_dataset.dataset_df.columns,
+                                        tiles_dataset.PATH_COLUMN]))
+        subsampling = Subsampled(tile_keys, max_size=self.max_bag_size, allow_missing_keys=True)
+        # Seeded after composing, as Compose re-seeds its random transforms
+        return Compose([*transforms, subsampling]).set_random_state(seed=self.seed)
+
     def _get_transformed_dataset(self, base_dataset: BagDataset,
                                  transform: Union[Sequence[Callable], Callable]) -> Dataset:
+        # Shuffle each bag independently of the caching order, so parallel and serial caching are identical
+        generator = base_dataset.bag_sampler.generator or _create_generator(self.seed)
+        base_dataset.set_shuffle_seed(int(torch.randint(2**62, size=(), generator=generator)))
         if self.cache_mode is CacheMode.MEMORY:
-            dataset = CacheDataset(base_dataset, transform, num_workers=1)  # type: ignore
+            dataset = ParallelCacheDataset(base_dataset, transform,  # type: ignore
+                                           loading_workers=self.cache_workers)
         elif self.cache_mode is CacheMode.DISK:
-            dataset = PersistentDataset(base_dataset, transform, cache_dir=self.cache_dir)  # type: ignore
+            dataset = ParallelPersistentDataset(base_dataset, transform, cache_dir=self.cache_dir)  # type: ignore
             if self.precache_location != CacheLocation.NONE:
-                import tqdm  # TODO: Make optional
-
-                for i in tqdm.trange(len(dataset), desc="Loading dataset"):
-                    dataset[i]  # empty loop to pre-compute all transformed samples
+                dataset.warm_up(loading_workers=self.cache_workers)
         else:
             dataset = Dataset(base_dataset, transform)  # type: ignore
+        base_dataset.set_shuffle_seed(None)
         return dataset
 
+    def get_dataloader_kwargs(self) -> Dict[str, Any]:
+        """Get the keyword arguments configuring parallel loading, with defaults chosen by cache mode."""
+        uncached = self.cache_mode is CacheMode.NONE
+        num_workers = self.num_workers
+        if num_workers is None:
+            num_workers = min(DEFAULT_MAX_WORKERS, os.cpu_count() or 1) if uncached else 0
+        pin_memory = self.pin_memory
+        if pin_memory is None:
+            pin_memory = uncached and torch.cuda.is_available()
+        dataloader_kwargs: Dict[str, Any] = dict(num_workers=num_workers, pin_memory=pin_memory)
+        if num_workers > 0:
+            dataloader_kwargs.update(prefetch_factor=self.prefetch_factor or 2,
+                                     persistent_workers=bool(self.persistent_workers))
+        return dataloader_kwargs
+
     def _get_dataloader(self, tiles_dataset: TilesDataset, stage: str, shuffle: bool,
                         **dataloader_kwargs: Any) -> DataLoader:
         transformed_bag_dataset = self._load_dataset(tiles_dataset, stage=stage, shuffle=shuffle)
         bag_dataset: BagDataset = transformed_bag_dataset.data  # type: ignore
         generator = bag_dataset.bag_sampler.generator
-        return DataLoader(transformed_bag_dataset, batch_size=self.batch_size,
-                          collate_fn=multibag_collate, shuffle=shuffle, generator=generator,
-                          pin_memory=False,  # disable pinning as loaded data may already be on GPU
-                          **dataloader_kwargs)
+        return BagDataLoader(transformed_bag_dataset, batch_size=self.batch_size,
+                             collate_fn=multibag_collate, shuffle=shuffle, generator=generator,
+                             **{**self.get_dataloader_kwargs(), **dataloader_kwargs})
 
     def train_dataloader(self) -> DataLoader:
         return self._get_dataloader(self.train_dataset, 'train', shuffle=True)
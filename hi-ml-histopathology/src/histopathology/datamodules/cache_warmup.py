@@ -0,0 +1,193 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+"""Parallel warm-up of MONAI caches of bag datasets.
+
+MONAI datasets cache the results of the deterministic transforms preceding the first random one. Here,
+these transforms are split into a loading part (e.g. `LoadTilesBatchd`), run for many bags at once in
+`DataLoader` worker processes, and an encoding part starting at the first `EncodeTilesBatchd`, run in the
+main process where the encoder lives. Each bag goes through the same transforms in the same order as
+with serial caching, so the cached results are identical.
+"""
+
+import itertools
+import logging
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple
+
+import torch
+from monai.data.dataset import CacheDataset, PersistentDataset
+from monai.transforms import Compose, Randomizable, Transform, apply_transform
+from torch.utils.data import DataLoader, Dataset, Subset
+from tqdm import tqdm
+
+from histopathology.models.transforms import EncodeTilesBatchd
+
+
+def split_cacheable_transforms(transform: Callable) -> Tuple[List[Callable], List[Callable]]:
+    """Split the transforms cached by MONAI datasets into loading and encoding transforms.
+
+    :param transform: A transform or a `Compose` of transforms.
+    :return: A tuple containing the deterministic transforms preceding the first `EncodeTilesBatchd`,
+    which can run in worker processes, and the remaining deterministic transforms up to the first random
+    (or non-MONAI) one, which must run in the main process.
+    """
+    transforms = transform.transforms if isinstance(transform, Compose) else [transform]
+    cacheable = list(itertools.takewhile(lambda t: isinstance(t, Transform) and not isinstance(t, Randomizable),
+                                         transforms))
+    encode_index = next((index for index, t in enumerate(cacheable) if isinstance(t, EncodeTilesBatchd)),
+                        len(cacheable))
+    return cacheable[:encode_index], cacheable[encode_index:]
+
+
+def _apply_transforms(item: Any, transforms: Sequence[Callable]) -> Any:
+    for transform in transforms:
+        item = apply_transform(transform, item)
+    return item
+
+
+def _finish_encoding(transforms: Sequence[Callable]) -> None:
+    """Save the features pending in the feature stores of the encoding transforms, and log their throughput."""
+    for transform in transforms:
+        if isinstance(transform, EncodeTilesBatchd):
+            if transform.feature_store is not None:
+                transform.feature_store.flush()
+            if transform.num_encoded_tiles > 0:
+                logging.info(f"Encoded {transform.num_encoded_tiles} tiles "
+                             f"at {transform.tiles_per_second:.1f} tiles/s")
+
+
+def _to_private_memory(item: Any) -> Any:
+    """Copy tensors received from worker processes out of shared memory, to avoid holding one shared
+    memory handle per cached tensor."""
+    if isinstance(item, torch.Tensor):
+        return item.clone() if item.is_shared() else item
+    elif isinstance(item, dict):
+        return {key: _to_private_memory(value) for key, value in item.items()}
+    elif isinstance(item, (list, tuple)):
+        return type(item)(_to_private_memory(value) for value in item)
+    return item
+
+
+def _identity(item: Any) -> Any:
+    return item
+
+
+class _LoadedItems(Dataset):
+    """Applies loading transforms to the items of a dataset, optionally skipping some items.
+
+    Each item is returned as a tuple of the raw item and the loaded item, or `None` if it was skipped.
+    """
+
+    def __init__(self, data: Sequence, transforms: Sequence[Callable],
+                 skip: Optional[Callable[[Any], bool]] = None) -> None:
+        self.data = data
+        self.transforms = transforms
+        self.skip = skip
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, index: int) -> Tuple[Any, Any]:
+        item = self.data[index]
+        if self.skip is not None and self.skip(item):
+            return item, None
+        return item, _apply_transforms(item, self.transforms)
+
+
+def iterate_loaded_items(data: Sequence, transforms: Sequence[Callable], num_workers: int,
+                         skip: Optional[Callable[[Any], bool]] = None,
+                         progress: bool = True) -> Iterable[Tuple[Any, Any]]:
+    """Load the items of a dataset in order, spreading them over a pool of worker processes.
+
+    :param data: The source dataset, e.g. a `BagDataset`.
+    :param transforms: Loading transforms to apply to each item in the workers.
+    :param num_workers: Number of worker processes. If 0, items are loaded in the main process.
+    :param skip: Optional predicate on raw items, e.g. checking whether an item is already cached.
+    :param progress: Whether to display a tqdm progress bar.
+    :return: An iterable of `(raw_item, loaded_item)` tuples, where `loaded_item` is `None` for skipped items.
+    """
+    loader = DataLoader(_LoadedItems(data, transforms, skip), batch_size=None, shuffle=False,  # type: ignore
+                        num_workers=num_workers, collate_fn=_identity)
+    return tqdm(loader, desc="Warming up cache", disable=not progress)
+
+
+class ParallelCacheDataset(CacheDataset):
+    """A MONAI `CacheDataset` whose cache is filled by loading items in parallel worker processes.
+
+    The cached items are identical to those computed by `CacheDataset`, as long as the source items
+    themselves do not depend on the loading order (see `BagDataset.set_shuffle_seed()`).
+    """
+
+    def __init__(self, data: Sequence, transform: Callable, loading_workers: int = 0,
+                 progress: bool = True, **kwargs: Any) -> None:
+        """
+        :param data: The source dataset.
+        :param transform: A transform or a `Compose` of transforms.
+        :param loading_workers: Number of worker processes running the loading transforms
+        (see `split_cacheable_transforms()`). If 0 (default), items are loaded in the main process.
+        :param progress: Whether to display a tqdm progress bar.
+        :param kwargs: Further keyword arguments to pass to `CacheDataset`.
+        """
+        self.loading_workers = loading_workers
+        super().__init__(data, transform, progress=progress, **kwargs)
+
+    @property
+    def cached_items(self) -> List:
+        """The cached items, i.e. the outputs of the deterministic transforms preceding the first random one."""
+        return self._cache
+
+    def _fill_cache(self) -> List:
+        if self.cache_num <= 0:
+            return []
+        load_transforms, encode_transforms = split_cacheable_transforms(self.transform)
+        cache = []
+        loaded_items = iterate_loaded_items(Subset(self.data, range(self.cache_num)), load_transforms,
+                                            num_workers=self.loading_workers, progress=self.progress)
+        for _, item in loaded_items:
+            item = _apply_transforms(_to_private_memory(item), encode_transforms)
+            # Only newer MONAI versions (after 0.6) make cached items contiguous, and have this option
+            if getattr(self, 'as_contiguous', False):
+                from monai.transforms import convert_to_contiguous
+                item = convert_to_contiguous(item, memory_format=torch.contiguous_format)
+            cache.append(item)
+        _finish_encoding(encode_transforms)
+        return cache
+
+
+class ParallelPersistentDataset(PersistentDataset):
+    """A MONAI `PersistentDataset` whose on-disk cache can be warmed up by loading items in parallel worker
+    processes. The cache files are identical to those written when iterating the dataset serially."""
+
+    _preloaded_item: Any = None
+
+    def _is_cached(self, item: Any) -> bool:
+        if self.cache_dir is None:
+            return False
+        return (self.cache_dir / f"{self.hash_func(item).decode('utf-8')}.pt").is_file()
+
+    def _pre_transform(self, item_transformed: Any) -> Any:
+        if self._preloaded_item is None:
+            return super()._pre_transform(item_transformed)
+        _, encode_transforms = split_cacheable_transforms(self.transform)
+        return _apply_transforms(self._preloaded_item, encode_transforms)
+
+    def warm_up(self, loading_workers: int = 0, progress: bool = True) -> None:
+        """Compute and save the cached results of all items missing from the cache.
+
+        :param loading_workers: Number of worker processes running the loading transforms
+        (see `split_cacheable_transforms()`). If 0 (default), items are loaded in the main process.
+        :param progress: Whether to display a tqdm progress bar.
+        """
+        load_transforms, encode_transforms = split_cacheable_transforms(self.transform)
+        for raw_item, loaded_item in iterate_loaded_items(self.data, load_transforms, num_workers=loading_workers,
+                                                          skip=self._is_cached, progress=progress):
+            if loaded_item is None:
+                continue  # already cached
+            self._preloaded_item = loaded_item
+            try:
+                self._cachecheck(raw_item)  # hashes the raw item and saves the pre-loaded item's transforms
+            finally:
+                self._preloaded_item = None
+        _finish_encoding(encode_transforms)
@@ -0,0 +1,160 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+"""Sharded on-disk format for pre-cached bag datasets, loaded lazily via memory mapping.
+
+Tensors of the cached bags are concatenated along their first dimension into one `.npy` shard per
+field, data type and trailing shape, alongside an index listing the slice of each bag in its shards and
+any non-tensor values. Shards are memory-mapped on first access, so loading is immediate and processes
+on the same node share the file pages in the OS page cache instead of holding private copies.
+"""
+
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from monai.data.dataset import Dataset
+from monai.transforms import Compose, apply_transform
+
+from histopathology.datamodules.cache_warmup import split_cacheable_transforms
+
+SHARDED_CACHE_INDEX_FILENAME = "index.pt"
+
+
+class ShardSlice(NamedTuple):
+    """Location of a cached tensor within a shard."""
+    shard_name: str
+    start: int
+    stop: int
+    device: str
+
+
+def is_sharded_cache(cache_dir: Path) -> bool:
+    """Check whether a directory contains a complete sharded cache, i.e. whether its index was written."""
+    return (cache_dir / SHARDED_CACHE_INDEX_FILENAME).is_file()
+
+
+def _is_sharded(value: Any) -> bool:
+    return isinstance(value, torch.Tensor) and value.ndim > 0
+
+
+def save_sharded_cache(items: Sequence[Any], cache_dir: Path) -> None:
+    """Save cached bags in sharded format.
+
+    The index is written last, so an interrupted save is not mistaken for a complete cache.
+
+    :param items: The cached items, usually dictionaries of bag fields. Tensors with at least one
+    dimension in dictionary items are saved to shards, while all other values are saved in the index.
+    :param cache_dir: Output directory, created if needed. Existing shards are overwritten.
+    """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    index_path = cache_dir / SHARDED_CACHE_INDEX_FILENAME
+    if index_path.exists():
+        index_path.unlink()
+
+    shard_lengths: Dict[Tuple, int] = {}
+    for item in items:
+        if isinstance(item, Mapping):
+            for key, value in item.items():
+                if _is_sharded(value):
+                    shard_key = (key, value.dtype, tuple(value.shape[1:]))
+                    shard_lengths[shard_key] = shard_lengths.get(shard_key, 0) + len(value)
+
+    shard_names = {shard_key: f"shard_{i:03d}.npy" for i, shard_key in enumerate(shard_lengths)}
+    shards = {}
+    for shard_key, length in shard_lengths.items():
+        _, dtype, trailing_shape = shard_key
+        shards[shard_key] = np.lib.format.open_memmap(cache_dir / shard_names[shard_key], mode='w+',
+                                                      dtype=torch.empty(0, dtype=dtype).numpy().dtype,
+                                                      shape=(length, *trailing_shape))
+
+    shard_offsets = dict.fromkeys(shard_lengths, 0)
+    index_items: List[Any] = []
+    for item in items:
+        if not isinstance(item, Mapping):
+            index_items.append(item)
+            continue
+        index_item = {}
+        for key, value in item.items():
+            if _is_sharded(value):
+                shard_key = (key, value.dtype, tuple(value.shape[1:]))
+                start = shard_offsets[shard_key]
+                stop = start + len(value)
+                shards[shard_key][start:stop] = value.detach().cpu().numpy()
+                shard_offsets[shard_key] = stop
+                value = ShardSlice(shard_names[shard_key], start, stop, str(value.device))
+            index_item[key] = value
+        index_items.append(index_item)
+
+    for shard in shards.values():
+        shard.flush()
+    temp_index_path = index_path.with_suffix(".tmp")
+    torch.save({'items': index_items}, temp_index_path)
+    os.replace(temp_index_path, index_path)
+
+
+class ShardedCacheDataset(Dataset):
+    """A dataset of bags loaded lazily from a sharded cache (see `save_sharded_cache()`).
+
+    Like with MONAI's `CacheDataset`, the cached items are the outputs of the deterministic transforms
+    preceding the first random one, and the remaining transforms are applied when fetching an item.
+    Cached tensors are views of the memory-mapped shards so, as with `CacheDataset`, they should not be
+    modified in place. Such changes would be visible within the process, but never written to the files.
+    """
+
+    def __init__(self, data: Sequence, transform: Callable, cache_dir: Path,
+                 map_location: Optional[torch.device] = None) -> None:
+        """
+        :param data: The source dataset, whose items were cached. It is not accessed for loading, but
+        is exposed as `self.data`, e.g. to configure bag shuffling.
+        :param transform: A transform or a `Compose` of transforms, including the cached ones.
+        :param cache_dir: Directory containing the sharded cache.
+        :param map_location: Device where to load cached tensors. If `None` (default), tensors are loaded
+        on the device they were cached from.
+        """
+        super().__init__(data, transform)
+        self.cache_dir = cache_dir
+        self.map_location = map_location
+        self._index_items = torch.load(cache_dir / SHARDED_CACHE_INDEX_FILENAME)['items']
+        if len(self._index_items) != len(data):
+            raise ValueError(f"The cache in {cache_dir} contains {len(self._index_items)} items, but the dataset "
+                             f"has {len(data)}. Please delete the outdated cache.")
+        transforms = transform.transforms if isinstance(transform, Compose) else [transform]
+        num_cached_transforms = sum(map(len, split_cacheable_transforms(transform)))
+        self._post_cache_transforms = transforms[num_cached_transforms:]
+        self._shards: Dict[str, np.ndarray] = {}
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Memory maps are re-opened in each process rather than pickled by value
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def _get_shard(self, shard_name: str) -> np.ndarray:
+        if shard_name not in self._shards:
+            # Copy-on-write mapping: pages are shared until written to, and writes never reach the file
+            self._shards[shard_name] = np.load(self.cache_dir / shard_name, mmap_mode='c')
+        return self._shards[shard_name]
+
+    def _load_value(self, value: Any) -> Any:
+        if not isinstance(value, ShardSlice):
+            return value
+        tensor = torch.from_numpy(self._get_shard(value.shard_name)[value.start:value.stop])
+        return tensor.to(self.map_location or torch.device(value.device))
+
+    def get_cached_item(self, index: int) -> Any:
+        """Load a cached item, before applying the transforms following the cached ones."""
+        index_item = self._index_items[index]
+        if not isinstance(index_item, Mapping):
+            return index_item
+        return {key: self._load_value(value) for key, value in index_item.items()}
+
+    def _transform(self, index: int) -> Any:
+        item = self.get_cached_item(index)
+        for transform in self._post_cache_transforms:
+            item = apply_transform(transform, item)
+        return item
@@ -4,7 +4,7 @@
 #  ------------------------------------------------------------------------------------------
 
 from pathlib import Path
-from typing import Any, Dict, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import pandas as pd
@@ -56,7 +56,8 @@ class TilesDataset(Dataset):
         :param root: Root directory of the dataset.
         :param dataset_csv: Full path to a dataset CSV file, containing at least
         `TILE_ID_COLUMN`, `SLIDE_ID_COLUMN`, and `IMAGE_COLUMN`. If omitted, the CSV will be read
-        from `"{root}/{DEFAULT_CSV_FILENAME}"`.
+        from `"{root}/{DEFAULT_CSV_FILENAME}"`. A Parquet tile index with the same columns (`*.parquet`)
+        is also accepted, and loads much faster for large datasets.
         :param dataset_df: A potentially pre-processed dataframe in the same format as would be read
         from the dataset CSV file, e.g. after some filtering. If given, overrides `dataset_csv`.
         :param train: If `True`, loads only the training split (resp. `False` for test split). By
@@ -71,7 +72,10 @@ class TilesDataset(Dataset):
             self.dataset_csv = None
         else:
             self.dataset_csv = dataset_csv or self.root_dir / self.DEFAULT_CSV_FILENAME
-            dataset_df = pd.read_csv(self.dataset_csv)
+            if Path(self.dataset_csv).suffix == '.parquet':
+                dataset_df = pd.read_parquet(self.dataset_csv)
+            else:
+                dataset_df = pd.read_csv(self.dataset_csv)
 
         columns = [self.SLIDE_ID_COLUMN, self.IMAGE_COLUMN, self.LABEL_COLUMN,
                    self.SPLIT_COLUMN, self.TILE_X_COLUMN, self.TILE_Y_COLUMN]
@@ -89,16 +93,46 @@ class TilesDataset(Dataset):
     def __len__(self) -> int:
         return self.dataset_df.shape[0]
 
+    def _get_columns(self) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """Get the tile IDs and the columns of `dataset_df` as numpy arrays.
+
+        The arrays are extracted once and rebuilt only if `dataset_df` is replaced (e.g. filtered by a
+        subclass), as label-based row lookups in the dataframe dominate the cost of loading large bags.
+        """
+        if getattr(self, '_columns_source', None) is not self.dataset_df:
+            self._tile_ids = self.dataset_df.index.to_numpy()
+            self._columns = {column: self.dataset_df[column].to_numpy() for column in self.dataset_df.columns}
+            self._columns_source = self.dataset_df
+        return self._tile_ids, self._columns
+
+    def get_many(self, indices: Sequence[int]) -> List[Dict[str, Any]]:
+        """Fetch several samples at once, slicing each column a single time.
+
+        :param indices: Positional indices of the samples to fetch, e.g. all tiles of a bag.
+        :return: The list of samples, identical to `[self[index] for index in indices]`.
+        """
+        tile_ids, columns = self._get_columns()
+        indices = np.asarray(indices, dtype=int)
+        # Same scalar types as indexing `dataset_df.index` and as a row lookup in a mixed-type dataframe
+        tile_id_values = list(tile_ids[indices])
+        column_values = {column: values[indices].tolist() for column, values in columns.items()}
+        samples = []
+        for position, tile_id in enumerate(tile_id_values):
+            sample = {
+                self.TILE_ID_COLUMN: tile_id,
+                **{column: values[position] for column, values in column_values.items()}
+            }
+            sample[self.IMAGE_COLUMN] = str(self.root_dir / sample.pop(self.IMAGE_COLUMN))
+            # we're replicating this column because we want to propagate the path to the batch
+            sample[self.PATH_COLUMN] = sample[self.IMAGE_COLUMN]
+            samples.append(sample)
+        return samples
+
+    def __getitems__(self, indices: Sequence[int]) -> List[Dict[str, Any]]:
+        return self.get_many(indices)
+
     def __getitem__(self, index: int) -> Dict[str, Any]:
-        tile_id = self.dataset_df.index[index]
-        sample = {
-            self.TILE_ID_COLUMN: tile_id,
-            **self.dataset_df.loc[tile_id].to_dict()
-        }
-        sample[self.IMAGE_COLUMN] = str(self.root_dir / sample.pop(self.IMAGE_COLUMN))
-        # we're replicating this column because we want to propagate the path to the batch
-        sample[self.PATH_COLUMN] = sample[self.IMAGE_COLUMN]
-        return sample
+        return self.get_many([index])[0]
 
     @property
     def slide_ids(self) -> pd.Series:
@@ -198,7 +232,7 @@ class SlidesDataset(Dataset):
 
     def __getitem__(self, index: int) -> Dict[SlideKey, Any]:
         slide_id = self.dataset_df.index[index]
-        slide_row = self.dataset_df.loc[slide_id]
+        slide_row = self.dataset_df.iloc[index]
         sample = {SlideKey.SLIDE_ID: slide_id}
 
         rel_image_path = slide_row[self.IMAGE_COLUMN]
@@ -215,6 +249,25 @@ class SlidesDataset(Dataset):
         sample[SlideKey.METADATA] = {col: slide_row[col] for col in self.METADATA_COLUMNS}
         return sample
 
+    def get_slide_by_id(self, slide_id: str) -> Dict[SlideKey, Any]:
+        """Get the sample of a slide from its ID, looked up in the slide ID index of the dataframe rather than
+        by scanning the dataset.
+
+        :raises KeyError: If the slide ID is not in the dataset.
+        :raises ValueError: If the slide ID appears more than once in the dataset.
+        """
+        index = self.dataset_df.index.get_loc(slide_id)
+        # With duplicated slide IDs in the index, a slice or boolean mask is returned instead of a position
+        if isinstance(index, slice):
+            positions = range(len(self.dataset_df))[index]
+        elif isinstance(index, np.ndarray):
+            positions = np.flatnonzero(index)
+        else:
+            positions = [index]
+        if len(positions) > 1:
+            raise ValueError(f"Slide ID {slide_id} is not unique in the dataset")
+        return self[int(positions[0])]
+
     @classmethod
     def has_mask(cls) -> bool:
         return cls.MASK_COLUMN is not None
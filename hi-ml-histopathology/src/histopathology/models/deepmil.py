@@ -4,13 +4,16 @@
 #  ------------------------------------------------------------------------------------------
 
 import logging
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import pandas as pd
 import numpy as np
 from typing import Any, Callable, Dict, Optional, Tuple, List
 import torch
+import torch.nn.functional as F
 import matplotlib.pyplot as plt
-import more_itertools as mi
 
 from pytorch_lightning import LightningModule
 from torch import Tensor, argmax, mode, nn, set_grad_enabled, optim, round
@@ -30,6 +33,16 @@ from histopathology.utils.viz_utils import load_image_dict
 RESULTS_COLS = [ResultsKey.SLIDE_ID, ResultsKey.TILE_ID, ResultsKey.IMAGE_PATH, ResultsKey.PROB,
                 ResultsKey.CLASS_PROBS, ResultsKey.PRED_LABEL, ResultsKey.TRUE_LABEL, ResultsKey.BAG_ATTN]
 
+TEST_OUTPUT_CSV_FILENAME = 'test_output.csv'
+TEST_ENCODED_FEATURES_DIRNAME = 'test_encoded_features'
+TEST_RANK_OUTPUTS_DIRNAME_PREFIX = 'test_outputs_rank'
+
+# Maximum number of report figure worker processes chosen by default, as each may hold a whole slide in memory
+DEFAULT_MAX_FIGURE_WORKERS = 4
+
+HEATMAP_RESULTS_KEYS = [ResultsKey.SLIDE_ID, ResultsKey.IMAGE_PATH, ResultsKey.BAG_ATTN,
+                        ResultsKey.TILE_X, ResultsKey.TILE_Y]
+
 
 def _format_cuda_memory_stats() -> str:
     return (f"GPU {torch.cuda.current_device()} memory: "
@@ -37,6 +50,49 @@ def _format_cuda_memory_stats() -> str:
             f"{torch.cuda.memory_reserved() / 1024 ** 3:.2f} GB reserved")
 
 
+def _to_cpu(value: Any) -> Any:
+    if isinstance(value, Tensor):
+        return value.cpu()
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_cpu(item) for item in value)
+    return value
+
+
+def _remove_test_results(outputs_path: Path) -> None:
+    csv_filename = outputs_path / TEST_OUTPUT_CSV_FILENAME
+    if csv_filename.exists():
+        csv_filename.unlink()
+    shutil.rmtree(outputs_path / TEST_ENCODED_FEATURES_DIRNAME, ignore_errors=True)
+
+
+def _save_attention_tiles_figure(selected_tiles: Tuple[Any, Any, List[Any], List[Any]], case: str,
+                                 figpath: Path) -> None:
+    slide, score, paths, attn = selected_tiles
+    fig = plot_attention_tiles(slide, score, paths, attn, case, ncols=4)
+    DeepMILModule.save_figure(fig=fig, figpath=figpath)
+    plt.close(fig)
+
+
+def _save_slide_figures(slide_dict: Dict[SlideKey, Any], slide_results: Dict[str, List[Any]], tile_size: int,
+                        level: int, folder_paths: List[Path], raster_heatmap: bool = False) -> None:
+    # The slide is loaded once for its thumbnail and heatmap, which are saved in each report folder it appears in
+    slide = slide_dict[SlideKey.SLIDE_ID]
+    load_image_dict(slide_dict, level=level, margin=0)  # type: ignore
+    slide_image = slide_dict[SlideKey.IMAGE]
+    location_bbox = slide_dict[SlideKey.LOCATION]
+
+    fig = plot_slide(slide_image=slide_image, scale=1.0)
+    for folder_path in folder_paths:
+        DeepMILModule.save_figure(fig=fig, figpath=folder_path / f'{slide}_thumbnail.png')
+    plt.close(fig)
+    fig = plot_heatmap_overlay(slide=slide, slide_image=slide_image, results=slide_results,
+                               location_bbox=location_bbox, tile_size=tile_size, level=level,
+                               raster=raster_heatmap)
+    for folder_path in folder_paths:
+        DeepMILModule.save_figure(fig=fig, figpath=folder_path / f'{slide}_heatmap.png')
+    plt.close(fig)
+
+
 class DeepMILModule(LightningModule):
     """Base class for deep multiple-instance learning"""
 
@@ -56,7 +112,15 @@ class DeepMILModule(LightningModule):
                  tile_size: int = 224,
                  level: int = 1,
                  class_names: Optional[List[str]] = None,
-                 is_finetune: bool = False) -> None:
+                 is_finetune: bool = False,
+                 batched_forward: bool = False,
+                 inference_top_k: Optional[int] = None,
+                 screening_downscale: int = 1,
+                 screening_pooling_layer: Optional[nn.Module] = None,
+                 report_pruning_deviation: bool = False,
+                 outputs_path: Optional[Path] = None,
+                 num_figure_workers: Optional[int] = None,
+                 raster_heatmaps: bool = False) -> None:
         """
         :param label_column: Label key for input batch dictionary.
         :param n_classes: Number of output classes for MIL prediction. For binary classification, n_classes should be
@@ -76,6 +140,31 @@ class DeepMILModule(LightningModule):
         :param level: The downsampling level (e.g. 0, 1, 2) of the tiles if available (default=1).
         :param class_names: The names of the classes if available (default=None).
         :param is_finetune: Boolean value to enable/disable finetuning (default=False).
+        :param batched_forward: If `True` and the pooling layer supports it (i.e. has a `forward_bags()` method),
+        the tiles of all bags in a batch are encoded in a single call and pooled per bag at once. This matches the
+        per-bag forward pass, unless the encoder depends on the batch composition, e.g. batch normalisation in
+        training mode when finetuning. If `False` (default), bags are processed one at a time.
+        :param inference_top_k: If set, run two-stage inference at test time: a cheap first pass scores all tiles
+        (see `get_screening_scores()`), then the encoder and pooling layer are applied only to the `inference_top_k`
+        highest scoring tiles of each bag. Larger values recover more of the attention of full-bag inference, at a
+        higher cost. If `None` (default), the whole bag is used.
+        :param screening_downscale: Factor by which to downscale tile images in the first pass of two-stage inference
+        (default=1, i.e. no downscaling). This requires an encoder accepting smaller images, e.g. a convolutional
+        network with global pooling, and has no effect on pre-encoded features.
+        :param screening_pooling_layer: Frozen pooling layer whose attention scores tiles in the first pass of
+        two-stage inference, e.g. a separately trained attention layer. If `None` (default), the model's own
+        pooling layer is used, or its cheaper `get_screening_attention()` if it has one (as transformer pooling
+        does, see `get_screening_scores()`).
+        :param report_pruning_deviation: If `True` and `inference_top_k` is set, also run full-bag inference at test
+        time, and save a report of how far the predictions of two-stage inference deviate from it.
+        :param outputs_path: Directory where to save test outputs. If `None` (default), use the `outputs` directory
+        in the repository root.
+        :param num_figure_workers: Number of worker processes rendering the figures of the test report. If `None`
+        (default), use up to `DEFAULT_MAX_FIGURE_WORKERS` workers, as each may hold a whole slide image in memory.
+        If 0, render figures in the main process.
+        :param raster_heatmaps: If `True`, draw the attention heatmaps of the test report as a single image of the
+        tile grid, which is much faster for large slides (see `plot_heatmap_overlay()`). If `False` (default), draw
+        one patch per tile.
         """
         super().__init__()
 
@@ -118,6 +207,21 @@ class DeepMILModule(LightningModule):
 
         # Finetuning attributes
         self.is_finetune = is_finetune
+        self.batched_forward = batched_forward
+
+        # Two-stage inference attributes
+        if inference_top_k is not None and inference_top_k < 1:
+            raise ValueError(f"inference_top_k should be at least 1, got {inference_top_k}")
+        self.inference_top_k = inference_top_k
+        self.screening_downscale = screening_downscale
+        self.screening_pooling_layer = screening_pooling_layer
+        self.report_pruning_deviation = report_pruning_deviation
+        self.pruning_deviations: List[Dict[str, Any]] = []
+
+        self.outputs_path = outputs_path
+        self.num_figure_workers = num_figure_workers
+        self.raster_heatmaps = raster_heatmaps
+        self._num_saved_test_rows = 0
 
         self.classifier_fn = self.get_classifier()
         self.loss_fn = self.get_loss()
@@ -201,6 +305,64 @@ class DeepMILModule(LightningModule):
         bag_logit = self.classifier_fn(bag_features)
         return bag_logit, attentions
 
+    def forward_bags(self, instances_list: List[Tensor]) -> Tuple[Tensor, List[Tensor]]:
+        """Compute the logits and attentions of several bags with a single encoder and pooling call.
+
+        :param instances_list: List of B tensors containing the instances of each bag.
+        :return: A tuple containing the bag logits, B x n_classes, and the list of attentions of each bag.
+        """
+        bag_sizes = [len(instances) for instances in instances_list]
+        with set_grad_enabled(self.is_finetune):
+            instance_features = self.encoder(torch.cat(instances_list))  # N X L x 1 x 1
+        attentions, bag_features = self.aggregation_fn.forward_bags(instance_features,  # type: ignore
+                                                                    bag_sizes)  # B x K x L
+        bag_logits = self.classifier_fn(bag_features.view(len(bag_sizes), -1))
+        return bag_logits, attentions
+
+    @torch.no_grad()
+    def get_screening_scores(self, instances: Tensor) -> Tensor:
+        """Cheap first pass of two-stage inference, scoring each tile by its highest attention weight.
+
+        Tiles are scored by `screening_pooling_layer` if given. Otherwise, if the pooling layer has a
+        `get_screening_attention()` method (e.g. transformer pooling, whose full self-attention is quadratic in the
+        bag size), its cheaper approximation of the attention is used, else the pooling layer itself.
+
+        :param instances: The instances of one bag, N x C x H x W for tile images, which are downscaled by
+        `screening_downscale` before encoding, or N x L for pre-encoded features.
+        :return: The score of each instance, N.
+        """
+        if self.screening_downscale > 1 and instances.ndim == 4:
+            instances = F.avg_pool2d(instances, self.screening_downscale)
+        instance_features = self.encoder(instances)
+        if self.screening_pooling_layer is not None:
+            attentions, _ = self.screening_pooling_layer(instance_features)             # K x N
+        elif hasattr(self.aggregation_fn, 'get_screening_attention'):
+            attentions = self.aggregation_fn.get_screening_attention(instance_features)  # type: ignore
+        else:
+            attentions, _ = self.aggregation_fn(instance_features)                      # K x N
+        return attentions.view(-1, len(instances)).max(dim=0).values
+
+    def forward_top_k(self, instances: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        """Two-stage inference: encode and pool only the `inference_top_k` tiles of the bag with the highest
+        screening scores (see `get_screening_scores()`).
+
+        :param instances: The instances of one bag.
+        :return: A tuple containing the bag logit, the attentions of all instances, K x N, which are zero for the
+        instances that were not selected, and the sorted indices of the selected instances.
+        """
+        num_instances = len(instances)
+        if self.inference_top_k is None or num_instances <= self.inference_top_k:
+            selected_indices = torch.arange(num_instances, device=instances.device)
+            bag_logit, attentions = self(instances)
+            return bag_logit, attentions, selected_indices
+        scores = self.get_screening_scores(instances)
+        selected_indices = scores.topk(self.inference_top_k).indices.sort().values
+        bag_logit, selected_attentions = self(instances[selected_indices])
+        selected_attentions = selected_attentions.view(-1, self.inference_top_k)
+        attentions = selected_attentions.new_zeros(selected_attentions.shape[0], num_instances)
+        attentions[:, selected_indices] = selected_attentions
+        return bag_logit, attentions, selected_indices
+
     def configure_optimizers(self) -> optim.Optimizer:
         return optim.Adam(self.parameters(), lr=self.l_rate, weight_decay=self.weight_decay,
                           betas=self.adam_betas)
@@ -211,19 +373,20 @@ class DeepMILModule(LightningModule):
     def _shared_step(self, batch: Dict, batch_idx: int, stage: str) -> Dict[ResultsKey, Tensor]:
         # The batch dict contains lists of tensors of different sizes, for all bags in the batch.
         # This means we can't stack them along a new axis without padding to the same length.
-        # We could alternatively concatenate them, but this would require other changes (e.g. in
-        # the attention layers) to correctly split the tensors by bag/slide ID.
-        bag_labels_list = []
-        bag_logits_list = []
-        bag_attn_list = []
-        for bag_idx in range(len(batch[self.label_column])):
-            images = batch[TilesDataset.IMAGE_COLUMN][bag_idx]
-            labels = batch[self.label_column][bag_idx]
-            bag_labels_list.append(self.get_bag_label(labels))
-            logit, attn = self(images)
-            bag_logits_list.append(logit.view(-1))
-            bag_attn_list.append(attn)
-        bag_logits = torch.stack(bag_logits_list)
+        # With `batched_forward`, they are instead concatenated, and the pooling layer splits them by bag.
+        bag_labels_list = [self.get_bag_label(labels) for labels in batch[self.label_column]]
+        if stage == 'test' and self.inference_top_k is not None:
+            bag_logits, bag_attn_list = self._top_k_step(batch)
+        elif self.batched_forward and hasattr(self.aggregation_fn, 'forward_bags'):
+            bag_logits, bag_attn_list = self.forward_bags(batch[TilesDataset.IMAGE_COLUMN])
+        else:
+            bag_logits_list = []
+            bag_attn_list = []
+            for images in batch[TilesDataset.IMAGE_COLUMN]:
+                logit, attn = self(images)
+                bag_logits_list.append(logit.view(-1))
+                bag_attn_list.append(attn)
+            bag_logits = torch.stack(bag_logits_list)
         bag_labels = torch.stack(bag_labels_list).view(-1)
 
         if self.n_classes > 1:
@@ -273,6 +436,52 @@ class DeepMILModule(LightningModule):
                                 "input tiles dataset.")
         return results
 
+    def _top_k_step(self, batch: Dict) -> Tuple[Tensor, List[Tensor]]:
+        bag_logits_list = []
+        bag_attn_list = []
+        for slide_ids, images in zip(batch[TilesDataset.SLIDE_ID_COLUMN], batch[TilesDataset.IMAGE_COLUMN]):
+            logit, attn, selected_indices = self.forward_top_k(images)
+            bag_logits_list.append(logit.view(-1))
+            bag_attn_list.append(attn)
+            if self.report_pruning_deviation:
+                full_logit, full_attn = self(images)
+                self.pruning_deviations.append(self._get_pruning_deviation(
+                    slide_ids[0], logit.view(-1), full_logit.view(-1), full_attn, selected_indices))
+        return torch.stack(bag_logits_list), bag_attn_list
+
+    def _get_pruning_deviation(self, slide_id: str, logit: Tensor, full_logit: Tensor, full_attn: Tensor,
+                               selected_indices: Tensor) -> Dict[str, Any]:
+        probs = self.activation_fn(logit.view(1, -1))
+        full_probs = self.activation_fn(full_logit.view(1, -1))
+        if self.n_classes > 1:
+            same_prediction = bool(argmax(probs) == argmax(full_probs))
+        else:
+            same_prediction = bool(round(probs) == round(full_probs))
+        full_attn = full_attn.view(-1, full_attn.shape[-1])
+        return {ResultsKey.SLIDE_ID: slide_id,
+                'num_tiles': full_attn.shape[-1],
+                'num_selected_tiles': len(selected_indices),
+                'max_prob_deviation': (probs - full_probs).abs().max().item(),
+                'same_prediction': same_prediction,
+                # Fraction of the full-bag attention captured by the selected tiles
+                'attention_recall': full_attn[:, selected_indices].sum(dim=1).mean().item()}
+
+    def save_pruning_deviation_report(self, outputs_path: Path) -> Dict[str, float]:
+        """Save the deviations of two-stage from full-bag inference of each slide, and print their summary.
+
+        :param outputs_path: Directory where to save the report, `pruning_deviation.csv`.
+        :return: A dictionary containing the mean of each deviation metric across slides.
+        """
+        df = pd.DataFrame(self.pruning_deviations)
+        df.to_csv(outputs_path / 'pruning_deviation.csv', index=False)
+        print(f"Two-stage inference with the top {self.inference_top_k} tiles, compared to full-bag inference: "
+              f"mean probability deviation {df['max_prob_deviation'].mean():.4f}, "
+              f"same prediction for {df['same_prediction'].mean():.2%} of slides, "
+              f"mean attention recall {df['attention_recall'].mean():.4f}")
+        return {'pruning_prob_deviation': df['max_prob_deviation'].mean(),
+                'pruning_same_prediction': df['same_prediction'].mean(),
+                'pruning_attention_recall': df['attention_recall'].mean()}
+
     def training_step(self, batch: Dict, batch_idx: int) -> Tensor:  # type: ignore
         train_result = self._shared_step(batch, batch_idx, 'train')
         self.log('train/loss', train_result[ResultsKey.LOSS], on_epoch=True, on_step=True, logger=True,
@@ -294,16 +503,91 @@ class DeepMILModule(LightningModule):
         self.log('test/loss', test_result[ResultsKey.LOSS], on_epoch=True, on_step=True, logger=True,
                  sync_dist=True)
         self.log_metrics('test')
+        # Encoded features are saved to disk with the rest of the outputs, rather than kept until the epoch end
+        self.save_test_results(test_result)
+        del test_result[ResultsKey.IMAGE]
         return test_result
 
+    def on_test_epoch_start(self) -> None:
+        self.pruning_deviations = []
+        self._num_saved_test_rows = 0
+
+    def get_outputs_path(self) -> Path:
+        return fixed_paths.repository_root_directory() / 'outputs' if self.outputs_path is None else self.outputs_path
+
+    def get_test_results_path(self) -> Path:
+        """Get the directory where this process saves test results as they arrive: the outputs directory itself, or
+        a separate subdirectory for each rank of a distributed run, merged by `merge_test_results()`."""
+        outputs_path = self.get_outputs_path()
+        if self.trainer is None or self.trainer.world_size == 1:
+            return outputs_path
+        return outputs_path / f'{TEST_RANK_OUTPUTS_DIRNAME_PREFIX}{self.global_rank}'
+
+    def save_test_results(self, results: Dict[ResultsKey, Any]) -> None:
+        """Append the results of each slide in a test batch to `test_output.csv`, and save the encoded features
+        of each slide to a separate file in `test_encoded_features/`, named after the slide ID. Outputs of previous
+        test epochs are overwritten by the first batch of each epoch. In distributed runs, each rank saves its
+        results to its own directory (see `get_test_results_path()`), so that ranks do not overwrite each other.
+
+        :param results: The results of a test batch, as returned by `_shared_step()`.
+        """
+        results_path = self.get_test_results_path()
+        csv_filename = results_path / TEST_OUTPUT_CSV_FILENAME
+        features_dir = results_path / TEST_ENCODED_FEATURES_DIRNAME
+        if self._num_saved_test_rows == 0:
+            _remove_test_results(results_path)
+            features_dir.mkdir(parents=True)
+
+        # the first dimension of every key is the N of slides in the batch
+        for slide_idx, slide_ids in enumerate(results[ResultsKey.SLIDE_ID]):
+            slide_dict = {key: value[slide_idx] for key, value in results.items()
+                          if key not in [ResultsKey.IMAGE, ResultsKey.LOSS]}
+            df = pd.DataFrame.from_dict(self.normalize_dict_for_df(slide_dict, use_gpu=False))
+            df.index += self._num_saved_test_rows
+            df.to_csv(csv_filename, mode='a', header=self._num_saved_test_rows == 0)
+            self._num_saved_test_rows += len(df)
+
+            encoded_features = results[ResultsKey.IMAGE][slide_idx].squeeze(0).cpu()
+            torch.save(encoded_features, features_dir / f'{slide_ids[0]}.pt')
+
+    def merge_test_results(self) -> None:
+        """In distributed runs, wait for all ranks to finish testing, then merge the results they saved into
+        `test_output.csv` and `test_encoded_features/` on global rank zero, in rank order."""
+        if self.trainer is None or self.trainer.world_size == 1:
+            return
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.barrier()
+        if self.global_rank != 0:
+            return
+        outputs_path = self.get_outputs_path()
+        csv_filename = outputs_path / TEST_OUTPUT_CSV_FILENAME
+        features_dir = outputs_path / TEST_ENCODED_FEATURES_DIRNAME
+        _remove_test_results(outputs_path)
+        features_dir.mkdir(parents=True)
+        num_rows = 0
+        for rank in range(self.trainer.world_size):
+            rank_path = outputs_path / f'{TEST_RANK_OUTPUTS_DIRNAME_PREFIX}{rank}'
+            rank_csv_filename = rank_path / TEST_OUTPUT_CSV_FILENAME
+            if rank_csv_filename.exists():
+                df = pd.read_csv(rank_csv_filename, index_col=0)
+                df.index += num_rows
+                df.to_csv(csv_filename, mode='a', header=num_rows == 0)
+                num_rows += len(df)
+            for features_filename in sorted((rank_path / TEST_ENCODED_FEATURES_DIRNAME).glob('*.pt')):
+                features_filename.replace(features_dir / features_filename.name)
+            shutil.rmtree(rank_path, ignore_errors=True)
+
     def test_epoch_end(self, outputs: List[Dict[str, Any]]) -> None:  # type: ignore
-        # outputs object consists of a list of dictionaries (of metadata and results, including encoded features)
+        # outputs object consists of a list of dictionaries (of metadata and results, excluding encoded features,
+        # which were already saved with the per-slide results in `test_step`)
         # It can be indexed as outputs[batch_idx][batch_key][bag_idx][tile_idx]
         # example of batch_key ResultsKey.SLIDE_ID_COL
         # for batch keys that contains multiple values for slides e.g. ResultsKey.BAG_ATTN_COL
         # outputs[batch_idx][batch_key][bag_idx][tile_idx]
         # contains the tile value
 
+        self.merge_test_results()
+
         # collate the batches
         results: Dict[str, List[Any]] = {}
         [results.update({col: []}) for col in outputs[0].keys()]
@@ -311,37 +595,13 @@ class DeepMILModule(LightningModule):
             for batch_id in range(len(outputs)):
                 results[key] += outputs[batch_id][key]
 
-        print("Saving outputs ...")
-        # collate at slide level
-        list_slide_dicts = []
-        list_encoded_features = []
-        # any column can be used here, the assumption is that the first dimension is the N of slides
-        for slide_idx in range(len(results[ResultsKey.SLIDE_ID])):
-            slide_dict = dict()
-            for key in results.keys():
-                if key not in [ResultsKey.IMAGE, ResultsKey.LOSS]:
-                    slide_dict[key] = results[key][slide_idx]
-            list_slide_dicts.append(slide_dict)
-            list_encoded_features.append(results[ResultsKey.IMAGE][slide_idx])
-
-        outputs_path = fixed_paths.repository_root_directory() / 'outputs'
-        assert outputs_path.is_dir, f"No such dir: {outputs_path}"
+        outputs_path = self.get_outputs_path()
         print(f"Metrics results will be output to {outputs_path}")
         outputs_fig_path = outputs_path / 'fig'
-        csv_filename = outputs_path / 'test_output.csv'
-        encoded_features_filename = outputs_path / 'test_encoded_features.pickle'
-
-        # Collect the list of dictionaries in a list of pandas dataframe and save
-        df_list = []
-        for slide_dict in list_slide_dicts:
-            slide_dict = self.normalize_dict_for_df(slide_dict, use_gpu=False)
-            df_list.append(pd.DataFrame.from_dict(slide_dict))
-        df = pd.concat(df_list, ignore_index=True)
-        df.to_csv(csv_filename, mode='w+', header=True)
 
-        # Collect all features in a list and save
-        features_list = self.move_list_to_device(list_encoded_features, use_gpu=False)
-        torch.save(features_list, encoded_features_filename)
+        if self.pruning_deviations:
+            pruning_metrics = self.save_pruning_deviation_report(outputs_path)
+            log_on_epoch(self, metrics={f'test/{name}': value for name, value in pruning_metrics.items()})
 
         print("Selecting tiles ...")
 
@@ -366,34 +626,20 @@ class DeepMILModule(LightningModule):
             report_cases.update({'TP_' + str(i): [tp_top_tiles, tp_bottom_tiles],
                                  'FN_' + str(i): [fn_top_tiles, fn_bottom_tiles]})
 
-        for key in report_cases.keys():
-            print(f"Plotting {key} (tiles, thumbnails, attention heatmaps)...")
+        tiles_figures = []
+        slide_folder_paths: Dict[str, List[Path]] = {}
+        for key, (top_tiles, bottom_tiles) in report_cases.items():
             key_folder_path = outputs_fig_path / f'{key}'
-            Path(key_folder_path).mkdir(parents=True, exist_ok=True)
-            nslides = len(report_cases[key][0])
-            for i in range(nslides):
-                slide, score, paths, top_attn = report_cases[key][0][i]
-                fig = plot_attention_tiles(slide, score, paths, top_attn, key + '_top', ncols=4)
-                self.save_figure(fig=fig, figpath=Path(key_folder_path, f'{slide}_top.png'))
-
-                slide, score, paths, bottom_attn = report_cases[key][1][i]
-                fig = plot_attention_tiles(slide, score, paths, bottom_attn, key + '_bottom', ncols=4)
-                self.save_figure(fig=fig, figpath=Path(key_folder_path, f'{slide}_bottom.png'))
-
-                if self.slide_dataset is not None:
-                    slide_dict = mi.first_true(self.slide_dataset, pred=lambda entry:  # type: ignore
-                                               entry[SlideKey.SLIDE_ID] == slide)
-                    _ = load_image_dict(slide_dict,
-                                        level=self.level,
-                                        margin=0)  # type: ignore
-                    slide_image = slide_dict[SlideKey.IMAGE]
-                    location_bbox = slide_dict[SlideKey.LOCATION]
-
-                    fig = plot_slide(slide_image=slide_image, scale=1.0)
-                    self.save_figure(fig=fig, figpath=Path(key_folder_path, f'{slide}_thumbnail.png'))
-                    fig = plot_heatmap_overlay(slide=slide, slide_image=slide_image, results=results,
-                                               location_bbox=location_bbox, tile_size=self.tile_size, level=self.level)
-                    self.save_figure(fig=fig, figpath=Path(key_folder_path, f'{slide}_heatmap.png'))
+            key_folder_path.mkdir(parents=True, exist_ok=True)
+            for selected_top_tiles, selected_bottom_tiles in zip(top_tiles, bottom_tiles):
+                slide = selected_top_tiles[0]
+                tiles_figures.append((selected_top_tiles, key + '_top', key_folder_path / f'{slide}_top.png'))
+                tiles_figures.append((selected_bottom_tiles, key + '_bottom',
+                                      key_folder_path / f'{slide}_bottom.png'))
+                slide_folder_paths.setdefault(slide, []).append(key_folder_path)
+
+        print(f"Plotting {', '.join(report_cases)} (tiles, thumbnails, attention heatmaps)...")
+        self.save_report_figures(results, tiles_figures, slide_folder_paths)
 
         print("Plotting histogram ...")
         fig = plot_scores_hist(results)
@@ -411,6 +657,43 @@ class DeepMILModule(LightningModule):
         fig = plot_normalized_confusion_matrix(cm=cf_matrix_n, class_names=self.class_names)
         self.save_figure(fig=fig, figpath=outputs_fig_path / 'normalized_confusion_matrix.png')
 
+    def save_report_figures(self, results: Dict[str, List[Any]],
+                            tiles_figures: List[Tuple[Tuple[Any, Any, List[Any], List[Any]], str, Path]],
+                            slide_folder_paths: Dict[str, List[Path]]) -> None:
+        """Render the figures of the selected tiles and slides of the test report, in parallel worker processes
+        unless `num_figure_workers` is 0.
+
+        :param results: The collated test results of all slides.
+        :param tiles_figures: A list of tuples containing the selected tiles of a slide (see `select_k_tiles()`),
+        the name of the report case and the path of the figure.
+        :param slide_folder_paths: A dictionary of the folders in which to save the thumbnail and heatmap of each
+        slide. Thumbnails and heatmaps are only plotted if a slide dataset is available.
+        """
+        figure_calls: List[Tuple[Callable, ...]] = [(_save_attention_tiles_figure, _to_cpu(selected_tiles), case,
+                                                     figpath) for selected_tiles, case, figpath in tiles_figures]
+        if self.slide_dataset is not None:
+            slide_indices = {slide_ids[0]: slide_idx
+                             for slide_idx, slide_ids in enumerate(results[ResultsKey.SLIDE_ID])}
+            for slide, folder_paths in slide_folder_paths.items():
+                slide_idx = slide_indices[slide]
+                # Only the results of this slide are sent to the worker
+                slide_results = {key: [_to_cpu(results[key][slide_idx])] for key in HEATMAP_RESULTS_KEYS
+                                 if key in results}
+                figure_calls.append((_save_slide_figures, self.slide_dataset.get_slide_by_id(slide), slide_results,
+                                     self.tile_size, self.level, folder_paths, self.raster_heatmaps))
+
+        if self.num_figure_workers == 0:
+            for func, *args in figure_calls:
+                func(*args)
+            return
+        num_workers = self.num_figure_workers
+        if num_workers is None:
+            num_workers = min(DEFAULT_MAX_FIGURE_WORKERS, os.cpu_count() or 1)
+        with ProcessPoolExecutor(num_workers) as executor:
+            futures = [executor.submit(func, *args) for func, *args in figure_calls]
+            for future in futures:
+                future.result()
+
     @staticmethod
     def save_figure(fig: plt.figure, figpath: Path) -> None:
         fig.savefig(figpath, bbox_inches='tight')
@@ -425,23 +708,13 @@ class DeepMILModule(LightningModule):
         for key, value in dict_old.items():
             if key not in [ResultsKey.CLASS_PROBS, ResultsKey.PROB]:
                 if isinstance(value, Tensor):
-                    value = value.squeeze(0).to(device).numpy()
+                    value = value.squeeze(0).detach().to(device).numpy()
                     if value.ndim == 0:
                         value = np.full(bag_size, fill_value=value)
                 dict_new[key] = value
             elif key == ResultsKey.CLASS_PROBS:
                 if isinstance(value, Tensor):
-                    value = value.squeeze(0).to(device).numpy()
+                    value = value.squeeze(0).detach().to(device).numpy()
                     for i in range(len(value)):
                         dict_new[key + str(i)] = np.repeat(value[i], bag_size)
         return dict_new
-
-    @staticmethod
-    def move_list_to_device(list_encoded_features: List, use_gpu: bool) -> List:
-        # a list of features on cpu obtained from original list on gpu
-        features_list = []
-        device = 'cuda' if use_gpu else 'cpu'
-        for feature in list_encoded_features:
-            feature = feature.squeeze(0).to(device)
-            features_list.append(feature)
-        return features_list
@@ -0,0 +1,194 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+"""Persistent store of tile features, addressed by the content of the encoder and the tile ID.
+
+Features are saved under a namespace derived from a hash of the encoder weights and a signature of its
+input preprocessing, so experiments using the same frozen encoder on the same tiles share features, and
+changing the encoder in any way cannot reuse stale ones. Within a namespace, newly encoded features are
+buffered in memory and appended in large chunks of `.npy` files, so growing a dataset only encodes the new
+tiles, with few files and directory listings even on mounted blob storage. Chunk names are unique and their
+tile ID files are written last, so concurrent processes can add features to the same store safely.
+"""
+
+import hashlib
+import os
+import uuid
+from multiprocessing.util import Finalize
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+import torch
+
+from histopathology.models.encoders import TileEncoder
+
+FEATURES_SUFFIX = ".features.npy"
+TILE_IDS_SUFFIX = ".tile_ids.npy"
+
+
+def get_encoder_weights_hash(encoder: torch.nn.Module) -> str:
+    """Compute a hash of the names, shapes, data types and values of all parameters and buffers of a module."""
+    hasher = hashlib.sha256()
+    for name, tensor in sorted(encoder.state_dict().items()):
+        tensor = tensor.detach().cpu().contiguous()
+        hasher.update(f"{name}|{tensor.dtype}|{tuple(tensor.shape)}".encode('utf-8'))
+        hasher.update(tensor.view(-1).view(torch.uint8).numpy().tobytes() if tensor.numel() > 0 else b'')
+    return hasher.hexdigest()
+
+
+def get_preprocessing_signature(encoder: TileEncoder) -> str:
+    """Describe the class, input shape and preprocessing of a tile encoder."""
+    return f"{type(encoder).__name__}|input_dim={encoder.input_dim}|preprocessing={encoder.preprocessing_fn!r}"
+
+
+def get_feature_namespace(encoder: TileEncoder, tiles_signature: str = "") -> str:
+    """Compute the name of the directory where to store the features computed by an encoder.
+
+    :param encoder: The tile encoder.
+    :param tiles_signature: Identifier of the tiles dataset, e.g. its name and tiling parameters, so that
+    equal tile IDs from different datasets are not confused.
+    """
+    key = "\n".join([get_encoder_weights_hash(encoder), get_preprocessing_signature(encoder), tiles_signature])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+
+def _to_list(tile_ids: Any) -> List:
+    return tile_ids.tolist() if isinstance(tile_ids, (torch.Tensor, np.ndarray)) else list(tile_ids)
+
+
+def _save_chunk(store_dir: Path, pending: Dict[Any, np.ndarray]) -> Optional[Tuple[str, List]]:
+    """Save the pending features as a new chunk, and clear them.
+
+    :return: A tuple containing the name of the new chunk and its tile IDs, or `None` if nothing was pending.
+    """
+    if not pending:
+        return None
+    tile_ids = list(pending)
+    features = np.stack(list(pending.values()))
+    chunk_name = uuid.uuid4().hex
+    for suffix, array in [(FEATURES_SUFFIX, features), (TILE_IDS_SUFFIX, np.asarray(tile_ids))]:
+        # Tile IDs are saved last and atomically, marking the chunk as complete
+        temp_path = store_dir / f"{chunk_name}{suffix}.tmp"
+        with temp_path.open('wb') as temp_file:
+            np.save(temp_file, array)
+        os.replace(temp_path, store_dir / (chunk_name + suffix))
+    pending.clear()
+    return chunk_name, tile_ids
+
+
+class TileFeatureStore:
+    """Persistent store of the features computed by one encoder for the tiles of one dataset."""
+
+    def __init__(self, store_dir: Path, min_chunk_size: int = 8192) -> None:
+        """
+        :param store_dir: Directory where to store the features. This should be specific to the encoder and
+        tiles dataset (see `get_feature_namespace()` and `for_encoder()`), and is created if needed.
+        :param min_chunk_size: Number of new tiles whose features are buffered in memory before being saved
+        as one chunk. Remaining features are saved by `flush()`, which is also called when the store is
+        pickled (e.g. for data loader workers), garbage collected, or when the process exits.
+        """
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.min_chunk_size = min_chunk_size
+        self._index: Dict[Any, Tuple[str, int]] = {}
+        self._indexed_chunks: Set[str] = set()
+        self._chunks: Dict[str, np.ndarray] = {}
+        self._pending: Dict[Any, np.ndarray] = {}
+        self._is_refreshed = False
+        self._register_finalizer()
+
+    @classmethod
+    def for_encoder(cls, root_dir: Path, encoder: TileEncoder, tiles_signature: str = "",
+                    **kwargs: Any) -> "TileFeatureStore":
+        """Create a store in a subdirectory of `root_dir` specific to the given encoder and tiles dataset.
+
+        :param kwargs: Further keyword arguments to pass to the constructor, e.g. `min_chunk_size`.
+        """
+        return cls(Path(root_dir) / get_feature_namespace(encoder, tiles_signature), **kwargs)
+
+    def _register_finalizer(self) -> None:
+        # Unlike atexit handlers, multiprocessing finalizers also run when data loader worker processes exit
+        Finalize(self, _save_chunk, args=(self.store_dir, self._pending), exitpriority=10)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Pending features are saved rather than pickled, and memory maps are re-opened in each process
+        self.flush()
+        state = self.__dict__.copy()
+        state['_chunks'] = {}
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._register_finalizer()
+
+    def refresh(self) -> None:
+        """Index the chunks saved since the last refresh, possibly by other processes.
+
+        The store directory is listed on the first lookup in each process only, so chunks saved later by
+        other processes are not found until this is called again, e.g. once per epoch.
+        """
+        for tile_ids_path in sorted(self.store_dir.glob("*" + TILE_IDS_SUFFIX)):
+            chunk_name = tile_ids_path.name[:-len(TILE_IDS_SUFFIX)]
+            if chunk_name not in self._indexed_chunks:
+                self._index_chunk(chunk_name, np.load(tile_ids_path).tolist())
+        self._is_refreshed = True
+
+    def _index_chunk(self, chunk_name: str, tile_ids: List) -> None:
+        for row, tile_id in enumerate(tile_ids):
+            self._index[tile_id] = (chunk_name, row)
+        self._indexed_chunks.add(chunk_name)
+
+    def _get_chunk(self, chunk_name: str) -> np.ndarray:
+        if chunk_name not in self._chunks:
+            self._chunks[chunk_name] = np.load(self.store_dir / (chunk_name + FEATURES_SUFFIX), mmap_mode='r')
+        return self._chunks[chunk_name]
+
+    def _get_features(self, tile_id: Any) -> Optional[np.ndarray]:
+        if tile_id in self._pending:
+            return self._pending[tile_id]
+        location = self._index.get(tile_id)
+        if location is None:
+            return None
+        chunk_name, row = location
+        return self._get_chunk(chunk_name)[row]
+
+    def lookup(self, tile_ids: Sequence) -> Tuple[np.ndarray, Optional[torch.Tensor]]:
+        """Retrieve the stored features of the given tiles.
+
+        :param tile_ids: IDs of the tiles to look up.
+        :return: A tuple containing a boolean mask of the tiles whose features were found, and a tensor of
+        the features of those tiles, in the same order, or `None` if no tiles were found.
+        """
+        if not self._is_refreshed:
+            self.refresh()
+        tile_features = [self._get_features(tile_id) for tile_id in _to_list(tile_ids)]
+        found = np.array([features is not None for features in tile_features], dtype=bool)
+        if not found.any():
+            return found, None
+        return found, torch.from_numpy(np.stack([features for features in tile_features if features is not None]))
+
+    def add(self, tile_ids: Sequence, features: torch.Tensor) -> None:
+        """Add the features of the given tiles to the store.
+
+        The features are buffered in memory, and saved as a new chunk once at least `min_chunk_size` tiles
+        are pending, or when calling `flush()`.
+
+        :param tile_ids: IDs of the tiles.
+        :param features: Features of the tiles, in the same order, as a tensor with one row per tile.
+        """
+        tile_ids = _to_list(tile_ids)
+        if len(tile_ids) != len(features):
+            raise ValueError(f"Got {len(tile_ids)} tile IDs but {len(features)} features")
+        # Copied, as the features of CPU tensors would otherwise share their memory
+        self._pending.update(zip(tile_ids, features.detach().cpu().numpy().copy()))
+        if len(self._pending) >= self.min_chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Save all pending features as a new chunk."""
+        saved_chunk = _save_chunk(self.store_dir, self._pending)
+        if saved_chunk is not None:
+            self._index_chunk(*saved_chunk)
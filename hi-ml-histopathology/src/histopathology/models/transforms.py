@@ -3,8 +3,12 @@
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
 
+import io
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Mapping, Sequence, Union, Callable, Dict
+from typing import BinaryIO, Iterable, Mapping, Optional, Sequence, Tuple, Union, Callable, Dict
 
 import torch
 import numpy as np
@@ -14,33 +18,94 @@ from monai.transforms.transform import MapTransform, Randomizable
 from torchvision.transforms.functional import to_tensor
 
 from histopathology.models.encoders import TileEncoder
+from histopathology.models.feature_store import TileFeatureStore
+from histopathology.utils.tile_shards import read_shard_members, read_tile_bytes, split_shard_path
 
 PathOrString = Union[Path, str]
 
 
-def load_pil_image(image_path: PathOrString) -> PIL.Image.Image:
-    """Load a PIL image in RGB format from the given path"""
+def load_pil_image(image_path: Union[PathOrString, BinaryIO]) -> PIL.Image.Image:
+    """Load a PIL image in RGB format from the given path (possibly inside a tile shard) or file object"""
+    if not isinstance(image_path, io.IOBase):
+        shard_location = split_shard_path(image_path)  # type: ignore
+        if shard_location is not None:
+            shard_path, member_name = shard_location
+            image_path = io.BytesIO(read_shard_members(shard_path, [member_name])[0])
     with PIL.PngImagePlugin.PngImageFile(image_path) as pil_png:
         image = np.asarray(pil_png)
     return image
 
 
-def load_image_as_tensor(image_path: PathOrString) -> torch.Tensor:
-    """Load an image as a tensor from the given path"""
+def load_image_as_tensor(image_path: Union[PathOrString, BinaryIO]) -> torch.Tensor:
+    """Load an image as a tensor from the given path (possibly inside a tile shard) or file object"""
     pil_image = load_pil_image(image_path)
     return to_tensor(pil_image)
 
 
-def load_image_stack_as_tensor(image_paths: Sequence[PathOrString],
-                               progress: bool = False) -> torch.Tensor:
-    """Load a batch of images of the same size as a tensor from the given paths"""
-    loading_generator = (load_image_as_tensor(path) for path in image_paths)
-    if progress:
-        from tqdm import tqdm
-        loading_generator = tqdm(loading_generator, desc="Loading image stack",
-                                 total=len(image_paths), leave=False)
-    image_tensors = list(loading_generator)
-    return torch.stack(image_tensors, dim=0)
+def _decode_images_into(buffer: np.ndarray, image_sources: Sequence[Union[PathOrString, BinaryIO]],
+                        start: int) -> int:
+    """Decode images into consecutive CHW slots of a preallocated uint8 buffer, starting at `start`."""
+    for offset, source in enumerate(image_sources):
+        image = load_pil_image(source)
+        if image.ndim == 2:
+            image = image[:, :, None]
+        buffer[start + offset] = image.transpose(2, 0, 1)
+    return len(image_sources)
+
+
+def load_image_stack_as_tensor(image_paths: Sequence[PathOrString], progress: bool = False,
+                               num_workers: int = 0, chunk_size: int = 16,
+                               as_uint8: bool = False) -> torch.Tensor:
+    """Load a batch of images of the same size as a tensor from the given paths.
+
+    Images are decoded directly into a preallocated `(N, C, H, W)` uint8 buffer. Images stored in tile
+    shards are read with a single opening of each shard, instead of opening each file separately.
+
+    :param image_paths: Paths of the images to load.
+    :param progress: Whether to display a tqdm progress bar.
+    :param num_workers: Number of threads decoding chunks of images concurrently. PNG decoding releases
+    the GIL, so this speeds up loading within a single data loader worker. If 0 (default), images are
+    decoded sequentially in the calling thread.
+    :param chunk_size: Number of images decoded by each threaded task.
+    :param as_uint8: If `True`, returns the raw uint8 tensor, a quarter of the size of the float tensor.
+    Otherwise (default), returns a float32 tensor scaled to [0, 1], as `torchvision`'s `to_tensor()`.
+    :return: The stacked images tensor.
+    """
+    image_sources: Sequence[Union[PathOrString, BinaryIO]] = image_paths
+    if any(split_shard_path(path) is not None for path in image_paths):
+        image_sources = [io.BytesIO(data) for data in read_tile_bytes(image_paths)]
+    if len(image_sources) == 0:
+        raise ValueError("Expected at least one image to load")
+
+    first_image = load_pil_image(image_sources[0])
+    if first_image.ndim == 2:
+        first_image = first_image[:, :, None]
+    height, width, channels = first_image.shape
+    buffer = np.empty((len(image_sources), channels, height, width), dtype=np.uint8)
+    buffer[0] = first_image.transpose(2, 0, 1)
+
+    if chunk_size < 1:
+        raise ValueError(f"Chunk size must be positive, got {chunk_size}")
+    chunk_starts = range(1, len(image_sources), chunk_size)
+
+    def decode_chunk(start: int) -> int:
+        return _decode_images_into(buffer, image_sources[start:start + chunk_size], start)
+
+    executor = ThreadPoolExecutor(num_workers) if num_workers > 0 else None
+    try:
+        decoded_chunks: Iterable[int] = executor.map(decode_chunk, chunk_starts) if executor is not None \
+            else map(decode_chunk, chunk_starts)
+        if progress:
+            from tqdm import tqdm
+            decoded_chunks = tqdm(decoded_chunks, desc="Loading image stack", total=len(chunk_starts), leave=False)
+        for _ in decoded_chunks:
+            pass
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    images = torch.from_numpy(buffer)
+    return images if as_uint8 else images.to(dtype=torch.float32).div(255)
 
 
 def transform_dict_adaptor(function: Callable, k_input: str = None, k_output: str = None) -> Callable:
@@ -97,23 +162,41 @@ class LoadTilesBatchd(MapTransform):
 
     # Cannot reuse MONAI readers because they support stacking only images with no channels
     def __init__(self, keys: KeysCollection, allow_missing_keys: bool = False,
-                 progress: bool = False) -> None:
+                 progress: bool = False, num_workers: int = 0, chunk_size: int = 16,
+                 as_uint8: bool = False) -> None:
         """
         :param keys: Key(s) for the image path(s) in the input dictionary.
         :param allow_missing_keys: If `False` (default), raises an exception when an input
         dictionary is missing any of the specified keys.
         :param progress: Whether to display a tqdm progress bar.
+        :param num_workers: Number of threads decoding the tiles of a batch concurrently. If 0 (default),
+        tiles are decoded sequentially.
+        :param chunk_size: Number of tiles decoded by each threaded task.
+        :param as_uint8: Whether to keep the loaded tiles as uint8 tensors, e.g. to reduce the memory of
+        cached bags until they are passed to `EncodeTilesBatchd`. By default (`False`), tiles are
+        loaded as float32 tensors scaled to [0, 1].
         """
         super().__init__(keys, allow_missing_keys)
         self.progress = progress
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.as_uint8 = as_uint8
 
     def __call__(self, data: Mapping) -> Mapping:
         out_data = dict(data)  # create shallow copy
         for key in self.key_iterator(out_data):
-            out_data[key] = load_image_stack_as_tensor(data[key], progress=self.progress)
+            out_data[key] = load_image_stack_as_tensor(data[key], progress=self.progress,
+                                                       num_workers=self.num_workers, chunk_size=self.chunk_size,
+                                                       as_uint8=self.as_uint8)
         return out_data
 
 
+def _to_float_images(images: torch.Tensor) -> torch.Tensor:
+    if images.dtype == torch.uint8:  # tiles kept as uint8 by `LoadTilesBatchd(..., as_uint8=True)`
+        return images.to(dtype=torch.float32).div(255)
+    return images
+
+
 class EncodeTilesBatchd(MapTransform):
     """Dictionary transform to extract features from a batch tensor of image tiles"""
 
@@ -121,43 +204,131 @@ class EncodeTilesBatchd(MapTransform):
                  keys: KeysCollection,
                  encoder: TileEncoder,
                  allow_missing_keys: bool = False,
-                 chunk_size: int = 0) -> None:
+                 chunk_size: int = 0,
+                 feature_store: Optional[TileFeatureStore] = None,
+                 tile_id_key: str = 'tile_id',
+                 pipelined: bool = False,
+                 num_threads: int = 0) -> None:
         """
         :param keys: Key(s) for the image tensor(s) in the input dictionary.
         :param encoder: The tile encoder to use for feature extraction.
         :param allow_missing_keys: If `False` (default), raises an exception when an input
         dictionary is missing any of the specified keys.
         :param chunk_size: if > 0, extracts features in chunks of size chunk_size.
+        :param feature_store: Optional persistent store of the features computed by this encoder (see
+        `TileFeatureStore.for_encoder()`). If given, only the tiles missing from the store are encoded,
+        and their features are added to it.
+        :param tile_id_key: Key for the tile IDs in the input dictionary, used to look up the feature store.
+        :param pipelined: If `True`, the next chunk of tiles is copied to the encoder's device and
+        preprocessed in a background thread (and CUDA stream) while the current chunk is encoded, and the
+        CUDA cache is not emptied after every chunk. The embeddings are identical to sequential encoding.
+        :param num_threads: If > 0, number of intra-op threads used by PyTorch while encoding, e.g. to share
+        the CPU cores between encoding and data loading.
         """
         super().__init__(keys, allow_missing_keys)
         self.encoder = encoder
         self.chunk_size = chunk_size
+        self.feature_store = feature_store
+        self.tile_id_key = tile_id_key
+        self.pipelined = pipelined
+        self.num_threads = num_threads
+        self.num_encoded_tiles = 0
+        self.encoding_seconds = 0.
+
+    @property
+    def tiles_per_second(self) -> float:
+        """Average encoding throughput since this transform was created, to help size `chunk_size`."""
+        return self.num_encoded_tiles / self.encoding_seconds if self.encoding_seconds > 0 else 0.
 
     @torch.no_grad()
     def _encode_tiles(self, images: torch.Tensor) -> torch.Tensor:
         device = next(self.encoder.parameters()).device
-        if self.chunk_size > 0:
-            embeddings = []
-            chunks = torch.split(images, self.chunk_size)
-            # TODO parallelize encoding - keep metadata and images aligned
-            for chunk in chunks:
-                chunk_embeddings = self._encode_images(chunk, device)
-                embeddings.append(chunk_embeddings)
-            return torch.cat(embeddings)
-        else:
-            return self._encode_images(images, device)
+        previous_num_threads = torch.get_num_threads()
+        if self.num_threads > 0:
+            torch.set_num_threads(self.num_threads)
+        start_time = time.perf_counter()
+        try:
+            if self.pipelined:
+                embeddings = self._encode_tiles_pipelined(images, device)
+            elif self.chunk_size > 0:
+                embeddings = torch.cat([self._encode_images(chunk, device)
+                                        for chunk in torch.split(images, self.chunk_size)])
+            else:
+                embeddings = self._encode_images(images, device)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+        finally:
+            torch.set_num_threads(previous_num_threads)
+        elapsed_seconds = time.perf_counter() - start_time
+        self.num_encoded_tiles += len(images)
+        self.encoding_seconds += elapsed_seconds
+        logging.debug(f"Encoded {len(images)} tiles at {len(images) / max(elapsed_seconds, 1e-9):.1f} tiles/s")
+        return embeddings
+
+    def _split_encoder(self) -> Tuple[Callable, Callable]:
+        """Split the encoder into its preprocessing and feature extraction, if it does not customise `forward()`."""
+        if isinstance(self.encoder, TileEncoder) and type(self.encoder).forward is TileEncoder.forward:
+            return self.encoder.preprocessing_fn, self.encoder.feature_extractor_fn
+        return (lambda images: images), self.encoder
+
+    def _encode_tiles_pipelined(self, images: torch.Tensor, device: torch.device) -> torch.Tensor:
+        preprocess, extract_features = self._split_encoder()
+        copy_stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+        def prepare_chunk(chunk: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.cuda.Event]]:
+            with torch.no_grad():
+                if copy_stream is None:
+                    return preprocess(_to_float_images(chunk.to(device))), None
+                with torch.cuda.stream(copy_stream):
+                    chunk = chunk.pin_memory() if not chunk.is_cuda else chunk
+                    prepared_chunk = preprocess(_to_float_images(chunk.to(device, non_blocking=True)))
+                    ready_event = torch.cuda.Event()
+                    ready_event.record(copy_stream)
+                return prepared_chunk, ready_event
+
+        chunks = torch.split(images, self.chunk_size) if self.chunk_size > 0 else [images]
+        embeddings = []
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_chunk: Future = executor.submit(prepare_chunk, chunks[0])
+            for index in range(len(chunks)):
+                prepared_chunk, ready_event = next_chunk.result()
+                if index + 1 < len(chunks):
+                    next_chunk = executor.submit(prepare_chunk, chunks[index + 1])
+                if ready_event is not None:
+                    torch.cuda.current_stream(device).wait_event(ready_event)
+                    prepared_chunk.record_stream(torch.cuda.current_stream(device))
+                embeddings.append(extract_features(prepared_chunk))
+        return torch.cat(embeddings)
 
     def _encode_images(self, images: torch.Tensor, device: torch.device) -> torch.Tensor:
-        images = images.to(device)
+        images = _to_float_images(images.to(device))
         embeddings = self.encoder(images)
         del images
         torch.cuda.empty_cache()
         return embeddings
 
+    def _encode_tiles_with_store(self, images: torch.Tensor, tile_ids: Sequence) -> torch.Tensor:
+        assert self.feature_store is not None
+        found, stored_embeddings = self.feature_store.lookup(tile_ids)
+        if stored_embeddings is not None and found.all():
+            return stored_embeddings.to(next(self.encoder.parameters()).device)
+        missing_indices = np.flatnonzero(~found)
+        new_embeddings = self._encode_tiles(images[torch.from_numpy(missing_indices)])
+        self.feature_store.add(take_indices(tile_ids, missing_indices), new_embeddings)
+        if stored_embeddings is None:
+            return new_embeddings
+        embeddings = new_embeddings.new_empty((len(found), *new_embeddings.shape[1:]))
+        embeddings[torch.from_numpy(~found)] = new_embeddings
+        embeddings[torch.from_numpy(found)] = stored_embeddings.to(embeddings)
+        return embeddings
+
     def __call__(self, data: Mapping) -> Mapping:
         out_data = dict(data)  # create shallow copy
         for key in self.key_iterator(out_data):
-            out_data[key] = self._encode_tiles(data[key])
+            if self.feature_store is None:
+                out_data[key] = self._encode_tiles(data[key])
+            else:
+                out_data[key] = self._encode_tiles_with_store(data[key], data[self.tile_id_key])
         return out_data
 
 
@@ -189,7 +360,7 @@ class Subsampled(MapTransform, Randomizable):
 
     def randomize(self, total_size: int) -> None:
         subsample_size = min(self.max_size, total_size)
-        self._indices = self.R.choice(total_size, size=subsample_size)
+        self._indices = self.R.choice(total_size, size=subsample_size, replace=False)
 
     def __call__(self, data: Mapping) -> Mapping:
         out_data = dict(data)  # create shallow copy
@@ -13,7 +13,7 @@ import shutil
 import traceback
 import warnings
 from pathlib import Path
-from typing import Sequence, Tuple, Union
+from typing import Optional, Sequence, Tuple, Union
 
 import numpy as np
 import PIL
@@ -22,6 +22,12 @@ from monai.data.image_reader import WSIReader
 from tqdm import tqdm
 
 from histopathology.preprocessing import tiling
+from histopathology.preprocessing.slide_journal import (DATASET_CSV_FILENAME, commit_file, get_temp_path,
+                                                        is_slide_completed, merge_dataset_csv_files,
+                                                        prepare_slide_dir, reconcile_journal, record_completed_slide,
+                                                        save_tile_index)
+from histopathology.preprocessing.slide_scheduler import estimate_slide_memory, run_slides, save_slide_timings
+from histopathology.preprocessing.tile_writer import AsyncTileWriter
 from histopathology.datasets.panda_dataset import PandaDataset, LoadPandaROId
 
 
@@ -109,19 +115,20 @@ def save_tile(sample: dict, image_tile: np.ndarray, mask_tile: np.ndarray,
 
 
 def process_slide(sample: dict, level: int, margin: int, tile_size: int, occupancy_threshold: int,
-                  output_dir: Path, tile_progress: bool = False) -> None:
+                  output_dir: Path, tile_progress: bool = False, writer_threads: int = 0) -> None:
     slide_id = sample['image_id']
     slide_dir: Path = output_dir / (slide_id + "/")
     logging.info(f">>> Slide dir {slide_dir}")
-    if slide_dir.exists():  # already processed slide - skip
+    if is_slide_completed(slide_dir):  # already processed slide - skip
         logging.info(f">>> Skipping {slide_dir} - already processed")
         return
     else:
         try:
-            slide_dir.mkdir(parents=True)
+            prepare_slide_dir(slide_dir)  # discards outputs of any interrupted run
 
-            dataset_csv_path = slide_dir / "dataset.csv"
-            dataset_csv_file = dataset_csv_path.open('w')
+            # The CSV is renamed from its temporary path only once the slide is complete
+            dataset_csv_path = slide_dir / DATASET_CSV_FILENAME
+            dataset_csv_file = get_temp_path(dataset_csv_path).open('w')
             dataset_csv_file.write(','.join(CSV_COLUMNS) + '\n')  # write CSV header
 
             tiles_failure = 0
@@ -138,14 +145,15 @@ def process_slide(sample: dict, level: int, margin: int, tile_size: int, occupan
                 generate_tiles(sample, tile_size, occupancy_threshold)
             n_tiles = image_tiles.shape[0]
 
-            for i in tqdm(range(n_tiles), f"Tiles ({slide_id[:6]}…)", unit="img", disable=not tile_progress):
+            def write_tile_row(i: int, tile_metadata: Optional[dict], error: Optional[BaseException]) -> None:
+                nonlocal tiles_failure
                 try:
-                    tile_metadata = save_tile(sample, image_tiles[i], mask_tiles[i], tile_locations[i],
-                                              slide_dir)
-                    tile_metadata['occupancy'] = occupancies[i]
-                    tile_metadata['image'] = os.path.join(slide_dir.name, tile_metadata['image'])
-                    tile_metadata['mask'] = os.path.join(slide_dir.name, tile_metadata['mask'])
-                    dataset_row = ','.join(str(tile_metadata[column]) for column in CSV_COLUMNS)
+                    if error is not None:
+                        raise error
+                    tile_metadata['occupancy'] = occupancies[i]  # type: ignore
+                    tile_metadata['image'] = os.path.join(slide_dir.name, tile_metadata['image'])  # type: ignore
+                    tile_metadata['mask'] = os.path.join(slide_dir.name, tile_metadata['mask'])  # type: ignore
+                    dataset_row = ','.join(str(tile_metadata[column]) for column in CSV_COLUMNS)  # type: ignore
                     dataset_csv_file.write(dataset_row + '\n')
                 except Exception as e:
                     tiles_failure += 1
@@ -155,8 +163,21 @@ def process_slide(sample: dict, level: int, margin: int, tile_size: int, occupan
                     warnings.warn(f"An error occurred while saving tile "
                                   f"{get_tile_id(slide_id, tile_locations[i])}: {e}")
 
+            with AsyncTileWriter(num_threads=writer_threads) as tile_writer:
+                for i in tqdm(range(n_tiles), f"Tiles ({slide_id[:6]}…)", unit="img", disable=not tile_progress):
+                    job = functools.partial(save_tile, sample, image_tiles[i], mask_tiles[i], tile_locations[i],
+                                            slide_dir)
+                    for completed in tile_writer.submit(job, context=i):
+                        write_tile_row(*completed)
+                for completed in tile_writer.drain():
+                    write_tile_row(*completed)
+                logging.info(f"Saved {tile_writer.n_completed} tiles for slide {slide_id} "
+                             f"({tile_writer.throughput:.1f} tiles/s)")
+
             dataset_csv_file.close()
             failed_tiles_file.close()
+            commit_file(get_temp_path(dataset_csv_path), dataset_csv_path)
+            record_completed_slide(output_dir, slide_id)
             if tiles_failure > 0:
                 # TODO what we want to do with slides that have some failed tiles?
                 logging.warning(f"{slide_id} is incomplete. {tiles_failure} tiles failed.")
@@ -165,27 +186,10 @@ def process_slide(sample: dict, level: int, margin: int, tile_size: int, occupan
             warnings.warn(f"An error occurred while processing slide {slide_id}: {e}")
 
 
-def merge_dataset_csv_files(dataset_dir: Path) -> Path:
-    full_csv = dataset_dir / "dataset.csv"
-    # TODO change how we retrieve these filenames, probably because mounted, the operation is slow
-    #  and it seems to find many more files
-    # print("List of files")
-    # print([str(file) + '\n' for file in dataset_dir.glob("*/dataset.csv")])
-    with full_csv.open('w') as full_csv_file:
-        # full_csv_file.write(','.join(CSV_COLUMNS) + '\n')  # write CSV header
-        first_file = True
-        for slide_csv in tqdm(dataset_dir.glob("*/dataset.csv"), desc="Merging dataset.csv", unit='file'):
-            logging.info(f"Merging slide {slide_csv}")
-            content = slide_csv.read_text()
-            if not first_file:
-                content = content[content.index('\n') + 1:]  # discard header row for all but the first file
-            full_csv_file.write(content)
-            first_file = False
-    return full_csv
-
-
 def main(panda_dir: Union[str, Path], root_output_dir: Union[str, Path], level: int, tile_size: int,
-         margin: int, occupancy_threshold: float, parallel: bool = False, overwrite: bool = False) -> None:
+         margin: int, occupancy_threshold: float, parallel: bool = False, overwrite: bool = False,
+         writer_threads: int = 0, max_workers: Optional[int] = None, memory_budget: Optional[int] = None,
+         merge_csv: bool = True, parquet_index: bool = False) -> None:
 
     # Ignoring some types here because mypy is getting confused with the MONAI Dataset class
     # to select a subsample use keyword n_slides
@@ -200,23 +204,27 @@ def main(panda_dir: Union[str, Path], root_output_dir: Union[str, Path], level:
 
     func = functools.partial(process_slide, level=level, margin=margin, tile_size=tile_size,
                              occupancy_threshold=occupancy_threshold, output_dir=output_dir,
-                             tile_progress=not parallel)
-
-    if parallel:
-        import multiprocessing
-
-        pool = multiprocessing.Pool()
-        map_func = pool.imap_unordered  # type: ignore
-    else:
-        map_func = map  # type: ignore
-
-    list(tqdm(map_func(func, dataset), desc="Slides", unit="img", total=len(dataset)))  # type: ignore
-
-    if parallel:
-        pool.close()
-
-    logging.info("Merging slide files in a single file")
-    merge_dataset_csv_files(output_dir)
+                             tile_progress=not parallel, writer_threads=writer_threads)
+
+    samples = [dataset[i] for i in range(len(dataset))]
+    slide_ids = [sample['image_id'] for sample in samples]
+    # Slides completed by workers killed before journaling them are skipped below, so journal them now
+    reconcile_journal(output_dir, slide_ids)
+    samples = [sample for sample in samples if not is_slide_completed(output_dir / sample['image_id'])]
+    logging.info(f"{len(dataset) - len(samples)} slides already processed, {len(samples)} remaining")
+    memory_estimates = [estimate_slide_memory([sample['image'], sample['mask']], level) for sample in samples]
+    timings = run_slides(func, samples, slide_ids=[sample['image_id'] for sample in samples],
+                         memory_estimates=memory_estimates, parallel=parallel, max_workers=max_workers,
+                         memory_budget=memory_budget)
+    save_slide_timings(timings, output_dir)
+
+    completed_slide_ids = [slide_id for slide_id in slide_ids if is_slide_completed(output_dir / slide_id)]
+    if merge_csv:
+        logging.info("Merging slide files in a single file")
+        merge_dataset_csv_files(output_dir, completed_slide_ids)
+    if parquet_index:
+        logging.info("Saving slide files in a single Parquet tile index")
+        save_tile_index(output_dir, completed_slide_ids)
 
 
 if __name__ == '__main__':
@@ -4,23 +4,32 @@
 #  ------------------------------------------------------------------------------------------
 
 import functools
+import io
 import logging
 import shutil
 import traceback
 import warnings
 from pathlib import Path
-from typing import Any, Dict, Iterable, Optional, Sequence, Tuple, Union
+from typing import Any, Dict, Iterable, Iterator, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import PIL
+import skimage.filters
 from monai.data import Dataset
 from monai.data.image_reader import WSIReader
 from tqdm import tqdm
 
 from histopathology.datasets.base_dataset import SlidesDataset
 from histopathology.preprocessing import tiling
-from histopathology.preprocessing.loading import LoadROId, segment_foreground
+from histopathology.preprocessing.loading import LoadROId, get_luminance, segment_foreground
+from histopathology.preprocessing.slide_journal import (DATASET_CSV_FILENAME, commit_file, get_temp_path,
+                                                        is_slide_completed, merge_dataset_csv_files,
+                                                        prepare_slide_dir, reconcile_journal, record_completed_slide,
+                                                        save_tile_index)
+from histopathology.preprocessing.slide_scheduler import estimate_slide_memory, run_slides, save_slide_timings
+from histopathology.preprocessing.tile_writer import AsyncTileWriter
 from histopathology.utils.naming import SlideKey, TileKey
+from histopathology.utils.tile_shards import SHARD_FILENAME, TileFormat, TileShardWriter, split_shard_path
 
 logging.basicConfig(format='%(asctime)s %(message)s', filemode='w')
 logger = logging.getLogger()
@@ -47,8 +56,10 @@ def get_tile_descriptor(tile_location: Sequence[int]) -> str:
     return f"{tile_location[0]:05d}x_{tile_location[1]:05d}y"
 
 
-def get_tile_id(slide_id: str, tile_location: Sequence[int]) -> str:
-    """Format the slide ID and XY tile coordinates into a unique tile ID."""
+def get_tile_id(slide_id: str, tile_location: Sequence[int], level: Optional[int] = None) -> str:
+    """Format the slide ID and XY tile coordinates (and magnification level, if given) into a unique tile ID."""
+    if level is not None:
+        return f"{slide_id}.level{level}.{get_tile_descriptor(tile_location)}"
     return f"{slide_id}.{get_tile_descriptor(tile_location)}"
 
 
@@ -61,40 +72,384 @@ def save_image(array_chw: np.ndarray, path: Path) -> PIL.Image:
     return pil_image
 
 
+def encode_image(array_chw: np.ndarray) -> bytes:
+    """Encode an image array in (C, H, W) format as PNG, exactly as `save_image()` would save it."""
+    array_hwc = np.moveaxis(array_chw, 0, -1).astype(np.uint8).squeeze()
+    pil_image = PIL.Image.fromarray(array_hwc)
+    buffer = io.BytesIO()
+    pil_image.convert('RGB').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
 def generate_tiles(slide_image: np.ndarray, tile_size: int, foreground_threshold: float,
-                   occupancy_threshold: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+                   occupancy_threshold: float, stride: Optional[int] = None) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
     """Split the foreground of an input slide image into tiles.
 
+    The foreground is segmented once on the whole image, and tiles are only copied out of the image
+    after discarding empty ones, so peak memory does not include a copy of all tiles.
+
     :param slide_image: The RGB image array in (C, H, W) format.
     :param tile_size: Lateral dimensions of each tile, in pixels.
-    :param foreground_threshold: Luminance threshold (0 to 255) to determine tile occupancy.
+    :param foreground_threshold: Luminance threshold (0 to 255) to determine tile occupancy. If `None`,
+    it is estimated with Otsu's method on the padded image, i.e. on the same pixels as when segmenting
+    all non-overlapping tiles. With overlapping tiles (`stride < tile_size`), each pixel is counted once.
     :param occupancy_threshold: Threshold (between 0 and 1) to determine empty tiles to discard.
+    :param stride: Distance in pixels between the starts of consecutive tiles, for overlapping tiles.
+    If `None` (default), equal to `tile_size` (non-overlapping tiles).
     :return: A tuple containing the image tiles (N, C, H, W), tile coordinates (N, 2), occupancies
     (N,), and total number of discarded empty tiles.
     """
-    image_tiles, tile_locations = tiling.tile_array_2d(slide_image, tile_size=tile_size,
+    tile_views, tile_coords = tiling.get_tile_views_2d(slide_image, tile_size=tile_size, stride=stride,
                                                        constant_values=255)
-    foreground_mask, _ = segment_foreground(image_tiles, foreground_threshold)
-
-    selected, occupancies = select_tiles(foreground_mask, occupancy_threshold)
+    if foreground_threshold is None:
+        padded_luminance, _ = tiling.pad_for_tiling_2d(get_luminance(slide_image)[None], tile_size, stride=stride,
+                                                       constant_values=255)
+        foreground_threshold = skimage.filters.threshold_otsu(padded_luminance)
+    foreground_mask, foreground_threshold = segment_foreground(slide_image, foreground_threshold)
+    # Padding is white (255), so background unless the threshold is above that
+    mask_views, _ = tiling.get_tile_views_2d(foreground_mask[None], tile_size=tile_size, stride=stride,
+                                             constant_values=255 < foreground_threshold)
+
+    selected, occupancies = select_tiles(mask_views[:, :, 0], occupancy_threshold)
+    # select_tiles() returns scalars for a single tile, which would break the boolean indexing below
+    selected, occupancies = np.atleast_1d(selected).reshape(-1), np.atleast_1d(occupancies).reshape(-1)
     n_discarded = (~selected).sum()
     logging.info(f"Percentage tiles discarded: {n_discarded / len(selected) * 100:.2f}")
 
-    image_tiles = image_tiles[selected]
-    tile_locations = tile_locations[selected]
+    # Only the selected tiles are copied out of the tile views
+    tile_rows, tile_cols = np.unravel_index(np.flatnonzero(selected), tile_views.shape[:2])
+    image_tiles = tile_views[tile_rows, tile_cols]
+    tile_locations = tile_coords.reshape(-1, 2)[selected]
     occupancies = occupancies[selected]
 
     return image_tiles, tile_locations, occupancies, n_discarded
 
 
+def read_roi_region(loader: LoadROId, image_obj: Any, origin: Tuple[int, int], scale: float,
+                    roi_shape: Tuple[int, int], y_range: Tuple[int, int], x_range: Tuple[int, int]) -> np.ndarray:
+    """Read a rectangular region of the slide ROI at the loader's level, padding it with white (255).
+
+    The region is given in pixel coordinates at the target level, relative to the top-left corner of the
+    ROI, and may extend beyond the ROI bounds (e.g. into the tiling padding), in which case only the
+    part inside the ROI is read from the slide.
+
+    :param loader: The ROI loading transform, defining the reader and level to use.
+    :param image_obj: The cuCIM image object returned by `loader.reader.read(<image_file>)`.
+    :param origin: ROI origin in the level 0 reference frame, as returned by `LoadROId.get_roi()`.
+    :param scale: Scale of the target level, as returned by `LoadROId.get_roi()`.
+    :param roi_shape: Height and width of the ROI, in pixels at the target level.
+    :param y_range: Start (inclusive) and end (exclusive) rows of the region, relative to the ROI.
+    :param x_range: Start (inclusive) and end (exclusive) columns of the region, relative to the ROI.
+    :return: The region image array in (C, H, W) format, of shape `(C, y1 - y0, x1 - x0)`.
+    """
+    height, width = roi_shape
+    (y0, y1), (x0, x1) = y_range, x_range
+    read_y0, read_y1 = max(y0, 0), min(y1, height)
+    read_x0, read_x1 = max(x0, 0), min(x1, width)
+
+    location = (origin[0] + int(read_y0 * scale), origin[1] + int(read_x0 * scale))
+    region, _ = loader.reader.get_data(image_obj, location=location, level=loader.level,
+                                       size=(read_y1 - read_y0, read_x1 - read_x0))
+    padding = ((0, 0), (read_y0 - y0, y1 - read_y1), (read_x0 - x0, x1 - read_x1))
+    return np.pad(region, padding, constant_values=255)
+
+
+def load_roi_strips(loader: LoadROId, sample: Dict[SlideKey, Any], tile_size: int,
+                    strip_rows: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Lazily load the slide ROI in horizontal strips spanning a fixed number of tile rows.
+
+    Each strip is padded exactly as `tiling.tile_array_2d()` would pad the full ROI, so tiling the
+    strips one after another reproduces the tiles of the whole ROI, in the same order. The ROI
+    origin, scale, and foreground threshold are added to `sample` before the first strip is read.
+
+    :param loader: The ROI loading transform, defining the reader, level, and margin to use.
+    :param sample: Slide information dictionary, returned by the input slide dataset.
+    :param tile_size: Lateral dimensions of each tile, in pixels.
+    :param strip_rows: Number of tile rows to load in each strip.
+    :return: An iterator over tuples containing the padded strip image in (C, H, W) format and the
+    XY offset of the strip relative to the ROI origin, to be added to tile coordinates within the strip.
+    """
+    image_obj = loader.reader.read(sample[loader.image_key])
+    try:
+        origin, scale, scaled_bbox, threshold = loader.get_roi(image_obj)
+        sample[SlideKey.ORIGIN] = origin
+        sample[SlideKey.SCALE] = scale
+        sample[SlideKey.FOREGROUND_THRESHOLD] = threshold
+
+        # Same (location, size) convention as in LoadROId, i.e. shape of the loaded (C, H, W) array
+        roi_shape = (scaled_bbox.w, scaled_bbox.h)
+        height, width = roi_shape
+        pad_top, pad_bottom = tiling.get_1d_padding(height, tile_size)
+        pad_left, pad_right = tiling.get_1d_padding(width, tile_size)
+        padded_height = pad_top + height + pad_bottom
+
+        strip_height = strip_rows * tile_size
+        for strip_start in range(0, padded_height, strip_height):
+            # Rows of the strip in the ROI frame, including any padding rows
+            strip_y0 = strip_start - pad_top
+            strip_y1 = min(strip_start + strip_height, padded_height) - pad_top
+            strip = read_roi_region(loader, image_obj, origin, scale, roi_shape,
+                                    y_range=(strip_y0, strip_y1), x_range=(-pad_left, width + pad_right))
+            yield strip, np.array([-pad_left, strip_y0])
+    finally:
+        image_obj.close()
+
+
+def generate_tiles_by_strips(loader: LoadROId, sample: Dict[SlideKey, Any], tile_size: int,
+                             occupancy_threshold: float, strip_rows: int) \
+        -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray, int]]:
+    """Split the foreground of a slide into tiles, loading and tiling one strip of the ROI at a time.
+
+    Peak memory thus depends on the strip size instead of the ROI size, and the concatenated outputs
+    are identical to those of `generate_tiles()` applied to the full ROI.
+
+    :param loader: The ROI loading transform, defining the reader, level, and margin to use.
+    :param sample: Slide information dictionary, returned by the input slide dataset.
+    :param tile_size: Lateral dimensions of each tile, in pixels.
+    :param occupancy_threshold: Threshold (between 0 and 1) to determine empty tiles to discard.
+    :param strip_rows: Number of tile rows to load in each strip.
+    :return: An iterator over the outputs of `generate_tiles()` for each strip, with tile coordinates
+    relative to the ROI origin.
+    """
+    for strip, strip_offset in load_roi_strips(loader, sample, tile_size, strip_rows):
+        image_tiles, tile_locations, occupancies, n_discarded = \
+            generate_tiles(strip, tile_size, sample[SlideKey.FOREGROUND_THRESHOLD], occupancy_threshold)
+        yield image_tiles, tile_locations + strip_offset, occupancies, n_discarded
+
+
+def estimate_tile_occupancies(thumbnail_mask: np.ndarray, thumbnail_scale: float, origin: Tuple[int, int],
+                              scale: float, roi_shape: Tuple[int, int], tile_size: int) -> np.ndarray:
+    """Estimate the foreground occupancy of every tile in the padded ROI tile grid from a thumbnail mask.
+
+    Each tile is mapped to the smallest block of thumbnail pixels covering its part inside the ROI,
+    and its occupancy is approximated by the foreground fraction of that block, weighted by the
+    fraction of the tile lying inside the ROI (padding is always background). Block sums are computed
+    in constant time per tile with a summed-area table, so planning costs nothing at the target level.
+
+    :param thumbnail_mask: Boolean foreground mask at the lowest resolution, in (H, W) format.
+    :param thumbnail_scale: Downsampling factor of `thumbnail_mask` relative to level 0.
+    :param origin: ROI origin in the level 0 reference frame, as returned by `LoadROId.get_roi()`.
+    :param scale: Scale of the target level, as returned by `LoadROId.get_roi()`.
+    :param roi_shape: Height and width of the ROI, in pixels at the target level.
+    :param tile_size: Lateral dimensions of each tile, in pixels at the target level.
+    :return: A float array of shape `(n_tile_rows, n_tile_cols)` with the estimated occupancies, laid
+    out like the tile grid of `tiling.tile_array_2d()` applied to the full ROI.
+    """
+    height, width = roi_shape
+    pad_top, pad_bottom = tiling.get_1d_padding(height, tile_size)
+    pad_left, pad_right = tiling.get_1d_padding(width, tile_size)
+    n_rows = (pad_top + height + pad_bottom) // tile_size
+    n_cols = (pad_left + width + pad_right) // tile_size
+
+    def tile_edges(length: int, pad_before: int, n_tiles: int, origin_1d: int, thumbnail_length: int) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Tile extents in the ROI frame, clipped to the ROI, then mapped to thumbnail pixels
+        starts = np.clip(tile_size * np.arange(n_tiles) - pad_before, 0, length)
+        ends = np.clip(tile_size * np.arange(1, n_tiles + 1) - pad_before, 0, length)
+        thumb_starts = np.floor((origin_1d + starts * scale) / thumbnail_scale).astype(int)
+        thumb_ends = np.ceil((origin_1d + ends * scale) / thumbnail_scale).astype(int)
+        thumb_starts = np.clip(thumb_starts, 0, thumbnail_length)
+        thumb_ends = np.clip(np.maximum(thumb_ends, thumb_starts + 1), 0, thumbnail_length)
+        return thumb_starts, thumb_ends, (ends - starts) / tile_size
+
+    row_starts, row_ends, row_fractions = tile_edges(height, pad_top, n_rows, origin[0], thumbnail_mask.shape[0])
+    col_starts, col_ends, col_fractions = tile_edges(width, pad_left, n_cols, origin[1], thumbnail_mask.shape[1])
+
+    summed_area = np.zeros((thumbnail_mask.shape[0] + 1, thumbnail_mask.shape[1] + 1))
+    summed_area[1:, 1:] = thumbnail_mask.cumsum(axis=0).cumsum(axis=1)
+    r0, r1 = row_starts[:, None], row_ends[:, None]
+    c0, c1 = col_starts[None, :], col_ends[None, :]
+    foreground_sums = summed_area[r1, c1] - summed_area[r0, c1] - summed_area[r1, c0] + summed_area[r0, c0]
+    block_areas = np.maximum((r1 - r0) * (c1 - c0), 1)
+
+    return foreground_sums / block_areas * row_fractions[:, None] * col_fractions[None, :]
+
+
+def generate_planned_tiles(loader: LoadROId, sample: Dict[SlideKey, Any], tile_size: int,
+                           occupancy_threshold: float, plan_occupancy_threshold: float) \
+        -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray, int]]:
+    """Split the foreground of a slide into tiles, reading only candidate tiles at the target level.
+
+    Candidate tiles are first chosen from the thumbnail foreground mask already computed to estimate
+    the ROI (see `estimate_tile_occupancies()`). Only those are then read from the slide, batching
+    consecutive candidates in a tile row into a single region read, and the exact occupancy filtering
+    of `generate_tiles()` is applied to them. Background regions are therefore never decoded.
+
+    With a conservative `plan_occupancy_threshold` (e.g. 0), the outputs are the same as those of
+    `generate_tiles()` applied to the full ROI, except for tiles whose foreground is too small to be
+    visible in the thumbnail.
+
+    :param loader: The ROI loading transform, defining the reader, level, and margin to use.
+    :param sample: Slide information dictionary, returned by the input slide dataset.
+    :param tile_size: Lateral dimensions of each tile, in pixels.
+    :param occupancy_threshold: Threshold (between 0 and 1) to determine empty tiles to discard.
+    :param plan_occupancy_threshold: Threshold (between 0 and 1) on the occupancy estimated from the
+    thumbnail, to determine which tiles to read at the target level.
+    :return: An iterator over the outputs of `generate_tiles()` for each tile row, with tile coordinates
+    relative to the ROI origin. Tiles discarded during planning are counted as discarded.
+    """
+    if plan_occupancy_threshold < 0. or plan_occupancy_threshold > 1.:
+        raise ValueError("Planning occupancy threshold must be between 0 and 1")
+    image_obj = loader.reader.read(sample[loader.image_key])
+    try:
+        thumbnail_foreground = loader.get_thumbnail_foreground(image_obj)
+        origin, scale, scaled_bbox, threshold = loader.get_roi(image_obj, thumbnail_foreground)
+        sample[SlideKey.ORIGIN] = origin
+        sample[SlideKey.SCALE] = scale
+        sample[SlideKey.FOREGROUND_THRESHOLD] = threshold
+
+        roi_shape = (scaled_bbox.w, scaled_bbox.h)
+        pad_top, _ = tiling.get_1d_padding(roi_shape[0], tile_size)
+        pad_left, _ = tiling.get_1d_padding(roi_shape[1], tile_size)
+        thumbnail_mask, thumbnail_scale, _ = thumbnail_foreground
+        estimated_occupancies = estimate_tile_occupancies(thumbnail_mask, thumbnail_scale, origin, scale,
+                                                          roi_shape, tile_size)
+        candidates = estimated_occupancies > plan_occupancy_threshold
+        logging.info(f"Percentage tiles to read: {candidates.mean() * 100:.2f}")
+
+        for row, row_candidates in enumerate(candidates):
+            row_y0 = row * tile_size - pad_top
+            n_discarded = int((~row_candidates).sum())
+            if n_discarded == len(row_candidates):
+                yield (np.empty((0, 3, tile_size, tile_size), dtype=np.uint8), np.empty((0, 2), dtype=int),
+                       np.empty(0), n_discarded)
+                continue
+            # Find runs of consecutive candidate tiles, to be read together as a single region
+            edges = np.diff(np.concatenate([[0], row_candidates.astype(int), [0]]))
+            run_starts, run_ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+            all_tiles, all_locations, all_occupancies = [], [], []
+            for col_start, col_end in zip(run_starts, run_ends):
+                run_x0 = col_start * tile_size - pad_left
+                region = read_roi_region(loader, image_obj, origin, scale, roi_shape,
+                                         y_range=(row_y0, row_y0 + tile_size),
+                                         x_range=(run_x0, col_end * tile_size - pad_left))
+                image_tiles, tile_locations, occupancies, run_discarded = \
+                    generate_tiles(region, tile_size, threshold, occupancy_threshold)
+                all_tiles.append(image_tiles)
+                all_locations.append(tile_locations + np.array([run_x0, row_y0]))
+                all_occupancies.append(occupancies)
+                n_discarded += run_discarded
+            yield (np.concatenate(all_tiles), np.concatenate(all_locations), np.concatenate(all_occupancies),
+                   n_discarded)
+    finally:
+        image_obj.close()
+
+
+def generate_pyramid_tiles(loader: LoadROId, sample: Dict[SlideKey, Any],
+                           levels_and_tile_sizes: Sequence[Tuple[int, int]], occupancy_threshold: float) \
+        -> Iterator[Tuple[int, int, float, np.ndarray, np.ndarray, np.ndarray, int]]:
+    """Split the foreground of a slide into tiles at several magnification levels, on aligned tile grids.
+
+    The slide is opened, and its thumbnail loaded and segmented, only once: all levels share the same
+    ROI and foreground threshold. The tile grids are aligned on the grid with the largest tile footprint
+    (in level 0 pixels), which is padded exactly as `tiling.tile_array_2d()` would pad it, so that each
+    tile at a coarser level exactly covers whole tiles at finer levels when footprints are multiples of
+    each other. The ROI origin, the scale of `loader.level`, and the foreground threshold are added to
+    `sample`.
+
+    :param loader: The ROI loading transform, defining the reader, margin, and foreground threshold to use.
+    :param sample: Slide information dictionary, returned by the input slide dataset.
+    :param levels_and_tile_sizes: Pairs of magnification level and tile size to tile.
+    :param occupancy_threshold: Threshold (between 0 and 1) to determine empty tiles to discard.
+    :return: An iterator over tuples containing the level, tile size, and scale for each pair in
+    `levels_and_tile_sizes`, followed by the outputs of `generate_tiles()` at that level, with tile
+    coordinates relative to the ROI origin, in pixels at that level.
+    """
+    image_obj = loader.reader.read(sample[loader.image_key])
+    try:
+        thumbnail_foreground = loader.get_thumbnail_foreground(image_obj)
+        level_loaders = [LoadROId(loader.reader, image_key=loader.image_key, level=level, margin=loader.margin,
+                                  foreground_threshold=loader.foreground_threshold)
+                         for level, _ in levels_and_tile_sizes]
+        rois = [level_loader.get_roi(image_obj, thumbnail_foreground) for level_loader in level_loaders]
+        origin, _, _, threshold = rois[0]
+        sample[SlideKey.ORIGIN] = origin
+        sample[SlideKey.SCALE] = image_obj.resolutions['level_downsamples'][loader.level]
+        sample[SlideKey.FOREGROUND_THRESHOLD] = threshold
+
+        # Padding and number of tiles of the reference grid, in level 0 pixels
+        footprints = [tile_size * scale for (_, tile_size), (_, scale, _, _) in zip(levels_and_tile_sizes, rois)]
+        reference = int(np.argmax(footprints))
+        _, reference_scale, reference_bbox, _ = rois[reference]
+        reference_tile_size = levels_and_tile_sizes[reference][1]
+        # Same (location, size) convention as in LoadROId, i.e. shape of the loaded (C, H, W) array
+        reference_height, reference_width = reference_bbox.w, reference_bbox.h
+        pad_top_0 = tiling.get_1d_padding(reference_height, reference_tile_size)[0] * reference_scale
+        pad_left_0 = tiling.get_1d_padding(reference_width, reference_tile_size)[0] * reference_scale
+        n_reference_rows = -(-reference_height // reference_tile_size)  # ceiling division
+        n_reference_cols = -(-reference_width // reference_tile_size)
+
+        for (level, tile_size), level_loader, footprint, (_, scale, scaled_bbox, _) \
+                in zip(levels_and_tile_sizes, level_loaders, footprints, rois):
+            # Express the reference grid in pixels and tiles at this level
+            pad_top, pad_left = int(round(pad_top_0 / scale)), int(round(pad_left_0 / scale))
+            tiles_per_reference_tile = int(round(footprints[reference] / footprint))
+            grid_height = n_reference_rows * tiles_per_reference_tile * tile_size
+            grid_width = n_reference_cols * tiles_per_reference_tile * tile_size
+            region = read_roi_region(level_loader, image_obj, origin, scale, (scaled_bbox.w, scaled_bbox.h),
+                                     y_range=(-pad_top, grid_height - pad_top),
+                                     x_range=(-pad_left, grid_width - pad_left))
+            image_tiles, tile_locations, occupancies, n_discarded = \
+                generate_tiles(region, tile_size, threshold, occupancy_threshold)
+            yield (level, tile_size, scale, image_tiles, tile_locations + np.array([-pad_left, -pad_top]),
+                   occupancies, n_discarded)
+    finally:
+        image_obj.close()
+
+
+def generate_slide_tiles(loader: LoadROId, sample: Dict[SlideKey, Any], tile_size: int,
+                         occupancy_threshold: float, strip_rows: int = 0,
+                         plan_occupancy_threshold: Optional[float] = None,
+                         pyramid_levels: Sequence[Tuple[int, int]] = ()) \
+        -> Iterator[Tuple[Optional[int], int, float, np.ndarray, np.ndarray, np.ndarray, int]]:
+    """Load a slide and split its foreground into tiles, using the tiling mode chosen by the arguments.
+
+    See `process_slide()` for a description of the arguments. The ROI origin, scale, and foreground
+    threshold are added to `sample`.
+
+    :return: An iterator over tuples containing the magnification level (`None` unless tiling several
+    levels), tile size, and scale, followed by the outputs of `generate_tiles()` for a batch of tiles,
+    with tile coordinates relative to the ROI origin, in pixels at that level.
+    """
+    slide_id = sample[SlideKey.SLIDE_ID]
+    if pyramid_levels:
+        levels_and_tile_sizes = [(loader.level, tile_size), *pyramid_levels]
+        logging.info(f"Tiling slide {slide_id} at levels {[level for level, _ in levels_and_tile_sizes]} ...")
+        yield from generate_pyramid_tiles(loader, sample, levels_and_tile_sizes, occupancy_threshold)
+        return
+
+    tile_batches: Iterable[Tuple[np.ndarray, np.ndarray, np.ndarray, int]]
+    if plan_occupancy_threshold is not None:
+        logging.info(f"Tiling foreground of slide {slide_id} planned from thumbnail ...")
+        tile_batches = generate_planned_tiles(loader, sample, tile_size, occupancy_threshold,
+                                              plan_occupancy_threshold)
+    elif strip_rows > 0:
+        logging.info(f"Tiling slide {slide_id} in strips of {strip_rows} tile rows ...")
+        tile_batches = generate_tiles_by_strips(loader, sample, tile_size, occupancy_threshold, strip_rows)
+    else:
+        sample.update(loader(sample))  # load 'image' from disk
+
+        logging.info(f"Tiling slide {slide_id} ...")
+        tile_batches = [generate_tiles(sample[SlideKey.IMAGE], tile_size, sample[SlideKey.FOREGROUND_THRESHOLD],
+                                       occupancy_threshold)]
+    for tile_batch in tile_batches:
+        # The scale is only added to the sample once the first batch is generated
+        yield (None, tile_size, sample[SlideKey.SCALE], *tile_batch)
+
+
 def get_tile_info(sample: Dict[SlideKey, Any], occupancy: float, tile_location: Sequence[int],
-                  rel_slide_dir: Path) -> Dict[TileKey, Any]:
+                  rel_slide_dir: Path, level: Optional[int] = None, tile_size: Optional[int] = None) \
+        -> Dict[TileKey, Any]:
     """Map slide information and tiling outputs into tile-specific information dictionary.
 
     :param sample: Slide dictionary.
     :param occupancy: Estimated tile foreground occuppancy.
     :param tile_location: Tile XY coordinates.
-    :param rel_slide_dir: Directory where tiles are saved, relative to dataset root.
+    :param rel_slide_dir: Directory (or tile shard) where tiles are saved, relative to dataset root.
+    :param level: Magnification level of the tile, to be included in the tile ID and information when
+    tiling several levels of the same slide.
+    :param tile_size: Lateral dimensions of the tile, to be included in the tile information alongside `level`.
     :return: Tile information dictionary.
     """
     slide_id = sample[SlideKey.SLIDE_ID]
@@ -103,7 +458,7 @@ def get_tile_info(sample: Dict[SlideKey, Any], occupancy: float, tile_location:
 
     tile_info = {
         TileKey.SLIDE_ID: slide_id,
-        TileKey.TILE_ID: get_tile_id(slide_id, tile_location),
+        TileKey.TILE_ID: get_tile_id(slide_id, tile_location, level),
         TileKey.IMAGE: rel_image_path,
         TileKey.LABEL: sample[SlideKey.LABEL],
         TileKey.TILE_X: tile_location[0],
@@ -112,6 +467,9 @@ def get_tile_info(sample: Dict[SlideKey, Any], occupancy: float, tile_location:
         TileKey.SLIDE_METADATA: {TileKey.from_slide_metadata_key(key): value
                                  for key, value in sample[SlideKey.METADATA].items()}
     }
+    if level is not None:
+        tile_info[TileKey.LEVEL] = level
+        tile_info[TileKey.TILE_SIZE] = tile_size
 
     return tile_info
 
@@ -134,7 +492,11 @@ def format_csv_row(tile_info: Dict[TileKey, Any], keys_to_save: Iterable[TileKey
 
 def process_slide(sample: Dict[SlideKey, Any], level: int, margin: int, tile_size: int,
                   foreground_threshold: Optional[float], occupancy_threshold: float, output_dir: Path,
-                  tile_progress: bool = False) -> None:
+                  tile_progress: bool = False, strip_rows: int = 0,
+                  plan_occupancy_threshold: Optional[float] = None,
+                  tile_format: TileFormat = TileFormat.PNG, writer_threads: int = 0,
+                  max_pending_tiles: Optional[int] = None,
+                  pyramid_levels: Sequence[Tuple[int, int]] = ()) -> None:
     """Load and process a slide, saving tile images and information to a CSV file.
 
     :param sample: Slide information dictionary, returned by the input slide dataset.
@@ -147,10 +509,44 @@ def process_slide(sample: Dict[SlideKey, Any], level: int, margin: int, tile_siz
     :param output_dir: Root directory for the output dataset; outputs for a single slide will be
     saved inside `output_dir/slide_id/`.
     :param tile_progress: Whether to display a progress bar in the terminal.
+    :param strip_rows: If > 0, the slide ROI is loaded, tiled, and saved in horizontal strips of
+    `strip_rows` tile rows at a time, so peak memory depends on the strip size rather than the slide
+    size. If 0 (default), the whole ROI is loaded at once. The outputs are the same in both cases.
+    :param plan_occupancy_threshold: If given, tiles whose occupancy estimated from the slide thumbnail
+    is not above this threshold (between 0 and 1) are never read at the target level; only the remaining
+    tiles are loaded, in batched region reads, and filtered with `occupancy_threshold` as usual. A low
+    value (e.g. 0) keeps essentially all tiles that would otherwise be saved. Cannot be combined with
+    `strip_rows`. If `None` (default), the whole ROI is read.
+    :param tile_format: Whether to save each tile as a separate PNG file (`PNG`, default), or to pack
+    all PNG tiles of the slide into a single tar shard, `output_dir/slide_id/tiles.tar` (`TAR`). In the
+    latter case, tile image paths in the CSV point inside the shard (see `utils.tile_shards`).
+    :param writer_threads: Number of background threads encoding and writing tiles, overlapping with
+    the loading and tiling of the next slide region. If 0 (default), tiles are saved in the main thread.
+    The outputs are the same in both cases.
+    :param max_pending_tiles: Maximum number of tiles queued for writing, bounding the memory held by
+    pending tiles. Defaults to `4 * writer_threads` (see `AsyncTileWriter`).
+    :param pyramid_levels: Additional pairs of magnification level and tile size at which to tile the
+    slide in the same pass, sharing the ROI and foreground segmentation of `level` (see
+    `generate_pyramid_tiles()`). If given, tiles of each level are saved in a `level<level>/`
+    subdirectory (or shard subdirectory), and the CSV gets `level` and `tile_size` columns, while tile
+    coordinates of all levels are in the same level 0 reference frame. Cannot be combined with
+    `strip_rows` or `plan_occupancy_threshold`.
     """
+    if strip_rows > 0 and plan_occupancy_threshold is not None:
+        raise ValueError("Streaming (strip_rows > 0) and planned tiling (plan_occupancy_threshold) "
+                         "cannot be combined")
+    levels_and_tile_sizes = [(level, tile_size), *pyramid_levels]
+    if pyramid_levels:
+        if strip_rows > 0 or plan_occupancy_threshold is not None:
+            raise ValueError("Multi-level tiling cannot be combined with streaming or planned tiling")
+        levels = [level for level, _ in levels_and_tile_sizes]
+        if len(set(levels)) != len(levels):
+            raise ValueError(f"Each magnification level can only be tiled once, got {levels}")
     slide_metadata: Dict[str, Any] = sample[SlideKey.METADATA]
-    keys_to_save = (TileKey.SLIDE_ID, TileKey.TILE_ID, TileKey.IMAGE, TileKey.LABEL,
-                    TileKey.TILE_X, TileKey.TILE_Y, TileKey.OCCUPANCY)
+    keys_to_save: Tuple[TileKey, ...] = (TileKey.SLIDE_ID, TileKey.TILE_ID, TileKey.IMAGE, TileKey.LABEL,
+                                         TileKey.TILE_X, TileKey.TILE_Y, TileKey.OCCUPANCY)
+    if pyramid_levels:
+        keys_to_save = (*keys_to_save, TileKey.LEVEL, TileKey.TILE_SIZE)
     metadata_keys = tuple(TileKey.from_slide_metadata_key(key) for key in slide_metadata)
     csv_columns: Tuple[str, ...] = (*keys_to_save, *metadata_keys)
 
@@ -158,15 +554,16 @@ def process_slide(sample: Dict[SlideKey, Any], level: int, margin: int, tile_siz
     rel_slide_dir = Path(slide_id)
     slide_dir = output_dir / rel_slide_dir
     logging.info(f">>> Slide dir {slide_dir}")
-    if slide_dir.exists():  # already processed slide - skip
+    if is_slide_completed(slide_dir):  # already processed slide - skip
         logging.info(f">>> Skipping {slide_dir} - already processed")
         return
     else:
         try:
-            slide_dir.mkdir(parents=True)
+            prepare_slide_dir(slide_dir)  # discards outputs of any interrupted run
 
-            dataset_csv_path = slide_dir / "dataset.csv"
-            dataset_csv_file = dataset_csv_path.open('w')
+            # The CSV is renamed from its temporary path only once the slide is complete
+            dataset_csv_path = slide_dir / DATASET_CSV_FILENAME
+            dataset_csv_file = get_temp_path(dataset_csv_path).open('w')
             dataset_csv_file.write(','.join(csv_columns) + '\n')  # write CSV header
 
             n_failed_tiles = 0
@@ -177,36 +574,81 @@ def process_slide(sample: Dict[SlideKey, Any], level: int, margin: int, tile_siz
             logging.info(f"Loading slide {slide_id} ...")
             loader = LoadROId(WSIReader('cuCIM'), level=level, margin=margin,
                               foreground_threshold=foreground_threshold)
-            sample = loader(sample)  # load 'image' from disk
-
-            logging.info(f"Tiling slide {slide_id} ...")
-            image_tiles, rel_tile_locations, occupancies, _ = \
-                generate_tiles(sample[SlideKey.IMAGE], tile_size,
-                               sample[SlideKey.FOREGROUND_THRESHOLD],
-                               occupancy_threshold)
-
-            tile_locations = (sample[SlideKey.SCALE] * rel_tile_locations
-                              + sample[SlideKey.ORIGIN]).astype(int)  # noqa: W503
-
-            n_tiles = image_tiles.shape[0]
-
-            logging.info(f"Saving tiles for slide {slide_id} ...")
-            for i in tqdm(range(n_tiles), f"Tiles ({slide_id[:6]}…)", unit="img", disable=not tile_progress):
+            level_tile_batches = generate_slide_tiles(loader, sample, tile_size, occupancy_threshold,
+                                                      strip_rows=strip_rows,
+                                                      plan_occupancy_threshold=plan_occupancy_threshold,
+                                                      pyramid_levels=pyramid_levels)
+
+            rel_slide_image_dir = rel_slide_dir
+            shard_writer: Optional[TileShardWriter] = None
+            if tile_format == TileFormat.TAR:
+                rel_slide_image_dir = rel_slide_dir / SHARD_FILENAME
+                shard_writer = TileShardWriter(output_dir / rel_slide_image_dir)
+
+            def save_tile(occupancy: float, tile_location: np.ndarray, image_tile: np.ndarray,
+                          tile_level: Optional[int], level_tile_size: int) \
+                    -> Tuple[Dict[TileKey, Any], Optional[bytes]]:
+                # Runs in a writer thread: encoded shard tiles are written to the shard in the main thread
+                rel_image_dir = rel_slide_image_dir
+                if tile_level is not None:
+                    rel_image_dir = rel_image_dir / f"level{tile_level}"
+                tile_info = get_tile_info(sample, occupancy, tile_location, rel_image_dir,
+                                          level=tile_level, tile_size=level_tile_size)
+                if shard_writer is not None:
+                    return tile_info, encode_image(image_tile)
+                save_image(image_tile, output_dir / tile_info[TileKey.IMAGE])
+                return tile_info, None
+
+            def write_tile_row(tile_key: Tuple[np.ndarray, Optional[int]],
+                               saved_tile: Optional[Tuple[Dict[TileKey, Any], Optional[bytes]]],
+                               error: Optional[BaseException]) -> None:
+                nonlocal n_failed_tiles
                 try:
-                    tile_info = get_tile_info(sample, occupancies[i], tile_locations[i], rel_slide_dir)
-                    save_image(image_tiles[i], output_dir / tile_info[TileKey.IMAGE])
+                    if error is not None:
+                        raise error
+                    tile_info, encoded_image = saved_tile  # type: ignore
+                    if shard_writer is not None:
+                        _, member_name = split_shard_path(tile_info[TileKey.IMAGE])  # type: ignore
+                        shard_writer.write(member_name, encoded_image)  # type: ignore
                     dataset_row = format_csv_row(tile_info, keys_to_save, metadata_keys)
                     dataset_csv_file.write(dataset_row + '\n')
                 except Exception as e:
                     n_failed_tiles += 1
-                    descriptor = get_tile_descriptor(tile_locations[i])
+                    tile_location, tile_level = tile_key
+                    descriptor = get_tile_descriptor(tile_location)
+                    if tile_level is not None:
+                        # Tiles of different levels can have the same location
+                        descriptor = f"level{tile_level}.{descriptor}"
                     failed_tiles_file.write(descriptor + '\n')
                     traceback.print_exc()
                     warnings.warn(f"An error occurred while saving tile "
-                                  f"{get_tile_id(slide_id, tile_locations[i])}: {e}")
+                                  f"{get_tile_id(slide_id, tile_location, tile_level)}: {e}")
 
+            logging.info(f"Saving tiles for slide {slide_id} ...")
+            with AsyncTileWriter(num_threads=writer_threads, max_pending=max_pending_tiles) as tile_writer:
+                for tile_level, level_tile_size, scale, image_tiles, rel_tile_locations, occupancies, _ \
+                        in level_tile_batches:
+                    tile_locations = (scale * rel_tile_locations + sample[SlideKey.ORIGIN]).astype(int)
+
+                    n_tiles = image_tiles.shape[0]
+
+                    for i in tqdm(range(n_tiles), f"Tiles ({slide_id[:6]}…)", unit="img",
+                                  disable=not tile_progress):
+                        job = functools.partial(save_tile, occupancies[i], tile_locations[i], image_tiles[i],
+                                                tile_level, level_tile_size)
+                        for completed in tile_writer.submit(job, context=(tile_locations[i], tile_level)):
+                            write_tile_row(*completed)
+                for completed in tile_writer.drain():
+                    write_tile_row(*completed)
+                logging.info(f"Saved {tile_writer.n_completed} tiles for slide {slide_id} "
+                             f"({tile_writer.throughput:.1f} tiles/s)")
+
+            if shard_writer is not None:
+                shard_writer.close()
             dataset_csv_file.close()
             failed_tiles_file.close()
+            commit_file(get_temp_path(dataset_csv_path), dataset_csv_path)
+            record_completed_slide(output_dir, slide_id)
             if n_failed_tiles > 0:
                 # TODO what we want to do with slides that have some failed tiles?
                 logging.warning(f"{slide_id} is incomplete. {n_failed_tiles} tiles failed.")
@@ -216,30 +658,15 @@ def process_slide(sample: Dict[SlideKey, Any], level: int, margin: int, tile_siz
             warnings.warn(f"An error occurred while processing slide {slide_id}: {e}")
 
 
-def merge_dataset_csv_files(dataset_dir: Path) -> Path:
-    """Combines all "*/dataset.csv" files into a single "dataset.csv" file in the given directory."""
-    full_csv = dataset_dir / "dataset.csv"
-    # TODO change how we retrieve these filenames, probably because mounted, the operation is slow
-    #  and it seems to find many more files
-    # print("List of files")
-    # print([str(file) + '\n' for file in dataset_dir.glob("*/dataset.csv")])
-    with full_csv.open('w') as full_csv_file:
-        # full_csv_file.write(','.join(CSV_COLUMNS) + '\n')  # write CSV header
-        first_file = True
-        for slide_csv in tqdm(dataset_dir.glob("*/dataset.csv"), desc="Merging dataset.csv", unit='file'):
-            logging.info(f"Merging slide {slide_csv}")
-            content = slide_csv.read_text()
-            if not first_file:
-                content = content[content.index('\n') + 1:]  # discard header row for all but the first file
-            full_csv_file.write(content)
-            first_file = False
-    return full_csv
-
-
 def main(slides_dataset: SlidesDataset, root_output_dir: Union[str, Path],
          level: int, tile_size: int, margin: int, foreground_threshold: Optional[float],
          occupancy_threshold: float, parallel: bool = False, overwrite: bool = False,
-         n_slides: Optional[int] = None) -> None:
+         n_slides: Optional[int] = None, strip_rows: int = 0,
+         plan_occupancy_threshold: Optional[float] = None,
+         tile_format: TileFormat = TileFormat.PNG, writer_threads: int = 0,
+         max_workers: Optional[int] = None, memory_budget: Optional[int] = None,
+         pyramid_levels: Sequence[Tuple[int, int]] = (), merge_csv: bool = True,
+         parquet_index: bool = False) -> None:
     """Process a slides dataset to produce a tiles dataset.
 
     :param slides_dataset: Input tiles dataset object.
@@ -250,10 +677,29 @@ def main(slides_dataset: SlidesDataset, root_output_dir: Union[str, Path],
     :param foreground_threshold: Luminance threshold (0 to 255) to determine tile occupancy.
     If `None` (default), an optimal threshold will be estimated automatically.
     :param occupancy_threshold: Threshold (between 0 and 1) to determine empty tiles to discard.
-    :param parallel: Whether slides should be processed in parallel with multiprocessing.
+    :param parallel: Whether slides should be processed in parallel with multiprocessing. Slides are
+    scheduled largest first, as long as their estimated memory fits in `memory_budget` (see
+    `slide_scheduler.run_slides()`), and per-slide timings are saved to `slide_timings.csv`.
     :param overwrite: Whether to overwrite an existing output tiles dataset. If `True`, will delete
-    and recreate `root_output_dir`, otherwise will resume by skipping already processed slides.
+    and recreate `root_output_dir`, otherwise will resume by skipping completely processed slides and
+    reprocessing any partially processed ones (see `slide_journal`).
     :param n_slides: If given, limit the total number of slides for debugging.
+    :param strip_rows: If > 0, each slide is loaded and tiled in horizontal strips of `strip_rows`
+    tile rows, bounding peak memory per worker by the strip size instead of the slide size.
+    :param plan_occupancy_threshold: If given, only tiles whose occupancy estimated from the slide
+    thumbnail is above this threshold are read at the target level (see `process_slide()`).
+    :param tile_format: Whether to save tiles as individual PNG files (default) or as one tar shard per
+    slide (see `process_slide()`).
+    :param writer_threads: Number of background tile writer threads per slide (see `process_slide()`).
+    :param max_workers: Maximum number of parallel worker processes. Defaults to the number of CPUs.
+    :param memory_budget: Total memory in bytes available to slides processed in parallel. Defaults to
+    80% of the available memory.
+    :param pyramid_levels: Additional pairs of magnification level and tile size at which to tile each
+    slide in the same pass (see `process_slide()`).
+    :param merge_csv: Whether to merge the CSV files of all completed slides into a single `dataset.csv`
+    at the dataset root (default: `True`). All completed slides of the dataset are merged, in dataset order.
+    :param parquet_index: Whether to also save all tiles in a typed Parquet tile index, `dataset.parquet`,
+    which loads much faster than the merged CSV for large datasets (default: `False`).
     """
 
     # Ignoring some types here because mypy is getting confused with the MONAI Dataset class
@@ -271,23 +717,34 @@ def main(slides_dataset: SlidesDataset, root_output_dir: Union[str, Path],
     func = functools.partial(process_slide, level=level, margin=margin, tile_size=tile_size,
                              foreground_threshold=foreground_threshold,
                              occupancy_threshold=occupancy_threshold, output_dir=output_dir,
-                             tile_progress=not parallel)
-
-    if parallel:
-        import multiprocessing
-
-        pool = multiprocessing.Pool()
-        map_func = pool.imap_unordered  # type: ignore
-    else:
-        map_func = map  # type: ignore
-
-    list(tqdm(map_func(func, dataset), desc="Slides", unit="img", total=len(dataset)))  # type: ignore
-
-    if parallel:
-        pool.close()
-
-    logging.info("Merging slide files in a single file")
-    merge_dataset_csv_files(output_dir)
+                             tile_progress=not parallel, strip_rows=strip_rows,
+                             plan_occupancy_threshold=plan_occupancy_threshold,
+                             tile_format=tile_format, writer_threads=writer_threads,
+                             pyramid_levels=pyramid_levels)
+
+    samples = [dataset[i] for i in range(len(dataset))]
+    slide_ids = [sample[SlideKey.SLIDE_ID] for sample in samples]
+    # Slides completed by workers killed before journaling them are skipped below, so journal them now
+    reconcile_journal(output_dir, slide_ids)
+    samples = [sample for sample in samples if not is_slide_completed(output_dir / sample[SlideKey.SLIDE_ID])]
+    logging.info(f"{len(dataset) - len(samples)} slides already processed, {len(samples)} remaining")
+    max_rows = strip_rows * tile_size if strip_rows > 0 else None
+    levels = [level, *(pyramid_level for pyramid_level, _ in pyramid_levels)]
+    memory_estimates = [sum(estimate_slide_memory([sample[SlideKey.IMAGE]], slide_level, max_rows=max_rows)
+                            for slide_level in levels)
+                        for sample in samples]
+    timings = run_slides(func, samples, slide_ids=[sample[SlideKey.SLIDE_ID] for sample in samples],
+                         memory_estimates=memory_estimates, parallel=parallel, max_workers=max_workers,
+                         memory_budget=memory_budget)
+    save_slide_timings(timings, output_dir)
+
+    completed_slide_ids = [slide_id for slide_id in slide_ids if is_slide_completed(output_dir / slide_id)]
+    if merge_csv:
+        logging.info("Merging slide files in a single file")
+        merge_dataset_csv_files(output_dir, completed_slide_ids)
+    if parquet_index:
+        logging.info("Saving slide files in a single Parquet tile index")
+        save_tile_index(output_dir, completed_slide_ids)
 
 
 if __name__ == '__main__':
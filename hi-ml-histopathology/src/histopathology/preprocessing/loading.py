@@ -82,26 +82,50 @@ class LoadROId(MapTransform):
         self.margin = margin
         self.foreground_threshold = foreground_threshold
 
-    def _get_bounding_box(self, slide_obj: CuImage) -> Tuple[box_utils.Box, float]:
-        # Estimate bounding box at the lowest resolution (i.e. highest level)
+    def get_thumbnail_foreground(self, slide_obj: CuImage) -> Tuple[np.ndarray, float, float]:
+        """Segment the foreground of the slide at the lowest resolution (i.e. highest level).
+
+        :param slide_obj: The cuCIM image object returned by `reader.read(<image_file>)`.
+        :return: A tuple containing the boolean foreground mask in (H, W) format, the scale of the
+        lowest-resolution level, and the threshold used.
+        """
         highest_level = slide_obj.resolutions['level_count'] - 1
         scale = slide_obj.resolutions['level_downsamples'][highest_level]
         slide = load_slide_at_level(self.reader, slide_obj, level=highest_level)
 
         foreground_mask, threshold = segment_foreground(slide, self.foreground_threshold)
-        bbox = scale * box_utils.get_bounding_box(foreground_mask).add_margin(self.margin)
-        return bbox, threshold
+        return foreground_mask, scale, threshold
 
-    def __call__(self, data: Dict) -> Dict:
-        image_obj: CuImage = self.reader.read(data[self.image_key])
+    def _get_bounding_box(self, foreground_mask: np.ndarray, thumbnail_scale: float) -> box_utils.Box:
+        # Estimate bounding box at the lowest resolution (i.e. highest level)
+        return thumbnail_scale * box_utils.get_bounding_box(foreground_mask).add_margin(self.margin)
 
-        level0_bbox, threshold = self._get_bounding_box(image_obj)
+    def get_roi(self, image_obj: CuImage,
+                thumbnail_foreground: Optional[Tuple[np.ndarray, float, float]] = None) \
+            -> Tuple[Tuple[int, int], float, box_utils.Box, float]:
+        """Estimate the region of interest to load, without reading it at the target level.
+
+        :param image_obj: The cuCIM image object returned by `reader.read(<image_file>)`.
+        :param thumbnail_foreground: The output of `get_thumbnail_foreground()`, if already computed.
+        :return: A tuple containing the ROI origin in the level 0 reference frame, the scale of the
+        target level, the ROI bounding box scaled to the target level, and the foreground threshold.
+        """
+        if thumbnail_foreground is None:
+            thumbnail_foreground = self.get_thumbnail_foreground(image_obj)
+        foreground_mask, thumbnail_scale, threshold = thumbnail_foreground
+        level0_bbox = self._get_bounding_box(foreground_mask, thumbnail_scale)
 
         # cuCIM/OpenSlide takes absolute location coordinates in the level 0 reference frame,
         # but relative region size in pixels at the chosen level
         origin = (level0_bbox.x, level0_bbox.y)
         scale = image_obj.resolutions['level_downsamples'][self.level]
         scaled_bbox = level0_bbox / scale
+        return origin, scale, scaled_bbox, threshold
+
+    def __call__(self, data: Dict) -> Dict:
+        image_obj: CuImage = self.reader.read(data[self.image_key])
+
+        origin, scale, scaled_bbox, threshold = self.get_roi(image_obj)
 
         data[self.image_key], _ = self.reader.get_data(image_obj, location=origin, level=self.level,
                                                        size=(scaled_bbox.w, scaled_bbox.h))
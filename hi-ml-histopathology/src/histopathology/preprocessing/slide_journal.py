@@ -0,0 +1,154 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+"""Crash-safe bookkeeping of processed slides, allowing interrupted tiling runs to be resumed.
+
+Each slide's dataset CSV is first written to a temporary file, which is atomically renamed to
+`dataset.csv` once all its tiles have been saved. The final CSV therefore only exists for fully
+processed slides: a resumed run skips those and redoes any partially processed ones. Completed slides
+are also appended to a journal file at the dataset root, in completion order. This journal doubles as
+the manifest of per-slide CSV files to merge when no slide IDs are given, so merging requires no scan of
+the output directory, which is slow on mounted storage.
+"""
+
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import List, Optional, Sequence
+
+import pandas as pd
+from tqdm import tqdm
+
+DATASET_CSV_FILENAME = "dataset.csv"
+TMP_SUFFIX = ".tmp"
+JOURNAL_FILENAME = "completed_slides.txt"
+TILE_INDEX_FILENAME = "dataset.parquet"
+
+
+def get_temp_path(path: Path) -> Path:
+    """Get the path of the temporary file to be renamed to `path` on completion."""
+    return path.with_name(path.name + TMP_SUFFIX)
+
+
+def is_slide_completed(slide_dir: Path) -> bool:
+    """Check whether the slide whose outputs are saved in `slide_dir` was completely processed."""
+    return (slide_dir / DATASET_CSV_FILENAME).is_file()
+
+
+def prepare_slide_dir(slide_dir: Path) -> bool:
+    """Prepare the output directory of a slide, discarding outputs of any previous partial run.
+
+    :param slide_dir: Directory where all the outputs of the slide are saved.
+    :return: `False` if the slide was already completely processed and should be skipped, `True` if
+    it should be processed, in which case `slide_dir` was (re-)created empty.
+    """
+    if is_slide_completed(slide_dir):
+        return False
+    if slide_dir.exists():
+        logging.info(f">>> Discarding partial outputs in {slide_dir}")
+        shutil.rmtree(slide_dir)
+    slide_dir.mkdir(parents=True)
+    return True
+
+
+def commit_file(temp_path: Path, path: Path) -> None:
+    """Flush a closed temporary file to disk and atomically rename it to its final path."""
+    with temp_path.open('rb') as temp_file:
+        os.fsync(temp_file.fileno())
+    os.replace(temp_path, path)
+
+
+def record_completed_slide(journal_dir: Path, slide_id: str) -> None:
+    """Append a slide ID to the journal of completed slides.
+
+    A single short append is atomic, so this is safe to call from concurrent worker processes.
+    """
+    with (journal_dir / JOURNAL_FILENAME).open('a') as journal_file:
+        journal_file.write(slide_id + '\n')
+
+
+def read_completed_slides(journal_dir: Path) -> List[str]:
+    """Read the IDs of completed slides from the journal, in completion order and without duplicates."""
+    journal_path = journal_dir / JOURNAL_FILENAME
+    if not journal_path.is_file():
+        return []
+    slide_ids = journal_path.read_text().splitlines()
+    return list(dict.fromkeys(slide_id for slide_id in slide_ids if slide_id))
+
+
+def reconcile_journal(dataset_dir: Path, slide_ids: Sequence[str]) -> None:
+    """Record in the journal the given slides that were completely processed but are missing from it.
+
+    This happens if a worker is killed between committing a slide's CSV and recording the slide, or if the
+    dataset was partly created before the journal existed. Call this before resuming, so that slides skipped
+    as completed are always journaled.
+
+    :param dataset_dir: Root directory of the tiles dataset, containing the journal.
+    :param slide_ids: IDs of the slides of the dataset.
+    """
+    journaled_slide_ids = set(read_completed_slides(dataset_dir))
+    for slide_id in slide_ids:
+        if slide_id not in journaled_slide_ids and is_slide_completed(dataset_dir / slide_id):
+            logging.info(f"Recording completed slide {slide_id} missing from the journal")
+            record_completed_slide(dataset_dir, slide_id)
+
+
+def get_slide_csv_paths(dataset_dir: Path, slide_ids: Optional[Sequence[str]] = None) -> List[Path]:
+    """Get the paths of the per-slide dataset CSV files to merge.
+
+    :param dataset_dir: Root directory of the tiles dataset.
+    :param slide_ids: IDs of the slides to merge. By default (`None`), the completed slides are read from
+    the journal. Datasets created without a journal fall back to scanning for `*/dataset.csv` files.
+    :return: The paths of the slide CSV files.
+    """
+    if slide_ids is None:
+        slide_ids = read_completed_slides(dataset_dir)
+        if not slide_ids:
+            logging.warning(f"No journal of completed slides in {dataset_dir}, scanning for slide CSV files")
+            return sorted(dataset_dir.glob(f"*/{DATASET_CSV_FILENAME}"))
+    return [dataset_dir / slide_id / DATASET_CSV_FILENAME for slide_id in slide_ids]
+
+
+def merge_dataset_csv_files(dataset_dir: Path, slide_ids: Optional[Sequence[str]] = None) -> Path:
+    """Combines the per-slide "dataset.csv" files into a single "dataset.csv" file in the given directory.
+
+    :param dataset_dir: Root directory of the tiles dataset.
+    :param slide_ids: IDs of the slides to merge. By default (`None`), all completed slides in the journal.
+    :return: The path of the merged CSV file.
+    """
+    full_csv = dataset_dir / DATASET_CSV_FILENAME
+    temp_csv = get_temp_path(full_csv)
+    with temp_csv.open('w') as full_csv_file:
+        first_file = True
+        for slide_csv in tqdm(get_slide_csv_paths(dataset_dir, slide_ids), desc="Merging dataset.csv", unit='file'):
+            with slide_csv.open() as slide_csv_file:
+                header = slide_csv_file.readline()
+                if first_file:
+                    full_csv_file.write(header)
+                shutil.copyfileobj(slide_csv_file, full_csv_file)
+            first_file = False
+    commit_file(temp_csv, full_csv)
+    return full_csv
+
+
+def save_tile_index(dataset_dir: Path, slide_ids: Optional[Sequence[str]] = None) -> Path:
+    """Saves all tiles of the per-slide "dataset.csv" files into a single typed Parquet tile index.
+
+    Loading the Parquet index skips CSV parsing and type inference, so a `TilesDataset` with millions of
+    tiles starts much faster than from the merged CSV. Requires `pyarrow` (or `fastparquet`).
+
+    :param dataset_dir: Root directory of the tiles dataset.
+    :param slide_ids: IDs of the slides to include. By default (`None`), all completed slides in the journal.
+    :return: The path of the Parquet tile index.
+    """
+    slide_dfs = [pd.read_csv(slide_csv) for slide_csv in
+                 tqdm(get_slide_csv_paths(dataset_dir, slide_ids), desc="Indexing dataset.csv", unit='file')]
+    dataset_df = pd.concat(slide_dfs, ignore_index=True) if slide_dfs else pd.DataFrame()
+    index_path = dataset_dir / TILE_INDEX_FILENAME
+    temp_path = get_temp_path(index_path)
+    dataset_df.to_parquet(temp_path, index=False)
+    commit_file(temp_path, index_path)
+    return index_path
@@ -0,0 +1,154 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+import logging
+import os
+import time
+import warnings
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import psutil
+from tqdm import tqdm
+
+# Rough multiplier accounting for copies made while tiling and filtering a loaded RGB region
+DEFAULT_MEMORY_OVERHEAD = 3.
+DEFAULT_BUDGET_FRACTION = 0.8
+SLIDE_TIMINGS_FILENAME = "slide_timings.csv"
+
+
+@dataclass(frozen=True)
+class SlideTiming:
+    slide_id: str
+    memory_estimate: int
+    seconds: float
+
+
+def get_level_dimensions(image_path: Union[str, Path], level: int) -> Optional[Sequence[int]]:
+    """Read the (width, height) dimensions of a slide at the given level from the file headers only.
+
+    :return: The level dimensions, or `None` if the file could not be read.
+    """
+    from cucim import CuImage
+
+    try:
+        slide_obj = CuImage(str(image_path))
+        try:
+            return slide_obj.resolutions['level_dimensions'][level]
+        finally:
+            slide_obj.close()
+    except Exception as e:
+        warnings.warn(f"Could not read dimensions of {image_path}: {e}")
+        return None
+
+
+def estimate_slide_memory(image_paths: Sequence[Union[str, Path]], level: int, max_rows: Optional[int] = None,
+                          overhead: float = DEFAULT_MEMORY_OVERHEAD) -> int:
+    """Estimate the peak memory needed to process a slide, from its level dimensions.
+
+    :param image_paths: Paths of all images loaded at once for the slide (e.g. the slide and its mask).
+    :param level: Magnification level at which the slide is loaded.
+    :param max_rows: If given, upper bound on the number of rows loaded at once (e.g. when tiling in strips).
+    :param overhead: Multiplier applied to the size of the loaded RGB arrays.
+    :return: The estimated memory in bytes, or 0 if the dimensions could not be read.
+    """
+    total_bytes = 0
+    for image_path in image_paths:
+        dimensions = get_level_dimensions(image_path, level)
+        if dimensions is None:
+            continue
+        width, height = dimensions
+        if max_rows is not None:
+            height = min(height, max_rows)
+        total_bytes += width * height * 3  # RGB uint8
+    return int(total_bytes * overhead)
+
+
+def _timed_call(func: Callable[[Any], Any], sample: Any) -> float:
+    start_time = time.time()
+    func(sample)
+    return time.time() - start_time
+
+
+def run_slides(func: Callable[[Any], Any], samples: Sequence[Any], slide_ids: Sequence[str],
+               memory_estimates: Sequence[int], parallel: bool = False, max_workers: Optional[int] = None,
+               memory_budget: Optional[int] = None) -> List[SlideTiming]:
+    """Process slides, largest first, running in parallel only as many as fit in a memory budget.
+
+    Slides are dispatched in decreasing order of estimated memory to reduce tail latency. A slide is
+    only admitted when its estimate fits in the remaining budget, in which case the largest such slide is
+    picked; a slide larger than the whole budget is run alone.
+
+    :param func: Function processing a single slide, e.g. a partial application of `process_slide()`.
+    It must be picklable if `parallel=True`.
+    :param samples: Slide samples to pass to `func`.
+    :param slide_ids: Slide IDs, used for reporting timings.
+    :param memory_estimates: Estimated peak memory in bytes of processing each slide
+    (see `estimate_slide_memory()`).
+    :param parallel: Whether to process slides in parallel worker processes.
+    :param max_workers: Maximum number of worker processes. Defaults to the number of CPUs.
+    :param memory_budget: Total memory in bytes that concurrently processed slides may use. Defaults to
+    80% of the memory available when the function is called.
+    :return: The processing time of each slide, in completion order.
+    """
+    order = list(np.argsort(-np.asarray(memory_estimates), kind='stable'))
+    timings: List[SlideTiming] = []
+
+    def record(index: int, seconds: float) -> None:
+        timings.append(SlideTiming(slide_ids[index], int(memory_estimates[index]), seconds))
+
+    if not parallel:
+        for index in tqdm(order, desc="Slides", unit="img"):
+            record(index, _timed_call(func, samples[index]))
+        return timings
+
+    max_workers = max_workers or os.cpu_count() or 1
+    if memory_budget is None:
+        memory_budget = int(DEFAULT_BUDGET_FRACTION * psutil.virtual_memory().available)
+    logging.info(f"Scheduling {len(order)} slides on up to {max_workers} workers "
+                 f"with a memory budget of {memory_budget / 2**30:.1f} GiB")
+
+    running: Dict[Future, int] = {}
+    used_memory = 0
+    with ProcessPoolExecutor(max_workers) as executor, tqdm(total=len(order), desc="Slides", unit="img") as progress:
+        while order or running:
+            while order and len(running) < max_workers:
+                available_memory = memory_budget - used_memory
+                fitting = [position for position, index in enumerate(order)
+                           if memory_estimates[index] <= available_memory]
+                if not fitting and running:
+                    break  # wait for running slides to free some memory
+                index = order.pop(fitting[0] if fitting else 0)
+                running[executor.submit(_timed_call, func, samples[index])] = index
+                used_memory += memory_estimates[index]
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                used_memory -= memory_estimates[index]
+                try:
+                    record(index, future.result())
+                except Exception as e:
+                    warnings.warn(f"An error occurred while processing slide {slide_ids[index]}: {e}")
+                progress.update()
+    return timings
+
+
+def save_slide_timings(timings: Sequence[SlideTiming], output_dir: Path) -> Path:
+    """Save per-slide timings and memory estimates to a CSV file, e.g. to tune the memory budget."""
+    timings_path = output_dir / SLIDE_TIMINGS_FILENAME
+    with timings_path.open('w') as timings_file:
+        timings_file.write("slide_id,memory_estimate,seconds\n")
+        for timing in timings:
+            timings_file.write(f"{timing.slide_id},{timing.memory_estimate},{timing.seconds:.3f}\n")
+    if timings:
+        total_seconds = sum(timing.seconds for timing in timings)
+        slowest = max(timings, key=lambda timing: timing.seconds)
+        logging.info(f"Processed {len(timings)} slides in {total_seconds:.1f} worker-seconds; "
+                     f"slowest: {slowest.slide_id} ({slowest.seconds:.1f}s)")
+    return timings_path
@@ -0,0 +1,107 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Generic, List, Optional, Tuple, TypeVar
+
+T = TypeVar('T')
+C = TypeVar('C')
+
+# (context, result, error) for each completed save job, where either result or error is None
+TileWriteResult = Tuple[C, Optional[T], Optional[BaseException]]
+
+
+class AsyncTileWriter(Generic[C, T]):
+    """Runs tile saving jobs (e.g. PNG encoding and writing) in a bounded pool of writer threads.
+
+    PIL releases the GIL while compressing and writing images, so saving tiles in background threads
+    overlaps with reading and tiling the next slide region in the main thread. Completed jobs are
+    returned in submission order, so the caller can write CSV rows in the same order as with serial
+    saving, and the number of pending jobs (hence of tile arrays kept alive) is bounded.
+
+    Typical usage:
+
+    ```
+    with AsyncTileWriter(num_threads=4) as writer:
+        for tile in tiles:
+            for context, result, error in writer.submit(functools.partial(save, tile), context=tile_id):
+                ...  # handle completed jobs
+        for context, result, error in writer.drain():
+            ...  # handle remaining jobs
+    ```
+    """
+
+    def __init__(self, num_threads: int = 0, max_pending: Optional[int] = None) -> None:
+        """
+        :param num_threads: Number of writer threads. If 0 (default), jobs are run synchronously in the
+        calling thread when submitted.
+        :param max_pending: Maximum number of submitted jobs whose results have not been returned yet.
+        When reached, `submit()` blocks until the oldest job completes. Defaults to `4 * num_threads`.
+        """
+        if num_threads < 0:
+            raise ValueError(f"Number of writer threads must be non-negative, got {num_threads}")
+        self.num_threads = num_threads
+        self.max_pending = max_pending or 4 * max(num_threads, 1)
+        self._executor = ThreadPoolExecutor(num_threads) if num_threads > 0 else None
+        self._pending: Deque[Tuple[C, Future]] = deque()
+        self.n_completed = 0
+        self._start_time = time.time()
+
+    @staticmethod
+    def _run(job: Callable[[], T]) -> Tuple[Optional[T], Optional[BaseException]]:
+        try:
+            return job(), None
+        except Exception as e:
+            return None, e
+
+    def _pop_completed(self, block: bool) -> List[TileWriteResult]:
+        completed: List[TileWriteResult] = []
+        while self._pending and (block or self._pending[0][1].done()):
+            context, future = self._pending.popleft()
+            completed.append((context, *future.result()))
+            block = block and len(self._pending) >= self.max_pending
+        self.n_completed += len(completed)
+        return completed
+
+    def submit(self, job: Callable[[], T], context: C) -> List[TileWriteResult]:
+        """Submit a saving job, and collect the jobs completed so far in submission order.
+
+        :param job: Function to run in a writer thread. Exceptions it raises are caught and returned.
+        :param context: Any information to return alongside the job result, e.g. the tile location.
+        :return: A list of `(context, result, error)` tuples for the completed jobs, where `error` is the
+        exception raised by the job (and `result` is `None`), or `None` if it succeeded.
+        """
+        if self._executor is None:
+            self.n_completed += 1
+            return [(context, *self._run(job))]
+        completed = self._pop_completed(block=len(self._pending) >= self.max_pending)
+        self._pending.append((context, self._executor.submit(self._run, job)))
+        return completed + self._pop_completed(block=False)
+
+    def drain(self) -> List[TileWriteResult]:
+        """Wait for all pending jobs to complete and return them in submission order."""
+        completed: List[TileWriteResult] = []
+        while self._pending:
+            context, future = self._pending.popleft()
+            completed.append((context, *future.result()))
+        self.n_completed += len(completed)
+        return completed
+
+    @property
+    def throughput(self) -> float:
+        """Number of completed jobs per second since the writer was created."""
+        return self.n_completed / max(time.time() - self._start_time, 1e-6)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self) -> "AsyncTileWriter":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
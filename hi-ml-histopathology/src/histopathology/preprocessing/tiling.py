@@ -10,19 +10,30 @@ from typing import Any, Optional, Tuple
 import numpy as np
 
 
-def get_1d_padding(length: int, tile_size: int) -> Tuple[int, int]:
-    """Computes symmetric padding for `length` to be divisible by `tile_size`."""
-    pad = (tile_size - length % tile_size) % tile_size
+def get_1d_padding(length: int, tile_size: int, stride: Optional[int] = None) -> Tuple[int, int]:
+    """Computes symmetric padding for `length` to be exactly covered by tiles of size `tile_size`.
+
+    :param length: Length of the array to pad.
+    :param tile_size: Length of each tile.
+    :param stride: Distance between the starts of consecutive tiles. If `None` (default), equal to
+    `tile_size`, i.e. `length` is padded to be divisible by `tile_size`.
+    """
+    stride = stride or tile_size
+    n_tiles = -(-max(length - tile_size, 0) // stride) + 1  # ceiling division
+    pad = (n_tiles - 1) * stride + tile_size - length
     return (pad // 2, pad - pad // 2)
 
 
 def pad_for_tiling_2d(array: np.ndarray, tile_size: int, channels_first: Optional[bool] = True,
-                      **pad_kwargs: Any) -> Tuple[np.ndarray, np.ndarray]:
+                      stride: Optional[int] = None, **pad_kwargs: Any) -> Tuple[np.ndarray, np.ndarray]:
     """Symmetrically pads a 2D `array` such that both dimensions are divisible by `tile_size`.
 
     :param array: 2D image array.
     :param tile_size: Width/height of each tile in pixels.
     :param channels_first: Whether `array` is in CHW (`True`, default) or HWC (`False`) layout.
+    :param stride: Distance in pixels between the starts of consecutive tiles, if overlapping or spaced
+    tiles are desired. In this case, both dimensions will instead be padded to be exactly covered by
+    tiles every `stride` pixels. If `None` (default), equal to `tile_size`.
     :param pad_kwargs: Keyword arguments to be passed to `np.pad()` (e.g. `constant_values=0`).
     :return: A tuple containing:
         - `padded_array`: Resulting array, in the same CHW/HWC layout as the input.
@@ -30,8 +41,8 @@ def pad_for_tiling_2d(array: np.ndarray, tile_size: int, channels_first: Optiona
         original array to obtain indices for the padded array.
     """
     height, width = array.shape[1:] if channels_first else array.shape[:-1]
-    padding_h = get_1d_padding(height, tile_size)
-    padding_w = get_1d_padding(width, tile_size)
+    padding_h = get_1d_padding(height, tile_size, stride)
+    padding_w = get_1d_padding(width, tile_size, stride)
     padding = [padding_h, padding_w]
     channels_axis = 0 if channels_first else 2
     padding.insert(channels_axis, (0, 0))  # zero padding on channels axis
@@ -40,64 +51,107 @@ def pad_for_tiling_2d(array: np.ndarray, tile_size: int, channels_first: Optiona
     return padded_array, np.array(offset)
 
 
-def tile_array_2d(array: np.ndarray, tile_size: int, channels_first: Optional[bool] = True,
-                  **pad_kwargs: Any) -> Tuple[np.ndarray, np.ndarray]:
-    """Split an image array into square non-overlapping tiles.
+def get_tile_views_2d(array: np.ndarray, tile_size: int, channels_first: Optional[bool] = True,
+                      stride: Optional[int] = None, **pad_kwargs: Any) -> Tuple[np.ndarray, np.ndarray]:
+    """Split an image array into a grid of square tiles, without copying the tiles' contents.
 
-    The array will be padded symmetrically if its dimensions are not exact multiples of `tile_size`.
+    The array will be padded symmetrically as in `pad_for_tiling_2d()`, and the returned tiles are
+    read-only views into the padded array. Indexing the grid (e.g. with the row and column indices of
+    selected tiles) therefore only copies the indexed tiles.
 
     :param array: Image array.
     :param tile_size: Width/height of each tile in pixels.
-    :param pad_kwargs: Keyword arguments to be passed to `np.pad()` (e.g. `constant_values=0`).
     :param channels_first: Whether `array` is in CHW (`True`, default) or HWC (`False`) layout.
+    :param stride: Distance in pixels between the starts of consecutive tiles. If smaller than
+    `tile_size`, tiles will overlap. If `None` (default), equal to `tile_size` (non-overlapping tiles).
+    :param pad_kwargs: Keyword arguments to be passed to `np.pad()` (e.g. `constant_values=0`).
     :return: A tuple containing:
-        - `tiles`: A batch of tiles in NCHW layout.
-        - `coords`: XY coordinates of each tile, in the same order.
+        - `tiles`: A grid of tiles in (n_tiles_h, n_tiles_w, C, H, W) layout, or
+        (n_tiles_h, n_tiles_w, H, W, C) if `channels_first` is `False`.
+        - `coords`: XY coordinates of each tile, in (n_tiles_h, n_tiles_w, 2) layout.
     """
-    padded_array, (offset_w, offset_h) = pad_for_tiling_2d(array, tile_size, channels_first, **pad_kwargs)
+    stride = stride or tile_size
+    padded_array, (offset_w, offset_h) = pad_for_tiling_2d(array, tile_size, channels_first, stride,
+                                                           **pad_kwargs)
     if channels_first:
         channels, height, width = padded_array.shape
+        stride_c, stride_h, stride_w = padded_array.strides
     else:
         height, width, channels = padded_array.shape
-    n_tiles_h = height // tile_size
-    n_tiles_w = width // tile_size
+        stride_h, stride_w, stride_c = padded_array.strides
+    n_tiles_h = (height - tile_size) // stride + 1
+    n_tiles_w = (width - tile_size) // stride + 1
 
+    grid_shape = (n_tiles_h, n_tiles_w)
+    grid_strides = (stride * stride_h, stride * stride_w)
     if channels_first:
-        intermediate_shape = (channels, n_tiles_h, tile_size, n_tiles_w, tile_size)
-        axis_order = (1, 3, 0, 2, 4)  # (n_tiles_h, n_tiles_w, channels, tile_size, tile_size)
-        output_shape = (n_tiles_h * n_tiles_w, channels, tile_size, tile_size)
+        tile_shape = (channels, tile_size, tile_size)
+        tile_strides = (stride_c, stride_h, stride_w)
     else:
-        intermediate_shape = (n_tiles_h, tile_size, n_tiles_w, tile_size, channels)
-        axis_order = (0, 2, 1, 3, 4)  # (n_tiles_h, n_tiles_w, tile_size, tile_size, channels)
-        output_shape = (n_tiles_h * n_tiles_w, tile_size, tile_size, channels)
-
-    tiles = padded_array.reshape(intermediate_shape)  # Split width and height axes
-    tiles = tiles.transpose(axis_order)
-    tiles = tiles.reshape(output_shape)  # Flatten tile batch dimension
+        tile_shape = (tile_size, tile_size, channels)
+        tile_strides = (stride_h, stride_w, stride_c)
+    # Compatible with NumPy versions predating `sliding_window_view()`
+    tiles = np.lib.stride_tricks.as_strided(padded_array, shape=(*grid_shape, *tile_shape),
+                                            strides=(*grid_strides, *tile_strides), writeable=False)
 
     # Compute top-left coordinates of every tile, relative to the original array's origin
-    coords_h = tile_size * np.arange(n_tiles_h) - offset_h
-    coords_w = tile_size * np.arange(n_tiles_w) - offset_w
-    # Shape: (n_tiles_h * n_tiles_w, 2)
-    coords = np.stack(np.meshgrid(coords_w, coords_h), axis=-1).reshape(-1, 2)
+    coords_h = stride * np.arange(n_tiles_h) - offset_h
+    coords_w = stride * np.arange(n_tiles_w) - offset_w
+    # Shape: (n_tiles_h, n_tiles_w, 2)
+    coords = np.stack(np.meshgrid(coords_w, coords_h), axis=-1)
 
     return tiles, coords
 
 
+def tile_array_2d(array: np.ndarray, tile_size: int, channels_first: Optional[bool] = True,
+                  stride: Optional[int] = None, **pad_kwargs: Any) -> Tuple[np.ndarray, np.ndarray]:
+    """Split an image array into square tiles, non-overlapping by default.
+
+    The array will be padded symmetrically if its dimensions are not exact multiples of `tile_size`
+    (or, with a custom `stride`, if they cannot be exactly covered by tiles every `stride` pixels).
+
+    :param array: Image array.
+    :param tile_size: Width/height of each tile in pixels.
+    :param pad_kwargs: Keyword arguments to be passed to `np.pad()` (e.g. `constant_values=0`).
+    :param channels_first: Whether `array` is in CHW (`True`, default) or HWC (`False`) layout.
+    :param stride: Distance in pixels between the starts of consecutive tiles. If smaller than
+    `tile_size`, tiles will overlap. If `None` (default), equal to `tile_size` (non-overlapping tiles).
+    To avoid copying all tiles, e.g. before discarding most of them, see `get_tile_views_2d()`.
+    :return: A tuple containing:
+        - `tiles`: A batch of tiles in NCHW layout.
+        - `coords`: XY coordinates of each tile, in the same order.
+    """
+    tiles, coords = get_tile_views_2d(array, tile_size, channels_first, stride, **pad_kwargs)
+    # Flatten tile batch dimension, which copies the tiles except in rare cases where strides allow a view
+    tiles = tiles.reshape(-1, *tiles.shape[2:])
+    if not tiles.flags.writeable:
+        tiles = tiles.copy()
+    coords = coords.reshape(-1, 2)
+    return tiles, coords
+
+
 def assemble_tiles_2d(tiles: np.ndarray, coords: np.ndarray, fill_value: Optional[float] = np.nan,
-                      channels_first: Optional[bool] = True) -> Tuple[np.ndarray, np.ndarray]:
+                      channels_first: Optional[bool] = True, dtype: Optional[np.dtype] = None,
+                      downsample: int = 1) -> Tuple[np.ndarray, np.ndarray]:
     """Assembles a 2D array from sequences of tiles and coordinates.
 
+    All tiles are placed with a single vectorised indexed assignment. Where tiles overlap, later
+    tiles overwrite earlier ones.
+
     :param tiles: Stack of tiles with batch dimension first.
     :param coords: XY tile coordinates, assumed to be spaced by multiples of `tile_size` (shape: [N, 2]).
-    :param tile_size: Size of each tile; must be >0.
-    :param fill_value: Value to assign to empty elements (default: `NaN`).
+    :param fill_value: Value to assign to empty elements (default: `NaN`). If `dtype` cannot represent `NaN`
+    (e.g. integer or boolean types), a `NaN` fill value is replaced with 0.
     :param channels_first: Whether each tile is in CHW (`True`, default) or HWC (`False`) layout.
+    :param dtype: Data type of the assembled array, e.g. `tiles.dtype` to avoid upcasting `uint8`
+    tiles. By default (`None`), inferred from `fill_value` as in `np.full()`.
+    :param downsample: Integer factor by which to downsample the assembled array, e.g. to build a
+    thumbnail or heatmap without allocating the full-resolution array. Tiles are subsampled every
+    `downsample` pixels, so `tile_size` must be divisible by `downsample`. Default: 1 (no downsampling).
     :return: A tuple containing:
         - `array`: The reassembled 2D array with the smallest dimensions to contain all given tiles.
-        - `offset`: The lowest XY coordinates.
-        - `offset`: XY offset introduced by the assembly. Add this to tile coordinates to obtain
-        indices for the assembled array.
+        - `offset`: XY offset introduced by the assembly. Add this to tile coordinates (and divide by
+        `downsample`) to obtain indices for the assembled array.
     """
     if coords.shape[0] != tiles.shape[0]:
         raise ValueError(f"Tile coordinates and values must have the same length, "
@@ -107,22 +161,29 @@ def assemble_tiles_2d(tiles: np.ndarray, coords: np.ndarray, fill_value: Optiona
         n_tiles, channels, tile_size, _ = tiles.shape
     else:
         n_tiles, tile_size, _, channels = tiles.shape
+    if downsample < 1 or tile_size % downsample != 0:
+        raise ValueError(f"Tile size ({tile_size}) must be divisible by the downsampling factor ({downsample})")
     tile_xs, tile_ys = coords.T
 
     x_min, x_max = min(tile_xs), max(tile_xs + tile_size)
     y_min, y_max = min(tile_ys), max(tile_ys + tile_size)
-    width = x_max - x_min
-    height = y_max - y_min
+    width = (x_max - x_min) // downsample
+    height = (y_max - y_min) // downsample
     output_shape = (channels, height, width) if channels_first else (height, width, channels)
-    array = np.full(output_shape, fill_value)
+    if dtype is not None and not np.issubdtype(dtype, np.inexact) \
+            and fill_value is not None and np.isnan(fill_value):
+        fill_value = 0
+    array = np.full(output_shape, fill_value, dtype=dtype)
 
     offset = np.array([-x_min, -y_min])
-    for idx in range(n_tiles):
-        row = coords[idx, 1] + offset[1]
-        col = coords[idx, 0] + offset[0]
-        if channels_first:
-            array[:, row:row + tile_size, col:col + tile_size] = tiles[idx]
-        else:
-            array[row:row + tile_size, col:col + tile_size, :] = tiles[idx]
+    # Row and column indices of every pixel of every tile in the output array, shapes: (N, h, 1) and (N, 1, w)
+    pixel_offsets = np.arange(tile_size // downsample)
+    rows = ((tile_ys + offset[1]) // downsample)[:, None, None] + pixel_offsets[None, :, None]
+    cols = ((tile_xs + offset[0]) // downsample)[:, None, None] + pixel_offsets[None, None, :]
+    if channels_first:
+        # Advanced indices placed after a slice yield an indexed shape of (C, N, h, w)
+        array[:, rows, cols] = tiles[:, :, ::downsample, ::downsample].transpose(1, 0, 2, 3)
+    else:
+        array[rows, cols, :] = tiles[:, ::downsample, ::downsample, :]
 
     return array, offset
@@ -0,0 +1,92 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+"""
+Script to benchmark the peak CPU memory of transformer pooling against the bag size, in the default and in the
+memory-efficient mode. Each measurement runs in a separate process, whose growth in peak resident memory during
+a forward (and optionally backward) pass is reported, e.g.:
+
+    python benchmark_transformer_pooling.py --bag_sizes 1000 4000 16000 --backward
+
+Measurements that run out of memory (e.g. large bags in the default mode) are reported as NaN.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+from typing import List
+
+import torch
+
+from health_ml.networks.layers.attention_layers import TransformerPooling
+
+
+def _get_peak_memory_mb() -> float:
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and in kilobytes on Linux
+    return max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 2 ** 10
+
+
+def _measure_peak_memory(args: argparse.Namespace, bag_size: int, memory_efficient: bool,
+                         queue: multiprocessing.Queue) -> None:
+    torch.manual_seed(0)
+    torch.set_num_threads(1)
+    pooling = TransformerPooling(args.num_layers, args.num_heads, args.dim,
+                                 memory_efficient=memory_efficient, query_chunk_size=args.query_chunk_size)
+    pooling.train(args.backward)
+    features = torch.randn(bag_size, args.dim)
+
+    # Warm up on a small bag, so that one-off allocations are not counted
+    with torch.set_grad_enabled(args.backward):
+        pooling(features[:2])
+    baseline_mb = _get_peak_memory_mb()
+    with torch.set_grad_enabled(args.backward):
+        _, pooled_features = pooling(features)
+        if args.backward:
+            pooled_features.sum().backward()
+    queue.put(_get_peak_memory_mb() - baseline_mb)
+
+
+def benchmark_transformer_pooling(args: argparse.Namespace) -> List[List[float]]:
+    """
+    Measure the peak memory of transformer pooling for each bag size, in the default and memory-efficient modes.
+    :param args: The parsed command line arguments.
+    :return: A list of rows containing the bag size and the peak memory of each mode, in MB.
+    """
+    # Large tensors are allocated with mmap and returned to the OS when freed, so that the peak resident memory
+    # of the spawned processes reflects the memory in use, rather than fragmentation of the glibc heap
+    os.environ.setdefault("MALLOC_MMAP_THRESHOLD_", str(2 ** 20))
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    for bag_size in args.bag_sizes:
+        row = [float(bag_size)]
+        for memory_efficient in [False, True]:
+            queue = context.Queue()
+            process = context.Process(target=_measure_peak_memory, args=(args, bag_size, memory_efficient, queue))
+            process.start()
+            process.join()
+            row.append(queue.get() if process.exitcode == 0 else float("nan"))
+        rows.append(row)
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bag_sizes", type=int, nargs="+", default=[1000, 2000, 4000, 8000, 16000])
+    parser.add_argument("--num_layers", type=int, default=4)
+    parser.add_argument("--num_heads", type=int, default=4)
+    parser.add_argument("--dim", type=int, default=512, help="Dimension of the tile features.")
+    parser.add_argument("--query_chunk_size", type=int, default=512)
+    parser.add_argument("--backward", action="store_true", help="Also measure the backward pass, in training mode.")
+    args = parser.parse_args()
+
+    print(f"{'bag size':>10} {'default (MB)':>14} {'efficient (MB)':>16}")
+    for bag_size, default_mb, efficient_mb in benchmark_transformer_pooling(args):
+        print(f"{bag_size:>10.0f} {default_mb:>14.1f} {efficient_mb:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
 
-from typing import List
+from typing import List, Tuple
 import numpy as np
 
 
@@ -30,3 +30,31 @@ def location_selected_tiles(tile_coords: np.ndarray,
     sel_coords = np.transpose([tile_xs.tolist(), tile_ys.tolist()])
 
     return sel_coords
+
+
+def get_attention_raster(tile_coords: np.ndarray,
+                         attentions: np.ndarray,
+                         location_bbox: List[int],
+                         level: int,
+                         tile_size: int = 224) -> Tuple[np.ndarray, Tuple[int, int, int, int]]:
+    """ Return a raster of tile attentions on the grid of tiles of the slide, with one cell per tile.
+    :param tile_coords: XY tile coordinates, assumed to be spaced by multiples of `tile_size`
+    (shape: [N, 2]) in original resolution.
+    :param attentions: Attention of each tile (shape: [N]).
+    :param location_bbox: Location of the bounding box on the slide in original resolution.
+    :param level: The downsampling level (e.g. 0, 1, 2) of the tiles if available.
+    :param tile_size: Size of each tile. Default 224.
+    :return: A tuple containing the attention raster (shape: [rows, cols]), which is NaN where there are no tiles,
+    and its extent (left, right, bottom, top) in pixels of the slide at the given level, as expected by `imshow`.
+    """
+    sel_coords = location_selected_tiles(tile_coords=tile_coords, location_bbox=location_bbox, level=level)
+    sel_coords = np.asarray(sel_coords).reshape(-1, 2)
+    origin = sel_coords.min(axis=0)
+    cols, rows = ((sel_coords - origin) // tile_size).astype(int).T
+
+    raster = np.full((rows.max() + 1, cols.max() + 1), np.nan, dtype=np.float32)
+    raster[rows, cols] = np.asarray(attentions).reshape(-1)
+
+    left, top = int(origin[0]), int(origin[1])
+    extent = (left, left + raster.shape[1] * tile_size, top + raster.shape[0] * tile_size, top)
+    return raster, extent
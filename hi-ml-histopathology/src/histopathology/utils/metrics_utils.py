@@ -16,7 +16,7 @@ import matplotlib.collections as collection
 
 from histopathology.models.transforms import load_pil_image
 from histopathology.utils.naming import ResultsKey
-from histopathology.utils.heatmap_utils import location_selected_tiles
+from histopathology.utils.heatmap_utils import get_attention_raster, location_selected_tiles
 
 
 def select_k_tiles(results: Dict, n_tiles: int = 5, n_slides: int = 5, label: int = 1,
@@ -123,12 +123,19 @@ def plot_slide(slide_image: np.ndarray, scale: float) -> plt.figure:
     return fig
 
 
+def _to_numpy(values: Any) -> np.ndarray:
+    if isinstance(values, torch.Tensor):
+        return values.detach().cpu().numpy()
+    return np.array([value.cpu().numpy() if isinstance(value, torch.Tensor) else value for value in values])
+
+
 def plot_heatmap_overlay(slide: str,
                          slide_image: np.ndarray,
                          results: Dict[str, List[Any]],
                          location_bbox: List[int],
                          tile_size: int = 224,
-                         level: int = 1) -> plt.figure:
+                         level: int = 1,
+                         raster: bool = False) -> plt.figure:
     """Plots heatmap of selected tiles (e.g. tiles in a bag) overlay on the corresponding slide.
     :param slide: slide identifier.
     :param slide_image: Numpy array of the slide image (shape: [3, H, W]).
@@ -137,6 +144,8 @@ def plot_heatmap_overlay(slide: str,
     :param level: Magnification at which tiles are available (e.g. PANDA levels are 0 for original,
     1 for 4x downsampled, 2 for 16x downsampled). Default 1.
     :param location_bbox: Location of the bounding box of the slide.
+    :param raster: If True, draw the heatmap as a single image of the attention raster on the tile grid (see
+    `get_attention_raster`), which is much faster for large bags. Otherwise (default), draw one patch per tile.
     :return: matplotlib figure of the heatmap of the given tiles on slide.
     """
     fig, ax = plt.subplots()
@@ -145,22 +154,27 @@ def plot_heatmap_overlay(slide: str,
     ax.set_xlim(0, slide_image.shape[1])
     ax.set_ylim(slide_image.shape[0], 0)
 
-    coords = []
     slide_ids = [item[0] for item in results[ResultsKey.SLIDE_ID]]
     slide_idx = slide_ids.index(slide)
-    attentions = results[ResultsKey.BAG_ATTN][slide_idx]
+    attentions = _to_numpy(results[ResultsKey.BAG_ATTN][slide_idx]).reshape(-1)
 
     # for each tile in the bag
-    for tile_idx in range(len(results[ResultsKey.IMAGE_PATH][slide_idx])):
-        tile_coords = np.transpose(np.array([results[ResultsKey.TILE_X][slide_idx][tile_idx].cpu().numpy(),
-                                   results[ResultsKey.TILE_Y][slide_idx][tile_idx].cpu().numpy()]))
-        coords.append(tile_coords)
+    coords = np.stack([_to_numpy(results[ResultsKey.TILE_X][slide_idx]),
+                       _to_numpy(results[ResultsKey.TILE_Y][slide_idx])], axis=1)
+    cmap = plt.cm.get_cmap('Reds')
 
-    coords = np.array(coords)  # type: ignore
-    attentions = np.array(attentions.cpu()).reshape(-1)
+    if raster:
+        attention_raster, extent = get_attention_raster(tile_coords=coords, attentions=attentions,
+                                                        location_bbox=location_bbox, level=level,
+                                                        tile_size=tile_size)
+        heatmap = ax.imshow(attention_raster, cmap=cmap, alpha=.5, vmin=0, vmax=1, extent=extent,
+                            interpolation='nearest')
+        ax.set_xlim(0, slide_image.shape[1])
+        ax.set_ylim(slide_image.shape[0], 0)
+        plt.colorbar(heatmap, ax=ax)
+        return fig
 
     sel_coords = location_selected_tiles(tile_coords=coords, location_bbox=location_bbox, level=level)
-    cmap = plt.cm.get_cmap('Reds')
 
     tile_xs, tile_ys = sel_coords.T
     rects = [patches.Rectangle(xy, tile_size, tile_size) for xy in zip(tile_xs, tile_ys)]
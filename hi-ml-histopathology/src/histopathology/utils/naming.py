@@ -33,6 +33,8 @@ class TileKey(str, Enum):
     TILE_X = 'tile_x'
     TILE_Y = 'tile_y'
     OCCUPANCY = 'occupancy'
+    LEVEL = 'level'
+    TILE_SIZE = 'tile_size'
     FOREGROUND_THRESHOLD = 'foreground_threshold'
     SLIDE_METADATA = 'slide_metadata'
 
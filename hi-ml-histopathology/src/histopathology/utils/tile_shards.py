@@ -0,0 +1,181 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+"""Sharded tile storage, where all tiles of a slide are packed into a single uncompressed tar file.
+
+The tiles are stored as encoded images (e.g. PNG) named by their tile descriptor, WebDataset-style,
+while the per-slide dataset CSV keeps the tile coordinates and occupancies. Tile image paths in the
+dataset CSV point inside the shard, e.g. `"<slide_id>/tiles.tar/<descriptor>.png"`, so the same
+`TilesDataset` and loading transforms can consume both one-file-per-tile and sharded datasets.
+
+Each shard has a sidecar JSON index, `tiles.tar.index.json`, recording the offset and size of every
+tile in the shard, so that individual tiles can be read directly without scanning the tar file.
+"""
+
+import functools
+import io
+import json
+import tarfile
+import time
+from collections import defaultdict
+from enum import Enum
+from pathlib import Path, PurePath
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+SHARD_SUFFIX = ".tar"
+SHARD_FILENAME = "tiles" + SHARD_SUFFIX
+SHARD_INDEX_SUFFIX = ".index.json"
+
+PathOrString = Union[Path, str]
+
+
+class TileFormat(Enum):
+    PNG = 'png'  # one PNG file per tile
+    TAR = 'tar'  # one tar shard of PNG tiles per slide
+
+
+def split_shard_path(path: PathOrString) -> Optional[Tuple[Path, str]]:
+    """Split a tile image path pointing inside a tar shard into the shard path and the member name.
+
+    :param path: A tile image path, e.g. `"root/<slide_id>/tiles.tar/<descriptor>.png"`.
+    :return: A tuple containing the path of the shard file and the name of the tile inside it, or `None` if
+    `path` does not point inside a shard.
+    """
+    pure_path = PurePath(path)
+    for parent in pure_path.parents:
+        if parent.suffix == SHARD_SUFFIX:
+            return Path(parent), pure_path.relative_to(parent).as_posix()
+    return None
+
+
+def get_shard_index_path(shard_path: PathOrString) -> Path:
+    """Return the path of the sidecar index of a tar shard, e.g. `"<slide_id>/tiles.tar.index.json"`."""
+    shard_path = Path(shard_path)
+    return shard_path.with_name(shard_path.name + SHARD_INDEX_SUFFIX)
+
+
+class TileShardWriter:
+    """Writer for a tar shard of encoded tile images, to be used as a context manager.
+
+    The offset and size of each tile in the shard are saved to the sidecar index when the writer is closed.
+    """
+
+    def __init__(self, shard_path: Path) -> None:
+        """
+        :param shard_path: Path of the shard file to create. Parent directories must already exist.
+        """
+        self.shard_path = shard_path
+        self._tar_file = tarfile.open(shard_path, mode='w')
+        self._index: Dict[str, Tuple[int, int]] = {}
+
+    def write(self, member_name: str, data: bytes) -> None:
+        """Append an encoded tile image to the shard.
+
+        :param member_name: Name of the tile in the shard, e.g. `"<descriptor>.png"`.
+        :param data: The encoded image bytes.
+        """
+        tar_info = tarfile.TarInfo(member_name)
+        tar_info.size = len(data)
+        tar_info.mtime = int(time.time())
+        self._tar_file.addfile(tar_info, io.BytesIO(data))
+        # The data is followed by padding to a whole number of blocks, after which the tar file offset now points
+        padded_size = -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self._index[member_name] = (self._tar_file.offset - padded_size, len(data))
+
+    def close(self) -> None:
+        if self._tar_file.closed:
+            return
+        self._tar_file.close()
+        with get_shard_index_path(self.shard_path).open('w') as index_file:
+            json.dump(self._index, index_file)
+
+    def __enter__(self) -> "TileShardWriter":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+
+@functools.lru_cache(maxsize=128)
+def _load_shard_index(index_path: str, mtime_ns: int) -> Dict[str, Tuple[int, int]]:
+    # The modification time is part of the cache key, so that rewritten shards are indexed again
+    with open(index_path) as index_file:
+        return {name: (offset, size) for name, (offset, size) in json.load(index_file).items()}
+
+
+def get_shard_index(shard_path: PathOrString) -> Optional[Dict[str, Tuple[int, int]]]:
+    """Load the sidecar index of a tar shard, caching it in memory for subsequent reads.
+
+    :param shard_path: Path of the shard file.
+    :return: A dictionary mapping the name of each member to its data offset and size in the shard file,
+    or `None` if the shard has no index (e.g. shards written by previous versions).
+    """
+    index_path = get_shard_index_path(shard_path)
+    try:
+        mtime_ns = index_path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return _load_shard_index(str(index_path), mtime_ns)
+
+
+def read_shard_members(shard_path: PathOrString, member_names: Sequence[str]) -> List[bytes]:
+    """Read the given members from a tar shard.
+
+    If the shard has a sidecar index, each member is read directly at its offset, in the order in which
+    members are stored in the shard. Otherwise, all members are read in a single sequential pass over the file.
+
+    :param shard_path: Path of the shard file.
+    :param member_names: Names of the members to read, in any order and possibly repeated.
+    :return: The contents of each requested member, in the same order as `member_names`.
+    """
+    remaining = set(member_names)
+    contents: Dict[str, bytes] = {}
+    shard_index = get_shard_index(shard_path)
+    if shard_index is not None:
+        missing = remaining.difference(shard_index)
+        if missing:
+            raise KeyError(f"Tiles not found in shard {shard_path}: {sorted(missing)}")
+        with open(shard_path, 'rb') as shard_file:
+            for name in sorted(remaining, key=lambda name: shard_index[name][0]):  # type: ignore
+                offset, size = shard_index[name]
+                shard_file.seek(offset)
+                contents[name] = shard_file.read(size)
+        return [contents[name] for name in member_names]
+
+    with tarfile.open(shard_path, mode='r') as tar_file:
+        for tar_info in tar_file:
+            if tar_info.name in remaining:
+                contents[tar_info.name] = tar_file.extractfile(tar_info).read()  # type: ignore
+                remaining.remove(tar_info.name)
+                if not remaining:
+                    break
+    if remaining:
+        raise KeyError(f"Tiles not found in shard {shard_path}: {sorted(remaining)}")
+    return [contents[name] for name in member_names]
+
+
+def read_tile_bytes(image_paths: Sequence[PathOrString]) -> List[bytes]:
+    """Read the encoded contents of tile images, stored either as individual files or inside shards.
+
+    Tiles stored in the same shard are read together, with a single opening of the shard file.
+
+    :param image_paths: Paths of the tile images, as given in the tiles dataset.
+    :return: The encoded contents of each image, in the same order as `image_paths`.
+    """
+    contents: List[Optional[bytes]] = [None] * len(image_paths)
+    shard_requests: Dict[Path, List[Tuple[int, str]]] = defaultdict(list)
+    for index, image_path in enumerate(image_paths):
+        shard_location = split_shard_path(image_path)
+        if shard_location is None:
+            contents[index] = Path(image_path).read_bytes()
+        else:
+            shard_path, member_name = shard_location
+            shard_requests[shard_path].append((index, member_name))
+
+    for shard_path, requests in shard_requests.items():
+        indices, member_names = zip(*requests)
+        for index, data in zip(indices, read_shard_members(shard_path, member_names)):
+            contents[index] = data
+    return contents  # type: ignore
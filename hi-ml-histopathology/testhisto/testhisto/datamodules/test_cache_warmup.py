@@ -0,0 +1,102 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+from pathlib import Path
+from typing import Any, Dict, List, Mapping
+
+import pytest
+import torch
+from monai.data.dataset import CacheDataset, PersistentDataset
+from monai.transforms import Compose, MapTransform
+
+from health_ml.utils.bag_utils import BagDataset
+from histopathology.datamodules.cache_warmup import (ParallelCacheDataset, ParallelPersistentDataset,
+                                                     split_cacheable_transforms)
+from histopathology.models.transforms import EncodeTilesBatchd, Subsampled
+
+N_TILES = 60
+TILE_SHAPE = (3, 4, 4)
+
+
+class MockLoadTilesd(MapTransform):
+    """Deterministically generates a tile tensor from each tile ID."""
+
+    def __call__(self, data: Mapping) -> Dict:
+        out_data = dict(data)
+        for key in self.key_iterator(out_data):
+            tile_ids = torch.as_tensor(data[key], dtype=torch.float32)
+            out_data[key] = torch.sin(tile_ids[:, None, None, None] + torch.arange(48.).view(TILE_SHAPE))
+        return out_data
+
+
+def _collate_as_lists(samples: List[Dict]) -> Dict[str, List]:
+    # Plain lists (unlike tensors) are hashed deterministically by PersistentDataset
+    return {key: [sample[key] for sample in samples] for key in samples[0]}
+
+
+def _get_bag_dataset() -> BagDataset:
+    tiles = [{'tile_id': i, 'image': i, 'slide_id': i % 7} for i in range(N_TILES)]
+    generator = torch.Generator()
+    generator.manual_seed(0)
+    bag_dataset = BagDataset(tiles, bag_ids=[tile['slide_id'] for tile in tiles],  # type: ignore
+                             shuffle_samples=True, generator=generator, collate_fn=_collate_as_lists)
+    bag_dataset.set_shuffle_seed(42)
+    return bag_dataset
+
+
+def _get_transform() -> Compose:
+    torch.manual_seed(0)
+    encoder = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(48, 5))
+    return Compose([MockLoadTilesd('image'), EncodeTilesBatchd('image', encoder, chunk_size=3)])  # type: ignore
+
+
+def _assert_items_equal(items: List[Any], expected_items: List[Any]) -> None:
+    assert len(items) == len(expected_items)
+    for item, expected_item in zip(items, expected_items):
+        assert item.keys() == expected_item.keys()
+        for key in item:
+            if isinstance(item[key], torch.Tensor):
+                assert torch.equal(item[key], expected_item[key])
+            else:
+                assert item[key] == expected_item[key]
+
+
+def test_split_cacheable_transforms() -> None:
+    load, subsample = MockLoadTilesd('image'), Subsampled('image', max_size=2)
+    encode = EncodeTilesBatchd('image', encoder=None)  # type: ignore
+    assert split_cacheable_transforms(Compose([load, encode, subsample])) == ([load], [encode])
+    assert split_cacheable_transforms(Compose([load, subsample, encode])) == ([load], [])
+    assert split_cacheable_transforms(load) == ([load], [])
+    assert split_cacheable_transforms(lambda x: x) == ([], [])
+
+
+@pytest.mark.parametrize('loading_workers', [0, 2])
+def test_parallel_cache_dataset(loading_workers: int) -> None:
+    expected_items = list(CacheDataset(_get_bag_dataset(), _get_transform(), progress=False))  # type: ignore
+    items = list(ParallelCacheDataset(_get_bag_dataset(), _get_transform(),  # type: ignore
+                                      loading_workers=loading_workers, progress=False))
+    _assert_items_equal(items, expected_items)
+
+
+@pytest.mark.parametrize('loading_workers', [0, 2])
+def test_parallel_persistent_dataset(tmp_path: Path, loading_workers: int) -> None:
+    serial_dataset = PersistentDataset(_get_bag_dataset(), _get_transform(),  # type: ignore
+                                       cache_dir=tmp_path / "serial")
+    expected_items = list(serial_dataset)  # type: ignore
+
+    parallel_cache_dir = tmp_path / "parallel"
+    parallel_dataset = ParallelPersistentDataset(_get_bag_dataset(), _get_transform(),  # type: ignore
+                                                 cache_dir=parallel_cache_dir)
+    parallel_dataset.warm_up(loading_workers=loading_workers, progress=False)
+    serial_files = sorted(path.name for path in (tmp_path / "serial").iterdir())
+    assert sorted(path.name for path in parallel_cache_dir.iterdir()) == serial_files
+    _assert_items_equal([torch.load(parallel_cache_dir / name) for name in serial_files],
+                        [torch.load(tmp_path / "serial" / name) for name in serial_files])
+    _assert_items_equal(list(parallel_dataset), expected_items)  # type: ignore
+
+    # Warming up again skips cached items
+    modification_times = [path.stat().st_mtime_ns for path in sorted(parallel_cache_dir.iterdir())]
+    parallel_dataset.warm_up(loading_workers=loading_workers, progress=False)
+    assert [path.stat().st_mtime_ns for path in sorted(parallel_cache_dir.iterdir())] == modification_times
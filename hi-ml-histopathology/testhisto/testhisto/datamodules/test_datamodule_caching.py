@@ -177,3 +177,73 @@ def test_tile_id_coverage(mock_data_dir: Path, cache_mode: CacheMode, precache_l
                 f"Tile IDs already seen: {bag_tile_ids}"
             loaded_tile_ids.update(bag_tile_ids)
     assert loaded_tile_ids == expected_tile_ids
+
+
+@pytest.mark.parametrize('cache_mode', [CacheMode.MEMORY, CacheMode.NONE])
+def test_dataloader_defaults(mock_data_dir: Path, cache_mode: CacheMode) -> None:
+    datamodule = MockTilesDataModule(root_path=mock_data_dir, transform=noop_transform, seed=0,
+                                     cache_mode=cache_mode)
+    dataloader = datamodule.train_dataloader()
+    if cache_mode is CacheMode.NONE:
+        assert dataloader.num_workers > 0
+        assert dataloader.pin_memory == torch.cuda.is_available()
+    else:
+        assert dataloader.num_workers == 0
+        assert not dataloader.pin_memory
+
+
+def test_multiworker_shuffling_reproducibility(mock_data_dir: Path) -> None:
+    def get_dataloader(num_workers: int) -> DataLoader:
+        datamodule = MockTilesDataModule(root_path=mock_data_dir, transform=noop_transform, seed=0,
+                                         batch_size=2, cache_mode=CacheMode.NONE, num_workers=num_workers)
+        return datamodule.train_dataloader()
+
+    def get_tile_ids(dataloader: DataLoader) -> list:
+        return [bag_tile_ids.tolist() for batch in dataloader
+                for bag_tile_ids in batch[MockTilesDataset.TILE_ID_COLUMN]]
+
+    serial_dataloader = get_dataloader(num_workers=0)
+    serial_epochs = [get_tile_ids(serial_dataloader) for _ in range(2)]
+    assert serial_epochs[0] != serial_epochs[1], "Shuffling should vary across epochs"
+
+    for num_workers in [1, 3]:
+        parallel_dataloader = get_dataloader(num_workers=num_workers)
+        parallel_epochs = [get_tile_ids(parallel_dataloader) for _ in range(2)]
+        assert parallel_epochs == serial_epochs
+
+
+@pytest.mark.parametrize('cache_mode', [CacheMode.MEMORY, CacheMode.DISK])
+def test_cache_full_bags(mock_data_dir: Path, tmp_path: Path, cache_mode: CacheMode) -> None:
+    max_bag_size = 3
+    datamodule = MockTilesDataModule(root_path=mock_data_dir, transform=noop_transform, seed=0, batch_size=2,
+                                     max_bag_size=max_bag_size, cache_mode=cache_mode, cache_dir=tmp_path,
+                                     cache_full_bags=True)
+    dataloader = datamodule.train_dataloader()
+    train_df = datamodule.train_dataset.dataset_df
+
+    def get_bags() -> list:
+        bags = []
+        for batch in dataloader:
+            for tile_ids, labels, images in zip(batch[MockTilesDataset.TILE_ID_COLUMN],
+                                                batch[MockTilesDataset.LABEL_COLUMN],
+                                                batch[MockTilesDataset.IMAGE_COLUMN]):
+                slide_id = train_df.loc[int(tile_ids[0]), MockTilesDataset.SLIDE_ID_COLUMN]
+                slide_size = (train_df[MockTilesDataset.SLIDE_ID_COLUMN] == slide_id).sum()
+                assert len(tile_ids) == min(max_bag_size, slide_size)
+                assert len(set(tile_ids.tolist())) == len(tile_ids)
+                # All tile fields are subsampled consistently
+                assert labels.tolist() == train_df.loc[tile_ids.tolist(), MockTilesDataset.LABEL_COLUMN].tolist()
+                assert images == [str(mock_data_dir / image_path)
+                                  for image_path in train_df.loc[tile_ids.tolist(), MockTilesDataset.IMAGE_COLUMN]]
+                bags.append(tile_ids.tolist())
+        return bags
+
+    first_epoch_bags = get_bags()
+    assert get_bags() != first_epoch_bags, "Subsets of cached bags should vary across epochs"
+
+    # Same subsets are drawn for a given seed
+    reloaded_datamodule = MockTilesDataModule(root_path=mock_data_dir, transform=noop_transform, seed=0,
+                                              batch_size=2, max_bag_size=max_bag_size, cache_mode=cache_mode,
+                                              cache_dir=tmp_path, cache_full_bags=True)
+    dataloader = reloaded_datamodule.train_dataloader()
+    assert get_bags() == first_epoch_bags
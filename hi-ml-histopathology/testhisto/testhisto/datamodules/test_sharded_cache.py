@@ -0,0 +1,101 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+import pickle
+from pathlib import Path
+from typing import Any, Dict, List, Mapping
+
+import numpy as np
+import pytest
+import torch
+from monai.transforms import Compose, MapTransform, RandomizableTransform
+
+from histopathology.datamodules.sharded_cache import (SHARDED_CACHE_INDEX_FILENAME, ShardedCacheDataset,
+                                                      is_sharded_cache, save_sharded_cache)
+
+
+class AddOne(MapTransform):
+    def __call__(self, data: Mapping) -> Dict:
+        return {**data, **{key: data[key] + 1 for key in self.key_iterator(data)}}
+
+
+class RandomNegate(RandomizableTransform):
+    def __call__(self, data: Mapping) -> Dict:
+        return {**data, 'features': -data['features']}
+
+
+def _get_items() -> List[Dict[str, Any]]:
+    items = []
+    for bag_size in [3, 1, 4]:
+        items.append({'features': torch.randn(bag_size, 5),
+                      'label': torch.full((bag_size,), bag_size % 2),
+                      'coords': torch.arange(2. * bag_size).half().view(bag_size, 2),
+                      'slide_id': [f"slide_{bag_size}"] * bag_size,
+                      'mean': torch.tensor(bag_size / 2)})
+    # Bag with a different feature dimension goes in a separate shard
+    items.append({**items[0], 'features': torch.randn(2, 7), 'label': torch.zeros(2, dtype=torch.long)})
+    return items
+
+
+def _assert_items_equal(item: Dict[str, Any], expected_item: Dict[str, Any]) -> None:
+    assert item.keys() == expected_item.keys()
+    for key, expected_value in expected_item.items():
+        if isinstance(expected_value, torch.Tensor):
+            assert item[key].dtype == expected_value.dtype
+            assert torch.equal(item[key], expected_value), key
+        else:
+            assert item[key] == expected_value, key
+
+
+def test_sharded_cache_round_trip(tmp_path: Path) -> None:
+    items = _get_items()
+    assert not is_sharded_cache(tmp_path)
+    save_sharded_cache(items, tmp_path)
+    assert is_sharded_cache(tmp_path)
+    # Shards of features of each dimension, labels, and coordinates
+    assert len(list(tmp_path.glob("*.npy"))) == 4
+
+    dataset = ShardedCacheDataset(items, AddOne('features'), tmp_path)  # type: ignore
+    assert len(dataset) == len(items)
+    for index in range(len(items)):
+        _assert_items_equal(dataset.get_cached_item(index), items[index])
+    # Shards are memory-mapped lazily rather than read into memory
+    assert len(dataset._shards) == 4
+    assert all(isinstance(shard, np.memmap) for shard in dataset._shards.values())
+
+    # Modifying a loaded tensor does not affect the files
+    dataset.get_cached_item(0)['features'].zero_()
+    _assert_items_equal(ShardedCacheDataset(items, AddOne('features'), tmp_path).get_cached_item(0),  # type: ignore
+                        items[0])
+
+    # Pickling, e.g. for data loader workers, re-opens the shards
+    unpickled_dataset = pickle.loads(pickle.dumps(dataset))
+    assert unpickled_dataset._shards == {}
+    _assert_items_equal(unpickled_dataset.get_cached_item(2), items[2])
+
+
+def test_sharded_cache_post_cache_transforms(tmp_path: Path) -> None:
+    items = _get_items()
+    transform = Compose([AddOne('features'), RandomNegate(), AddOne('label')])
+    cached_items = [AddOne('features')(item) for item in items]
+    save_sharded_cache(cached_items, tmp_path)
+    dataset = ShardedCacheDataset(items, transform, tmp_path)  # type: ignore
+    for index in range(len(items)):
+        _assert_items_equal(dataset[index], {**items[index], 'features': -items[index]['features'] - 1,
+                                             'label': items[index]['label'] + 1})
+
+
+def test_sharded_cache_interrupted_or_outdated(tmp_path: Path) -> None:
+    items = _get_items()
+    save_sharded_cache(items, tmp_path)
+    with pytest.raises(ValueError, match="outdated cache"):
+        ShardedCacheDataset(items[:-1], AddOne('features'), tmp_path)  # type: ignore
+
+    # Cache without an index, e.g. if saving was interrupted, is incomplete
+    (tmp_path / SHARDED_CACHE_INDEX_FILENAME).unlink()
+    assert not is_sharded_cache(tmp_path)
+
+    save_sharded_cache(items[:-1], tmp_path)
+    assert len(ShardedCacheDataset(items[:-1], AddOne('features'), tmp_path)) == len(items) - 1  # type: ignore
@@ -0,0 +1,102 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+from typing import Any, Dict
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from torch.utils.data._utils.collate import default_collate
+
+from health_ml.utils.bag_utils import BagDataset, multibag_collate
+from histopathology.datasets.base_dataset import SlidesDataset, TilesDataset
+from histopathology.utils.naming import SlideKey
+
+
+class MockTilesDataset(TilesDataset):
+    SPLIT_COLUMN = None
+
+
+def _get_mock_dataset_df(n_tiles: int = 20) -> pd.DataFrame:
+    return pd.DataFrame({TilesDataset.TILE_ID_COLUMN: np.arange(n_tiles) * 3,
+                         TilesDataset.SLIDE_ID_COLUMN: [f"slide_{i % 4}" for i in range(n_tiles)],
+                         TilesDataset.IMAGE_COLUMN: [f"tiles/{i}.png" for i in range(n_tiles)],
+                         TilesDataset.LABEL_COLUMN: np.arange(n_tiles) % 2,
+                         TilesDataset.TILE_X_COLUMN: np.arange(n_tiles) * 224.,
+                         TilesDataset.TILE_Y_COLUMN: [0., np.nan] * (n_tiles // 2),
+                         'occupancy': np.linspace(0, 1, n_tiles)})
+
+
+def _get_item_by_label(dataset: TilesDataset, index: int) -> Dict[str, Any]:
+    # Reference implementation with a label-based row lookup in the dataframe
+    tile_id = dataset.dataset_df.index[index]
+    sample = {dataset.TILE_ID_COLUMN: tile_id, **dataset.dataset_df.loc[tile_id].to_dict()}
+    sample[dataset.IMAGE_COLUMN] = str(dataset.root_dir / sample.pop(dataset.IMAGE_COLUMN))
+    sample[dataset.PATH_COLUMN] = sample[dataset.IMAGE_COLUMN]
+    return sample
+
+
+def _assert_samples_equal(sample: Dict[str, Any], expected_sample: Dict[str, Any]) -> None:
+    assert list(sample) == list(expected_sample)
+    for key, expected_value in expected_sample.items():
+        assert type(sample[key]) is type(expected_value), key
+        assert sample[key] == expected_value or (np.isnan(sample[key]) and np.isnan(expected_value)), key
+
+
+def test_tiles_dataset_get_many() -> None:
+    dataset = MockTilesDataset("/data", dataset_df=_get_mock_dataset_df())
+    indices = [5, 0, 17, 5]
+    samples = dataset.get_many(indices)
+    assert len(samples) == len(indices)
+    for index, sample in zip(indices, samples):
+        _assert_samples_equal(sample, _get_item_by_label(dataset, index))
+        _assert_samples_equal(dataset[index], _get_item_by_label(dataset, index))
+    for sample, bulk_sample in zip(samples, dataset.__getitems__(indices)):
+        _assert_samples_equal(bulk_sample, sample)
+
+    # Replacing the dataframe, e.g. after filtering, refreshes the columns
+    dataset.dataset_df = dataset.dataset_df.iloc[::2]
+    _assert_samples_equal(dataset[1], _get_item_by_label(dataset, 1))
+
+
+def test_tiles_bag_dataset_matches_per_tile_loading() -> None:
+    dataset = MockTilesDataset("/data", dataset_df=_get_mock_dataset_df())
+    bag_dataset = BagDataset(dataset, bag_ids=dataset.slide_ids)  # type: ignore
+
+    for start in range(0, len(bag_dataset), 2):
+        bag_indices = range(start, min(start + 2, len(bag_dataset)))
+        batch = multibag_collate([bag_dataset[index] for index in bag_indices])
+        expected_bags = [default_collate([_get_item_by_label(dataset, i)
+                                          for i in bag_dataset.bag_sampler.get_bag(index)])
+                         for index in bag_indices]
+        expected_batch = multibag_collate(expected_bags)
+        assert batch.keys() == expected_batch.keys()
+        for key in batch:
+            for value, expected_value in zip(batch[key], expected_batch[key]):
+                if isinstance(expected_value, torch.Tensor):
+                    assert value.dtype == expected_value.dtype
+                    assert torch.allclose(value, expected_value, equal_nan=True)
+                else:
+                    assert value == expected_value
+
+
+def test_slides_dataset_get_slide_by_id() -> None:
+    dataset_df = pd.DataFrame({SlidesDataset.SLIDE_ID_COLUMN: [f"slide_{i}" for i in range(5)],
+                               SlidesDataset.IMAGE_COLUMN: [f"slide_{i}.tiff" for i in range(5)],
+                               SlidesDataset.LABEL_COLUMN: [i % 2 for i in range(5)]})
+    dataset = SlidesDataset(root="/data", dataset_df=dataset_df)
+    for index in range(len(dataset)):
+        sample = dataset[index]
+        assert dataset.get_slide_by_id(sample[SlideKey.SLIDE_ID]) == sample
+    with pytest.raises(KeyError):
+        dataset.get_slide_by_id("missing_slide")
+
+    # Duplicated slide IDs, both apart and next to each other in the dataframe
+    for duplicated_df in [pd.concat([dataset_df, dataset_df[:1]]), pd.concat([dataset_df[:1], dataset_df])]:
+        duplicated_dataset = SlidesDataset(root="/data", dataset_df=duplicated_df)
+        with pytest.raises(ValueError, match="not unique"):
+            duplicated_dataset.get_slide_by_id("slide_0")
+        assert duplicated_dataset.get_slide_by_id("slide_1") == dataset.get_slide_by_id("slide_1")
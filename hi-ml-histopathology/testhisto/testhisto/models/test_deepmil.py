@@ -4,17 +4,23 @@
 #  ------------------------------------------------------------------------------------------
 
 import os
+from pathlib import Path
 from typing import Any, Callable, Dict, Iterable, List, Optional, Type, Tuple
 from unittest.mock import MagicMock
 
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from PIL import Image
 import pytest
 import torch
 from torch import Tensor, argmax, nn, rand, randint, randn, round, stack, allclose
-from torch.utils.data._utils.collate import default_collate
 from torchvision.models import resnet18
 
 from health_ml.lightning_container import LightningContainer
-from health_ml.networks.layers.attention_layers import AttentionLayer
+from health_ml.utils.bag_utils import multibag_collate
+from health_ml.networks.layers.attention_layers import (AttentionLayer, GatedAttentionLayer, MaxPoolingLayer,
+                                                        MeanPoolingLayer, TransformerPooling)
 
 
 from histopathology.configs.classification.DeepSMILECrck import DeepSMILECrck
@@ -22,9 +28,12 @@ from histopathology.configs.classification.DeepSMILEPanda import DeepSMILEPanda
 from histopathology.datamodules.base_module import TilesDataModule
 from histopathology.datasets.base_dataset import TilesDataset
 from histopathology.datasets.default_paths import PANDA_TILES_DATASET_DIR, TCGA_CRCK_DATASET_DIR
-from histopathology.models.deepmil import DeepMILModule
+from histopathology.models import deepmil
+from histopathology.models.deepmil import (DEFAULT_MAX_FIGURE_WORKERS, TEST_ENCODED_FEATURES_DIRNAME,
+                                           TEST_OUTPUT_CSV_FILENAME, TEST_RANK_OUTPUTS_DIRNAME_PREFIX, DeepMILModule)
 from histopathology.models.encoders import IdentityEncoder, ImageNetEncoder, TileEncoder
-from histopathology.utils.naming import MetricsKey, ResultsKey
+from histopathology.utils.metrics_utils import select_k_tiles
+from histopathology.utils.naming import MetricsKey, ResultsKey, SlideKey
 
 
 def get_supervised_imagenet_encoder() -> TileEncoder:
@@ -158,7 +167,7 @@ def add_callback(fn: Callable, callback: Callable) -> Callable:
 
 
 @pytest.mark.parametrize("n_classes", [1, 3])
-def test_metrics(n_classes: int) -> None:
+def test_metrics(n_classes: int, tmp_path: Path) -> None:
     input_dim = (128,)
 
     # hard-coded here to avoid test explosion; correctness of other pooling layers is tested elsewhere
@@ -170,7 +179,8 @@ def test_metrics(n_classes: int) -> None:
         label_column=TilesDataset.LABEL_COLUMN,
         n_classes=n_classes,
         pooling_layer=pooling_layer,
-        num_features=num_features
+        num_features=num_features,
+        outputs_path=tmp_path
     )
 
     # Patching to enable running the module without a Trainer object
@@ -196,7 +206,7 @@ def test_metrics(n_classes: int) -> None:
         sample[TilesDataset.PATH_COLUMN] = [tile_id + '.png'
                                             for tile_id in sample[TilesDataset.TILE_ID_COLUMN]]
         bags.append(sample)
-    batch = default_collate(bags)
+    batch = multibag_collate(bags)
 
     # ================
     # Test that the module metrics match manually computed metrics with the correct inputs
@@ -218,6 +228,287 @@ def test_metrics(n_classes: int) -> None:
         assert torch.allclose(value, expected_value), f"Discrepancy in '{key}' metric"
 
 
+@pytest.mark.parametrize("pooling_layer_type", [AttentionLayer, GatedAttentionLayer, MeanPoolingLayer,
+                                                MaxPoolingLayer, TransformerPooling])
+@pytest.mark.parametrize("n_classes", [1, 3])
+def test_batched_forward(pooling_layer_type: Type[nn.Module], n_classes: int) -> None:
+    num_encoding = 8
+    if pooling_layer_type in [AttentionLayer, GatedAttentionLayer]:
+        pooling_layer = pooling_layer_type(num_encoding, 5, 2)
+    elif pooling_layer_type is TransformerPooling:
+        pooling_layer = TransformerPooling(num_layers=2, num_heads=2, dim_representation=num_encoding)
+    else:
+        pooling_layer = pooling_layer_type()
+    num_features = num_encoding * (2 if pooling_layer_type in [AttentionLayer, GatedAttentionLayer] else 1)
+
+    def get_module(batched_forward: bool) -> DeepMILModule:
+        torch.manual_seed(0)
+        module = DeepMILModule(encoder=IdentityEncoder(input_dim=(num_encoding,)),
+                               label_column=TilesDataset.LABEL_COLUMN, n_classes=n_classes,
+                               pooling_layer=pooling_layer, num_features=num_features,
+                               batched_forward=batched_forward)
+        module.log = MagicMock()  # type: ignore
+        return module.eval()
+
+    bag_sizes = [3, 7, 1, 4]
+    batch = {TilesDataset.SLIDE_ID_COLUMN: [[str(i)] * size for i, size in enumerate(bag_sizes)],
+             TilesDataset.TILE_ID_COLUMN: [[f"{i}-{j}" for j in range(size)] for i, size in enumerate(bag_sizes)],
+             TilesDataset.PATH_COLUMN: [[f"{i}-{j}.png" for j in range(size)] for i, size in enumerate(bag_sizes)],
+             TilesDataset.IMAGE_COLUMN: [rand(size, num_encoding) for size in bag_sizes],
+             TilesDataset.LABEL_COLUMN: [randint(max(n_classes, 2), size=(1,)).expand(size) for size in bag_sizes]}
+
+    with torch.no_grad():
+        results = get_module(batched_forward=True)._shared_step(batch, 0, 'val')
+        expected_results = get_module(batched_forward=False)._shared_step(batch, 0, 'val')
+    for key in [ResultsKey.LOSS, ResultsKey.PROB, ResultsKey.CLASS_PROBS, ResultsKey.PRED_LABEL]:
+        assert allclose(results[key], expected_results[key], atol=1e-6), key
+    for attn, expected_attn in zip(results[ResultsKey.BAG_ATTN], expected_results[ResultsKey.BAG_ATTN]):
+        assert allclose(attn.view(expected_attn.shape), expected_attn, atol=1e-6)
+
+
+def _get_top_k_module(inference_top_k: Optional[int], attention_dims: int = 2, **kwargs: Any) -> DeepMILModule:
+    torch.manual_seed(0)
+    module = DeepMILModule(encoder=IdentityEncoder(input_dim=(8,)), label_column=TilesDataset.LABEL_COLUMN,
+                           n_classes=3, pooling_layer=AttentionLayer(8, 5, attention_dims),
+                           num_features=8 * attention_dims,
+                           inference_top_k=inference_top_k, **kwargs)
+    module.log = MagicMock()  # type: ignore
+    return module.eval()
+
+
+def _get_bags_batch(bag_sizes: List[int], first_slide_idx: int = 0) -> Dict[str, List]:
+    slide_ids = [str(first_slide_idx + i) for i in range(len(bag_sizes))]
+    return {TilesDataset.SLIDE_ID_COLUMN: [[slide_id] * size for slide_id, size in zip(slide_ids, bag_sizes)],
+            TilesDataset.TILE_ID_COLUMN: [[f"{slide_id}-{j}" for j in range(size)]
+                                          for slide_id, size in zip(slide_ids, bag_sizes)],
+            TilesDataset.PATH_COLUMN: [[f"{slide_id}-{j}.png" for j in range(size)]
+                                       for slide_id, size in zip(slide_ids, bag_sizes)],
+            TilesDataset.IMAGE_COLUMN: [rand(size, 8) for size in bag_sizes],
+            TilesDataset.LABEL_COLUMN: [randint(3, size=(1,)).expand(size) for size in bag_sizes]}
+
+
+def test_top_k_inference(tmp_path: Path) -> None:
+    bag_sizes = [2, 6, 5]
+    batch = _get_bags_batch(bag_sizes)
+    module = _get_top_k_module(inference_top_k=3, report_pruning_deviation=True)
+    with torch.no_grad():
+        full_results = module._shared_step(batch, 0, 'val')
+        results = module._shared_step(batch, 0, 'test')
+        # Bags at most as large as k are processed whole
+        assert allclose(results[ResultsKey.CLASS_PROBS][0], full_results[ResultsKey.CLASS_PROBS][0])
+        assert allclose(results[ResultsKey.BAG_ATTN][0], full_results[ResultsKey.BAG_ATTN][0])
+        for i in [1, 2]:
+            images = batch[TilesDataset.IMAGE_COLUMN][i]
+            attn = results[ResultsKey.BAG_ATTN][i]
+            assert attn.shape == full_results[ResultsKey.BAG_ATTN][i].shape
+            selected = attn[0] > 0
+            assert selected.sum() == 3
+            # The selected tiles have the highest attention in the first pass
+            scores = module.get_screening_scores(images)
+            assert scores[selected].min() >= scores[~selected].max()
+            expected_logit, expected_attn = module(images[selected])
+            assert allclose(results[ResultsKey.CLASS_PROBS][i], module.activation_fn(expected_logit).view(-1))
+            assert allclose(attn[:, selected], expected_attn)
+
+    assert [deviation[ResultsKey.SLIDE_ID] for deviation in module.pruning_deviations] == ["0", "1", "2"]
+    assert [deviation['num_selected_tiles'] for deviation in module.pruning_deviations] == [2, 3, 3]
+    assert module.pruning_deviations[0]['max_prob_deviation'] == pytest.approx(0, abs=1e-6)
+    assert module.pruning_deviations[0]['same_prediction']
+    assert module.pruning_deviations[0]['attention_recall'] == pytest.approx(1)
+    assert all(0 < deviation['attention_recall'] < 1 for deviation in module.pruning_deviations[1:])
+    pruning_metrics = module.save_pruning_deviation_report(tmp_path)
+    assert pruning_metrics['pruning_same_prediction'] >= 1 / len(bag_sizes)
+    assert len(pd.read_csv(tmp_path / 'pruning_deviation.csv')) == len(bag_sizes)
+
+    with pytest.raises(ValueError, match="inference_top_k"):
+        _get_top_k_module(inference_top_k=0)
+
+
+def test_screening_downscale() -> None:
+    module = _get_top_k_module(inference_top_k=2, screening_downscale=4)
+    module.encoder = nn.Sequential(nn.Conv2d(3, 8, kernel_size=3), nn.AdaptiveAvgPool2d(1), nn.Flatten())
+    images = rand(5, 3, 16, 16)
+    assert module.get_screening_scores(images).shape == (5,)
+    logit, attn, selected_indices = module.forward_top_k(images)
+    assert logit.shape == (1, 3)
+    assert attn.shape == (2, 5)
+    assert selected_indices.tolist() == sorted(selected_indices.tolist()) and len(selected_indices) == 2
+
+    # Without finetuning, tiles are encoded at full resolution in the datamodule
+    with pytest.raises(ValueError, match="screening_downscale requires is_finetune"):
+        DeepSMILECrck(screening_downscale=4).validate()
+    DeepSMILECrck(screening_downscale=4, is_finetune=True).validate()
+
+
+def test_top_k_inference_transformer_cost() -> None:
+    torch.manual_seed(0)
+    module = DeepMILModule(encoder=IdentityEncoder(input_dim=(8,)), label_column=TilesDataset.LABEL_COLUMN,
+                           n_classes=3, pooling_layer=TransformerPooling(num_layers=2, num_heads=2,
+                                                                         dim_representation=8),
+                           num_features=8, inference_top_k=20).eval()
+    images = rand(400, 8)
+
+    def count_flops(forward: Callable[[], Any]) -> int:
+        with torch.no_grad(), torch.profiler.profile(with_flops=True) as profiler:
+            forward()
+        return sum(event.flops for event in profiler.key_averages())
+
+    # The first pass only uses the attention of the cls token in the first layer, not full self-attention
+    scores = module.get_screening_scores(images)
+    expected_scores = module.aggregation_fn.get_screening_attention(images).view(-1)  # type: ignore
+    assert allclose(scores, expected_scores)
+    _, _, selected_indices = module.forward_top_k(images)
+    assert set(selected_indices.tolist()) == set(scores.topk(20).indices.tolist())
+    full_flops = count_flops(lambda: module(images))
+    assert count_flops(lambda: module.forward_top_k(images)) < full_flops / 10
+
+
+def test_save_test_results(tmp_path: Path) -> None:
+    module = _get_top_k_module(inference_top_k=None, attention_dims=1, outputs_path=tmp_path)
+    module.trainer = MagicMock(world_size=1)  # type: ignore
+    batches = [_get_bags_batch([2, 6], first_slide_idx=0), _get_bags_batch([5], first_slide_idx=2)]
+    with torch.no_grad():
+        for batch_idx, batch in enumerate(batches):
+            results = module.test_step(batch, batch_idx)
+            # Encoded features are not kept in memory until the end of the epoch
+            assert ResultsKey.IMAGE not in results
+
+            # Rows of each slide are appended as they arrive, so partial outputs are available
+            df = pd.read_csv(tmp_path / TEST_OUTPUT_CSV_FILENAME, index_col=0)
+            assert len(df) == sum(len(tile_ids) for batch in batches[:batch_idx + 1]
+                                  for tile_ids in batch[TilesDataset.TILE_ID_COLUMN])
+    assert df.index.tolist() == list(range(len(df)))
+    assert df[ResultsKey.TILE_ID].tolist() == [tile_id for batch in batches
+                                               for tile_ids in batch[TilesDataset.TILE_ID_COLUMN]
+                                               for tile_id in tile_ids]
+    assert {f"{ResultsKey.CLASS_PROBS}{i}" for i in range(3)} <= set(df.columns)
+    for batch in batches:
+        for slide_ids, images in zip(batch[TilesDataset.SLIDE_ID_COLUMN], batch[TilesDataset.IMAGE_COLUMN]):
+            features = torch.load(tmp_path / TEST_ENCODED_FEATURES_DIRNAME / f"{slide_ids[0]}.pt")
+            assert torch.equal(features, images)
+
+    # Outputs of a previous test epoch are overwritten
+    module.on_test_epoch_start()
+    with torch.no_grad():
+        module.test_step(batches[1], 0)
+    assert len(pd.read_csv(tmp_path / TEST_OUTPUT_CSV_FILENAME, index_col=0)) == 5
+    assert [path.name for path in (tmp_path / TEST_ENCODED_FEATURES_DIRNAME).iterdir()] == ["2.pt"]
+
+
+def test_save_test_results_distributed(tmp_path: Path) -> None:
+    # Ranks of a distributed run write to separate directories, merged on rank zero at the end of the epoch
+    (tmp_path / TEST_OUTPUT_CSV_FILENAME).write_text("stale outputs of a previous run")
+    batches = [_get_bags_batch([2, 6], first_slide_idx=0), _get_bags_batch([5], first_slide_idx=2)]
+    modules = []
+    for rank, batch in enumerate(batches):
+        module = _get_top_k_module(inference_top_k=None, attention_dims=1, outputs_path=tmp_path)
+        module.trainer = MagicMock(world_size=2, global_rank=rank)  # type: ignore
+        module.on_test_epoch_start()
+        with torch.no_grad():
+            module.test_step(batch, 0)
+        modules.append(module)
+    # Each rank numbers its rows from zero, without touching the files of other ranks
+    for rank, batch in enumerate(batches):
+        rank_path = tmp_path / f"{TEST_RANK_OUTPUTS_DIRNAME_PREFIX}{rank}"
+        rank_df = pd.read_csv(rank_path / TEST_OUTPUT_CSV_FILENAME, index_col=0)
+        assert rank_df.index.tolist() == list(range(sum(map(len, batch[TilesDataset.TILE_ID_COLUMN]))))
+
+    modules[1].merge_test_results()
+    assert (tmp_path / TEST_OUTPUT_CSV_FILENAME).read_text() == "stale outputs of a previous run"
+    modules[0].merge_test_results()
+    df = pd.read_csv(tmp_path / TEST_OUTPUT_CSV_FILENAME, index_col=0)
+    assert df.index.tolist() == list(range(len(df)))
+    assert df[ResultsKey.TILE_ID].tolist() == [tile_id for batch in batches
+                                               for tile_ids in batch[TilesDataset.TILE_ID_COLUMN]
+                                               for tile_id in tile_ids]
+    features_filenames = sorted(path.name for path in (tmp_path / TEST_ENCODED_FEATURES_DIRNAME).iterdir())
+    assert features_filenames == ["0.pt", "1.pt", "2.pt"]
+    assert not list(tmp_path.glob(f"{TEST_RANK_OUTPUTS_DIRNAME_PREFIX}*"))
+
+
+def _get_report_results(tmp_path: Path, n_slides: int = 3, bag_size: int = 4) -> Dict[str, List]:
+    results: Dict[str, List] = {key: [] for key in [ResultsKey.SLIDE_ID, ResultsKey.IMAGE_PATH, ResultsKey.BAG_ATTN,
+                                                    ResultsKey.CLASS_PROBS, ResultsKey.TRUE_LABEL,
+                                                    ResultsKey.TILE_X, ResultsKey.TILE_Y]}
+    rng = np.random.default_rng(0)
+    for slide_idx in range(n_slides):
+        paths = []
+        for tile_idx in range(bag_size):
+            paths.append(str(tmp_path / f"tile_{slide_idx}_{tile_idx}.png"))
+            Image.fromarray(rng.integers(0, 255, (8, 8, 3), dtype=np.uint8)).save(paths[-1])
+        results[ResultsKey.SLIDE_ID].append([f"slide_{slide_idx}"] * bag_size)
+        results[ResultsKey.IMAGE_PATH].append(paths)
+        results[ResultsKey.BAG_ATTN].append(torch.softmax(randn(1, bag_size), dim=1))
+        results[ResultsKey.CLASS_PROBS].append(torch.tensor([0.7, 0.3]))
+        results[ResultsKey.TRUE_LABEL].append(torch.tensor([slide_idx % 2]))
+        results[ResultsKey.TILE_X].append(torch.arange(bag_size) * 224)
+        results[ResultsKey.TILE_Y].append(torch.zeros(bag_size, dtype=torch.long))
+    return results
+
+
+def _mock_load_image_dict(sample: Dict, level: int, margin: int) -> Dict:
+    sample[SlideKey.IMAGE] = np.full((3, 32, 256), fill_value=200, dtype=np.uint8)
+    sample[SlideKey.LOCATION] = [0, 0]
+    return sample
+
+
+def test_save_report_figures(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    results = _get_report_results(tmp_path)
+    selected_tiles = select_k_tiles(results, n_slides=2, n_tiles=2, label=0)
+    slide_dataset = MagicMock(get_slide_by_id=lambda slide_id: {SlideKey.SLIDE_ID: slide_id})
+    monkeypatch.setattr(deepmil, 'load_image_dict', _mock_load_image_dict)
+
+    figure_files = {}
+    for num_figure_workers in [0, 2]:
+        module = _get_top_k_module(inference_top_k=None, num_figure_workers=num_figure_workers)
+        fig_path = tmp_path / f"fig_{num_figure_workers}"
+        for case in ['TN', 'FP']:
+            (fig_path / case).mkdir(parents=True)
+        tiles_figures = [(tiles, 'TN_top', fig_path / 'TN' / f'{tiles[0]}_top.png') for tiles in selected_tiles]
+        # Slide figures are rendered once, and saved in each report folder the slide appears in
+        slide_folder_paths = {'slide_0': [fig_path / 'TN', fig_path / 'FP'], 'slide_2': [fig_path / 'TN']}
+        if num_figure_workers == 0:
+            module.slide_dataset = slide_dataset
+        module.save_report_figures(results, tiles_figures, slide_folder_paths)
+        figure_files[num_figure_workers] = {path.relative_to(fig_path): path.read_bytes()
+                                            for path in fig_path.rglob("*.png")}
+
+    assert set(figure_files[0]) == {Path('TN', f'{slide}_{name}.png') for slide in ['slide_0', 'slide_2']
+                                    for name in ['top', 'thumbnail', 'heatmap']} | \
+        {Path('FP', f'slide_0_{name}.png') for name in ['thumbnail', 'heatmap']}
+    assert figure_files[0][Path('TN', 'slide_0_heatmap.png')] == figure_files[0][Path('FP', 'slide_0_heatmap.png')]
+    # Figures rendered in worker processes are identical
+    assert figure_files[2] == {path: data for path, data in figure_files[0].items() if path.name.endswith('_top.png')}
+
+
+@pytest.mark.parametrize("num_figure_workers", [None, 2])
+def test_save_report_figures_num_workers(num_figure_workers: Optional[int], tmp_path: Path,
+                                         monkeypatch: pytest.MonkeyPatch) -> None:
+    executor = MagicMock()
+    monkeypatch.setattr(deepmil, 'ProcessPoolExecutor', executor)
+    monkeypatch.setattr(os, 'cpu_count', lambda: 64)
+    module = _get_top_k_module(inference_top_k=None, num_figure_workers=num_figure_workers)
+    module.save_report_figures(_get_report_results(tmp_path), [], {})
+    # Figure workers are capped by default, as each may load a whole slide
+    expected_num_workers = DEFAULT_MAX_FIGURE_WORKERS if num_figure_workers is None else num_figure_workers
+    executor.assert_called_once_with(expected_num_workers)
+
+
+@pytest.mark.parametrize("raster_heatmaps", [None, False, True])
+def test_save_report_figures_raster_heatmaps(raster_heatmaps: Optional[bool], tmp_path: Path,
+                                             monkeypatch: pytest.MonkeyPatch) -> None:
+    results = _get_report_results(tmp_path, n_slides=1)
+    monkeypatch.setattr(deepmil, 'load_image_dict', _mock_load_image_dict)
+    plot_heatmap_overlay = MagicMock(return_value=plt.figure())
+    monkeypatch.setattr(deepmil, 'plot_heatmap_overlay', plot_heatmap_overlay)
+    kwargs = {} if raster_heatmaps is None else {'raster_heatmaps': raster_heatmaps}
+    module = _get_top_k_module(inference_top_k=None, num_figure_workers=0, **kwargs)
+    module.slide_dataset = MagicMock(get_slide_by_id=lambda slide_id: {SlideKey.SLIDE_ID: slide_id})
+    module.save_report_figures(results, [], {'slide_0': [tmp_path]})
+    # Heatmaps are drawn with one patch per tile unless rasterisation is enabled
+    assert plot_heatmap_overlay.call_args[1]['raster'] is bool(raster_heatmaps)
+
+
 def move_batch_to_expected_device(batch: Dict[str, List], use_gpu: bool) -> Dict:
     device = "cuda" if use_gpu else "cpu"
     return {
@@ -237,7 +528,7 @@ CONTAINER_DATASET_DIR = {
 @pytest.mark.parametrize("container_type", [DeepSMILEPanda,
                                             DeepSMILECrck])
 @pytest.mark.parametrize("use_gpu", [True, False])
-def test_container(container_type: Type[LightningContainer], use_gpu: bool) -> None:
+def test_container(container_type: Type[LightningContainer], use_gpu: bool, tmp_path: Path) -> None:
     dataset_dir = CONTAINER_DATASET_DIR[container_type]
     if not os.path.isdir(dataset_dir):
         pytest.skip(
@@ -256,6 +547,7 @@ def test_container(container_type: Type[LightningContainer], use_gpu: bool) -> N
     data_module: TilesDataModule = container.get_data_module()  # type: ignore
     data_module.max_bag_size = 10
     module = container.create_model()
+    module.outputs_path = tmp_path
     if use_gpu:
         module.cuda()
 
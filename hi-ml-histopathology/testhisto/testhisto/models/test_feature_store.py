@@ -0,0 +1,131 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+import gc
+import pickle
+from pathlib import Path
+from typing import Callable, Tuple
+
+import numpy as np
+import pytest
+import torch
+from torch import nn
+
+from histopathology.models.encoders import TileEncoder
+from histopathology.models.feature_store import FEATURES_SUFFIX, TileFeatureStore, get_feature_namespace
+from histopathology.models.transforms import EncodeTilesBatchd
+
+TILE_SIZE = 4
+
+
+class MockEncoder(TileEncoder):
+    def __init__(self, n_encoded_tiles: int = 0) -> None:
+        super().__init__(tile_size=TILE_SIZE)
+        self.n_encoded_tiles = n_encoded_tiles
+
+    def _get_encoder(self) -> Tuple[Callable, int]:
+        return nn.Sequential(nn.Flatten(), nn.Linear(3 * TILE_SIZE ** 2, 5)), 5
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        self.n_encoded_tiles += len(images)
+        return super().forward(images)
+
+
+def _get_encoder(seed: int = 0) -> MockEncoder:
+    torch.manual_seed(seed)
+    return MockEncoder()
+
+
+def test_feature_namespace() -> None:
+    namespace = get_feature_namespace(_get_encoder(), "dataset")
+    assert get_feature_namespace(_get_encoder(), "dataset") == namespace
+    # Different weights, input shape, or tiles dataset
+    assert get_feature_namespace(_get_encoder(seed=1), "dataset") != namespace
+    encoder = _get_encoder()
+    encoder.input_dim = (3, 2 * TILE_SIZE, 2 * TILE_SIZE)
+    assert get_feature_namespace(encoder, "dataset") != namespace
+    assert get_feature_namespace(_get_encoder(), "other_dataset") != namespace
+
+
+@pytest.mark.parametrize('tile_ids', [["a", "b", "c", "d"], torch.arange(4), np.arange(4)])
+def test_feature_store(tmp_path: Path, tile_ids: list) -> None:
+    store = TileFeatureStore(tmp_path)
+    features = torch.randn(4, 5)
+    found, stored_features = store.lookup(tile_ids)
+    assert not found.any() and stored_features is None
+
+    # Pending features are found before being saved
+    store.add(tile_ids[:3], features[:3])
+    assert not list(tmp_path.iterdir())
+    found, stored_features = store.lookup(tile_ids.flip(0) if isinstance(tile_ids, torch.Tensor) else tile_ids[::-1])
+    assert found.tolist() == [False, True, True, True]
+    assert torch.equal(stored_features, features[:3].flip(0))  # type: ignore
+
+    # Another process sees features saved before its first lookup, or before refreshing
+    store.flush()
+    other_store = TileFeatureStore(tmp_path)
+    store.add(tile_ids[3:], features[3:])
+    store.flush()
+    found, stored_features = other_store.lookup(tile_ids)
+    assert found.all()
+    assert torch.equal(stored_features, features)  # type: ignore
+
+    with pytest.raises(ValueError, match="tile IDs"):
+        store.add(tile_ids[:2], features)
+
+
+def test_feature_store_chunks(tmp_path: Path) -> None:
+    features = torch.randn(10, 5)
+    store = TileFeatureStore(tmp_path, min_chunk_size=4)
+    other_store = TileFeatureStore(tmp_path)
+    assert not other_store.lookup(range(10))[0].any()
+
+    # Features are saved in chunks of at least min_chunk_size tiles
+    for start in range(0, 10, 2):
+        store.add(range(start, start + 2), features[start:start + 2])
+    assert len(list(tmp_path.glob("*" + FEATURES_SUFFIX))) == 2
+    # Pending features are saved when the store is pickled, e.g. for data loader workers
+    unpickled_store = pickle.loads(pickle.dumps(store))
+    assert len(list(tmp_path.glob("*" + FEATURES_SUFFIX))) == 3
+    found, stored_features = unpickled_store.lookup(range(10))
+    assert found.all()
+    assert torch.equal(stored_features, features)  # type: ignore
+
+    # The directory is only listed again when refreshing
+    assert not other_store.lookup(range(10))[0].any()
+    other_store.refresh()
+    assert other_store.lookup(range(10))[0].all()
+
+    # Pending features are saved when the store is garbage collected
+    store.add([10], torch.randn(1, 5))
+    del store, unpickled_store
+    gc.collect()
+    assert TileFeatureStore(tmp_path).lookup([10])[0].all()
+
+
+def test_encode_tiles_with_feature_store(tmp_path: Path) -> None:
+    images = torch.rand(6, 3, TILE_SIZE, TILE_SIZE)
+    tile_ids = [f"tile_{i}" for i in range(6)]
+    encoder = _get_encoder()
+    expected_features = EncodeTilesBatchd('image', encoder)({'image': images})['image']
+    encoder.n_encoded_tiles = 0
+
+    store = TileFeatureStore.for_encoder(tmp_path, encoder, "dataset")
+    encode = EncodeTilesBatchd('image', encoder, chunk_size=2, feature_store=store)
+    sample = encode({'image': images[[0, 2, 4]], 'tile_id': tile_ids[0:6:2]})
+    assert torch.allclose(sample['image'], expected_features[[0, 2, 4]])
+    assert encoder.n_encoded_tiles == 3
+    store.flush()
+
+    # Only tiles missing from the store are encoded, also by a different transform of an equal encoder
+    encoder = _get_encoder()
+    store = TileFeatureStore.for_encoder(tmp_path, encoder, "dataset")
+    encode = EncodeTilesBatchd('image', encoder, feature_store=store)
+    sample = encode({'image': images, 'tile_id': tile_ids})
+    assert torch.allclose(sample['image'], expected_features)
+    assert encoder.n_encoded_tiles == 3
+    sample = encode({'image': images, 'tile_id': tile_ids})
+    assert torch.allclose(sample['image'], expected_features)
+    assert encoder.n_encoded_tiles == 3
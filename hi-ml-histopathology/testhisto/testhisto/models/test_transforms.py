@@ -5,9 +5,10 @@
 
 import os
 from pathlib import Path
-from typing import Callable, Sequence, Union
+from typing import Callable, List, Sequence, Tuple, Union
 import numpy as np
 
+import PIL
 import pytest
 import torch
 from monai.data.dataset import CacheDataset, Dataset, PersistentDataset
@@ -15,15 +16,16 @@ from monai.transforms import Compose
 from torch.utils.data import Dataset as TorchDataset
 from torch.utils.data import Subset
 from torchvision.models import resnet18
-from torchvision.transforms import RandomHorizontalFlip
+from torchvision.transforms import Normalize, RandomHorizontalFlip
 
 from health_ml.utils.bag_utils import BagDataset
 from health_ml.utils.data_augmentations import HEDJitter
 
 from histopathology.datasets.default_paths import TCGA_CRCK_DATASET_DIR
 from histopathology.datasets.tcga_crck_tiles_dataset import TcgaCrck_TilesDataset
-from histopathology.models.encoders import ImageNetEncoder
+from histopathology.models.encoders import ImageNetEncoder, TileEncoder
 from histopathology.models.transforms import (EncodeTilesBatchd, LoadTiled, LoadTilesBatchd, Subsampled,
+                                              load_image_as_tensor, load_image_stack_as_tensor,
                                               transform_dict_adaptor)
 
 from testhisto.utils.utils_testhisto import assert_dicts_equal
@@ -161,6 +163,81 @@ def test_encode_tiles(tmp_path: Path, use_gpu: bool, chunk_size: int) -> None:
                                         cache_subdir="TCGA-CRCk_embed_cache")
 
 
+def _save_mock_tiles(tmp_path: Path, n_tiles: int, mode: str) -> List[str]:
+    rng = np.random.default_rng(0)
+    shape = (8, 6, 3) if mode == 'RGB' else (8, 6)
+    image_paths = []
+    for i in range(n_tiles):
+        image_path = tmp_path / f"{i}.png"
+        PIL.Image.fromarray(rng.integers(0, 256, size=shape, dtype=np.uint8), mode).save(image_path)
+        image_paths.append(str(image_path))
+    return image_paths
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'L'])
+@pytest.mark.parametrize('num_workers, chunk_size', [(0, 16), (2, 1), (3, 4)])
+def test_load_image_stack(tmp_path: Path, mode: str, num_workers: int, chunk_size: int) -> None:
+    image_paths = _save_mock_tiles(tmp_path, n_tiles=11, mode=mode)
+    expected_images = torch.stack([load_image_as_tensor(image_path) for image_path in image_paths])
+
+    images = load_image_stack_as_tensor(image_paths, num_workers=num_workers, chunk_size=chunk_size)
+    assert images.dtype == torch.float32
+    assert torch.equal(images, expected_images)
+
+    uint8_images = load_image_stack_as_tensor(image_paths, num_workers=num_workers, chunk_size=chunk_size,
+                                              as_uint8=True)
+    assert uint8_images.dtype == torch.uint8
+    assert torch.equal(uint8_images.to(torch.float32).div(255), expected_images)
+
+
+def test_encode_uint8_tiles(tmp_path: Path) -> None:
+    image_paths = _save_mock_tiles(tmp_path, n_tiles=5, mode='RGB')
+    encoder = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(3 * 8 * 6, 4))
+    encode_transform = EncodeTilesBatchd('image', encoder, chunk_size=2)  # type: ignore
+    float_transform = Compose([LoadTilesBatchd('image', num_workers=2, chunk_size=2), encode_transform])
+    uint8_transform = Compose([LoadTilesBatchd('image', num_workers=2, chunk_size=2, as_uint8=True),
+                               encode_transform])
+
+    float_sample = float_transform({'image': image_paths})
+    uint8_sample = uint8_transform({'image': image_paths})
+    assert torch.equal(uint8_sample['image'], float_sample['image'])
+
+
+requires_gpu = pytest.mark.skipif(not torch.cuda.is_available(), reason="No GPU available")
+
+
+class NormalizingEncoder(TileEncoder):
+    def _get_preprocessing(self) -> Callable:
+        return Normalize(mean=[0.4, 0.5, 0.6], std=[0.1, 0.2, 0.3])
+
+    def _get_encoder(self) -> Tuple[Callable, int]:
+        return torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(int(np.prod(self.input_dim)), 4)), 4
+
+
+@pytest.mark.parametrize('encoder_type', ['tile_encoder', 'module'])
+@pytest.mark.parametrize('chunk_size', [0, 3])
+@pytest.mark.parametrize('use_gpu', [False, pytest.param(True, marks=requires_gpu)])
+def test_encode_tiles_pipelined(encoder_type: str, chunk_size: int, use_gpu: bool) -> None:
+    torch.manual_seed(0)
+    images = torch.randint(256, size=(10, 3, 8, 6), dtype=torch.uint8)
+    encoder = NormalizingEncoder(input_dim=(3, 8, 6))
+    if encoder_type == 'module':
+        encoder = torch.nn.Sequential(encoder)  # type: ignore
+    if use_gpu:
+        encoder.cuda()
+    expected_embeddings = EncodeTilesBatchd('image', encoder, chunk_size=chunk_size)({'image': images})['image']
+
+    num_threads = torch.get_num_threads()
+    encode_transform = EncodeTilesBatchd('image', encoder, chunk_size=chunk_size,  # type: ignore
+                                         pipelined=True, num_threads=1)
+    for _ in range(2):
+        embeddings = encode_transform({'image': images})['image']
+        assert torch.equal(embeddings, expected_embeddings)
+    assert torch.get_num_threads() == num_threads
+    assert encode_transform.num_encoded_tiles == 2 * len(images)
+    assert encode_transform.tiles_per_second > 0
+
+
 @pytest.mark.parametrize('include_non_indexable', [True, False])
 @pytest.mark.parametrize('allow_missing_keys', [True, False])
 def test_subsample(include_non_indexable: bool, allow_missing_keys: bool) -> None:
@@ -204,6 +281,9 @@ def test_subsample(include_non_indexable: bool, allow_missing_keys: bool) -> Non
         assert len(data[key]) == batch_size  # type: ignore
         assert len(sub_data[key]) == min(max_size, batch_size)  # type: ignore
 
+    # Check that elements are sampled without replacement
+    assert len(set(sub_data['indices'])) == len(sub_data['indices'])
+
     # Check contents of subsampled elements
     for key in ['tensor_1d', 'tensor_2d', 'array_1d', 'array_2d', 'list']:
         for idx, elem in zip(sub_data['indices'], sub_data[key]):
@@ -0,0 +1,308 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import pytest
+import tifffile
+import torch
+
+from histopathology.models.transforms import LoadTilesBatchd, load_image_as_tensor, load_image_stack_as_tensor
+from histopathology.preprocessing import create_tiles_dataset, tiling
+from histopathology.preprocessing.create_tiles_dataset import (estimate_tile_occupancies, generate_tiles, process_slide,
+                                                               select_tiles)
+from histopathology.preprocessing.loading import segment_foreground
+from histopathology.preprocessing.slide_journal import (DATASET_CSV_FILENAME, JOURNAL_FILENAME, TILE_INDEX_FILENAME,
+                                                        get_temp_path, is_slide_completed, read_completed_slides)
+from histopathology.utils.naming import SlideKey, TileKey
+from histopathology.utils.tile_shards import SHARD_FILENAME, TileFormat
+
+TILE_SIZE = 32
+LEVEL = 1
+
+
+@pytest.fixture
+def mock_slide_path(tmp_path: Path) -> Path:
+    """Create a small multi-resolution TIFF slide with a rectangular foreground region."""
+    rng = np.random.default_rng(0)
+    image = np.full((1024, 1536, 3), 240, dtype=np.uint8)
+    image[300:700, 400:1100] = rng.integers(0, 120, size=(400, 700, 3), dtype=np.uint8)
+    slide_path = tmp_path / "mock_slide.tiff"
+    with tifffile.TiffWriter(slide_path) as tiff:
+        tiff.write(image, tile=(128, 128), photometric='rgb', compression='deflate', subifds=0)
+        tiff.write(image[::4, ::4], tile=(128, 128), photometric='rgb', compression='deflate', subfiletype=1)
+        tiff.write(image[::16, ::16], tile=(16, 16), photometric='rgb', compression='deflate', subfiletype=1)
+    return slide_path
+
+
+def _get_sample(slide_path: Path) -> Dict[SlideKey, Any]:
+    return {SlideKey.SLIDE_ID: "mock_slide",
+            SlideKey.IMAGE: str(slide_path),
+            SlideKey.LABEL: 1,
+            SlideKey.METADATA: {'provider': 'mock'}}
+
+
+def _process_slide(slide_path: Path, output_dir: Path, strip_rows: int = 0,
+                   plan_occupancy_threshold: Optional[float] = None,
+                   tile_format: TileFormat = TileFormat.PNG, writer_threads: int = 0,
+                   pyramid_levels: Sequence[Tuple[int, int]] = ()) -> Path:
+    process_slide(_get_sample(slide_path), level=LEVEL, margin=0, tile_size=TILE_SIZE,
+                  foreground_threshold=None, occupancy_threshold=0.05, output_dir=output_dir,
+                  strip_rows=strip_rows, plan_occupancy_threshold=plan_occupancy_threshold,
+                  tile_format=tile_format, writer_threads=writer_threads, pyramid_levels=pyramid_levels)
+    return output_dir / "mock_slide"
+
+
+@pytest.mark.parametrize("stride", [None, 8, 16])
+def test_generate_tiles(stride: Optional[int]) -> None:
+    rng = np.random.default_rng(0)
+    slide_image = np.full((3, 50, 70), 250, dtype=np.uint8)
+    slide_image[:, 10:30, 20:60] = rng.integers(0, 100, size=(3, 20, 40), dtype=np.uint8)
+    tile_size, foreground_threshold, occupancy_threshold = 16, 200., 0.1
+
+    # Reference: filter a copy of all tiles, as if they were independent images
+    all_tiles, all_locations = tiling.tile_array_2d(slide_image, tile_size, stride=stride, constant_values=255)
+    selected, all_occupancies = select_tiles(segment_foreground(all_tiles, foreground_threshold)[0],
+                                             occupancy_threshold)
+
+    image_tiles, tile_locations, occupancies, n_discarded = \
+        generate_tiles(slide_image, tile_size, foreground_threshold, occupancy_threshold, stride=stride)
+    assert 0 < len(image_tiles) < len(all_tiles)
+    assert n_discarded == len(all_tiles) - len(image_tiles)
+    assert np.array_equal(image_tiles, all_tiles[selected])
+    assert np.array_equal(tile_locations, all_locations[selected])
+    assert np.array_equal(occupancies, all_occupancies[selected])
+
+
+@pytest.mark.parametrize("stride", [None, 16])
+def test_generate_tiles_otsu_threshold(stride: Optional[int]) -> None:
+    rng = np.random.default_rng(2)
+    slide_image = np.full((3, 50, 70), 250, dtype=np.uint8)
+    slide_image[:, 10:30, 20:60] = rng.integers(0, 100, size=(3, 20, 40), dtype=np.uint8)
+    slide_image[:, 35:50] = rng.integers(150, 240, size=(3, 15, 70), dtype=np.uint8)
+    tile_size, occupancy_threshold = 16, 0.1
+
+    # Reference: segment all padded tiles together, estimating a single Otsu threshold on all of them
+    all_tiles, all_locations = tiling.tile_array_2d(slide_image, tile_size, constant_values=255)
+    all_foreground, threshold = segment_foreground(all_tiles, threshold=None)
+    selected, all_occupancies = select_tiles(all_foreground, occupancy_threshold)
+    # The padding changes the threshold, and the occupancies, if estimated on the unpadded image instead
+    unpadded_threshold = segment_foreground(slide_image, threshold=None)[1]
+    assert not np.array_equal(select_tiles(segment_foreground(all_tiles, unpadded_threshold)[0],
+                                           occupancy_threshold)[1], all_occupancies)
+
+    image_tiles, tile_locations, occupancies, _ = \
+        generate_tiles(slide_image, tile_size, None, occupancy_threshold, stride=stride)  # type: ignore
+    assert np.array_equal(image_tiles, all_tiles[selected])
+    assert np.array_equal(tile_locations, all_locations[selected])
+    assert np.array_equal(occupancies, all_occupancies[selected])
+
+
+@pytest.mark.parametrize("strip_rows", [1, 2, 100])
+def test_streaming_tiling_matches_full_roi(mock_slide_path: Path, tmp_path: Path, strip_rows: int) -> None:
+    full_slide_dir = _process_slide(mock_slide_path, tmp_path / "full", strip_rows=0)
+    strips_slide_dir = _process_slide(mock_slide_path, tmp_path / "strips", strip_rows=strip_rows)
+
+    full_csv = (full_slide_dir / "dataset.csv").read_text()
+    assert len(full_csv.splitlines()) > 1, "No tiles were saved"
+    assert (strips_slide_dir / "dataset.csv").read_text() == full_csv
+
+    full_tile_paths = sorted(path.relative_to(full_slide_dir) for path in full_slide_dir.glob("*.png"))
+    strips_tile_paths = sorted(path.relative_to(strips_slide_dir) for path in strips_slide_dir.glob("*.png"))
+    assert strips_tile_paths == full_tile_paths
+    for rel_path in full_tile_paths:
+        assert (strips_slide_dir / rel_path).read_bytes() == (full_slide_dir / rel_path).read_bytes()
+
+
+@pytest.mark.parametrize("strip_rows", [0, 2])
+@pytest.mark.parametrize("tile_format", [TileFormat.PNG, TileFormat.TAR])
+def test_async_tile_writing_matches_serial(mock_slide_path: Path, tmp_path: Path, strip_rows: int,
+                                           tile_format: TileFormat) -> None:
+    serial_slide_dir = _process_slide(mock_slide_path, tmp_path / "serial", strip_rows=strip_rows,
+                                      tile_format=tile_format)
+    async_slide_dir = _process_slide(mock_slide_path, tmp_path / "async", strip_rows=strip_rows,
+                                     tile_format=tile_format, writer_threads=3)
+
+    serial_csv = (serial_slide_dir / "dataset.csv").read_text()
+    assert len(serial_csv.splitlines()) > 1, "No tiles were saved"
+    assert (async_slide_dir / "dataset.csv").read_text() == serial_csv
+    assert (async_slide_dir / "failed_tiles.csv").read_text() == "tile_id\n"
+
+    if tile_format == TileFormat.PNG:
+        serial_tile_paths = sorted(path.relative_to(serial_slide_dir) for path in serial_slide_dir.glob("*.png"))
+        async_tile_paths = sorted(path.relative_to(async_slide_dir) for path in async_slide_dir.glob("*.png"))
+        assert async_tile_paths == serial_tile_paths
+        for rel_path in serial_tile_paths:
+            assert (async_slide_dir / rel_path).read_bytes() == (serial_slide_dir / rel_path).read_bytes()
+
+
+def test_estimate_tile_occupancies() -> None:
+    thumbnail_mask = np.zeros((8, 8), dtype=bool)
+    thumbnail_mask[2:4, 4:8] = True
+    # Thumbnail at scale 4 and target level at scale 1, so 4x4 tiles map to single thumbnail pixels
+    occupancies = estimate_tile_occupancies(thumbnail_mask, thumbnail_scale=4, origin=(0, 0), scale=1,
+                                            roi_shape=(32, 28), tile_size=4)
+    expected = np.zeros((8, 7))
+    expected[2:4, 4:7] = 1.
+    assert np.allclose(occupancies, expected)
+
+    # Same, for an ROI offset from the slide origin
+    occupancies = estimate_tile_occupancies(thumbnail_mask, thumbnail_scale=4, origin=(8, 16), scale=1,
+                                            roi_shape=(16, 16), tile_size=4)
+    expected = np.zeros((4, 4))
+    expected[:2, :] = 1.
+    assert np.allclose(occupancies, expected)
+
+    # Tiles only partly inside the ROI are weighted by their fraction inside it (padding is background)
+    occupancies = estimate_tile_occupancies(np.ones((8, 8), dtype=bool), thumbnail_scale=4, origin=(0, 0),
+                                            scale=1, roi_shape=(30, 32), tile_size=4)
+    assert occupancies.shape == (8, 8)
+    assert np.allclose(occupancies[[0, -1]], 0.75)
+    assert np.allclose(occupancies[1:-1], 1.)
+
+
+def test_planned_tiling_matches_full_roi(mock_slide_path: Path, tmp_path: Path) -> None:
+    full_slide_dir = _process_slide(mock_slide_path, tmp_path / "full")
+    planned_slide_dir = _process_slide(mock_slide_path, tmp_path / "planned", plan_occupancy_threshold=0.)
+
+    full_csv = (full_slide_dir / "dataset.csv").read_text()
+    assert len(full_csv.splitlines()) > 1, "No tiles were saved"
+    assert (planned_slide_dir / "dataset.csv").read_text() == full_csv
+
+    full_tile_paths = sorted(path.relative_to(full_slide_dir) for path in full_slide_dir.glob("*.png"))
+    planned_tile_paths = sorted(path.relative_to(planned_slide_dir) for path in planned_slide_dir.glob("*.png"))
+    assert planned_tile_paths == full_tile_paths
+    for rel_path in full_tile_paths:
+        assert (planned_slide_dir / rel_path).read_bytes() == (full_slide_dir / rel_path).read_bytes()
+
+
+def test_planned_tiling_skips_background(mock_slide_path: Path, tmp_path: Path) -> None:
+    with pytest.raises(ValueError):
+        _process_slide(mock_slide_path, tmp_path / "invalid", strip_rows=1, plan_occupancy_threshold=0.)
+
+    full_csv = (_process_slide(mock_slide_path, tmp_path / "full") / "dataset.csv").read_text()
+    # A strict planning threshold reads only interior tiles, which are a subset of the full output
+    planned_slide_dir = _process_slide(mock_slide_path, tmp_path / "planned", plan_occupancy_threshold=0.99)
+    planned_csv = (planned_slide_dir / "dataset.csv").read_text()
+    assert 1 < len(planned_csv.splitlines()) < len(full_csv.splitlines())
+    assert set(planned_csv.splitlines()) <= set(full_csv.splitlines())
+
+
+def test_sharded_tiles_match_png_tiles(mock_slide_path: Path, tmp_path: Path) -> None:
+    png_slide_dir = _process_slide(mock_slide_path, tmp_path / "png")
+    tar_slide_dir = _process_slide(mock_slide_path, tmp_path / "tar", tile_format=TileFormat.TAR)
+
+    assert not list(tar_slide_dir.glob("*.png"))
+    assert (tar_slide_dir / SHARD_FILENAME).is_file()
+
+    png_df = pd.read_csv(png_slide_dir / "dataset.csv")
+    tar_df = pd.read_csv(tar_slide_dir / "dataset.csv")
+    assert tar_df.drop(columns=TileKey.IMAGE).equals(png_df.drop(columns=TileKey.IMAGE))
+    assert all(tar_df[TileKey.IMAGE].str.startswith(f"mock_slide/{SHARD_FILENAME}/"))
+
+    png_paths = [str(tmp_path / "png" / path) for path in png_df[TileKey.IMAGE]]
+    tar_paths = [str(tmp_path / "tar" / path) for path in tar_df[TileKey.IMAGE]]
+    # Load bags in a different order from the one in which tiles were written to the shard
+    order = np.random.default_rng(0).permutation(len(tar_paths))
+    load_transform = LoadTilesBatchd(TileKey.IMAGE)
+    png_bag = load_transform({TileKey.IMAGE: [png_paths[i] for i in order]})[TileKey.IMAGE]
+    tar_bag = load_transform({TileKey.IMAGE: [tar_paths[i] for i in order]})[TileKey.IMAGE]
+    assert tar_bag.shape == (len(tar_paths), 3, TILE_SIZE, TILE_SIZE)
+    assert torch.equal(tar_bag, png_bag)
+    assert torch.equal(load_image_as_tensor(tar_paths[order[0]]), png_bag[0])
+
+
+def test_resume_partially_processed_slide(mock_slide_path: Path, tmp_path: Path) -> None:
+    clean_slide_dir = _process_slide(mock_slide_path, tmp_path / "clean")
+    clean_csv = (clean_slide_dir / DATASET_CSV_FILENAME).read_text()
+    assert read_completed_slides(tmp_path / "clean") == ["mock_slide"]
+    assert not get_temp_path(clean_slide_dir / DATASET_CSV_FILENAME).exists()
+
+    # Simulate a worker killed mid-slide, leaving a partial CSV and some stray tiles
+    resumed_slide_dir = tmp_path / "resumed" / "mock_slide"
+    resumed_slide_dir.mkdir(parents=True)
+    get_temp_path(resumed_slide_dir / DATASET_CSV_FILENAME).write_text(clean_csv.splitlines()[0])
+    (resumed_slide_dir / "99999x_99999y.png").write_bytes(b"")
+    assert not is_slide_completed(resumed_slide_dir)
+
+    _process_slide(mock_slide_path, tmp_path / "resumed")
+    assert is_slide_completed(resumed_slide_dir)
+    assert (resumed_slide_dir / DATASET_CSV_FILENAME).read_text() == clean_csv
+    assert not (resumed_slide_dir / "99999x_99999y.png").exists()
+    assert read_completed_slides(tmp_path / "resumed") == ["mock_slide"]
+
+    # Completed slides are skipped
+    (resumed_slide_dir / DATASET_CSV_FILENAME).write_text("completed")
+    _process_slide(mock_slide_path, tmp_path / "resumed")
+    assert (resumed_slide_dir / DATASET_CSV_FILENAME).read_text() == "completed"
+
+
+def test_resume_completed_slide_missing_from_journal(mock_slide_path: Path, tmp_path: Path) -> None:
+    # Simulate a worker killed after committing the CSV of slide "a", but before journaling it
+    output_dir = tmp_path / "dataset"
+    samples = [{**_get_sample(mock_slide_path), SlideKey.SLIDE_ID: slide_id} for slide_id in ["a", "b"]]
+    kwargs = dict(level=LEVEL, tile_size=TILE_SIZE, margin=0, foreground_threshold=None, occupancy_threshold=0.05)
+    process_slide(samples[0], output_dir=output_dir, **kwargs)  # type: ignore
+    # The journal only lists a slide whose outputs were since deleted
+    (output_dir / JOURNAL_FILENAME).write_text("deleted\n")
+
+    create_tiles_dataset.main(samples, output_dir, parquet_index=True, **kwargs)  # type: ignore
+    # The completed slide is skipped, and journaled before the remaining slide
+    assert read_completed_slides(output_dir) == ["deleted", "a", "b"]
+    # All completed slides of the dataset are merged and indexed, whatever the journal contains
+    merged_df = pd.read_csv(output_dir / DATASET_CSV_FILENAME)
+    assert merged_df[TileKey.SLIDE_ID].unique().tolist() == ["a", "b"]
+    pd.testing.assert_frame_equal(pd.read_parquet(output_dir / TILE_INDEX_FILENAME), merged_df)
+
+
+@pytest.mark.parametrize("tile_format", [TileFormat.PNG, TileFormat.TAR])
+def test_multi_level_tiling(mock_slide_path: Path, tmp_path: Path, tile_format: TileFormat) -> None:
+    with pytest.raises(ValueError):
+        _process_slide(mock_slide_path, tmp_path / "invalid", pyramid_levels=[(LEVEL, 2 * TILE_SIZE)])
+
+    single_slide_dir = _process_slide(mock_slide_path, tmp_path / "single")
+    # Level 0 tiles have half the footprint of the reference level 1 tiles (4x downsampled)
+    fine_tile_size = 2 * TILE_SIZE
+    multi_slide_dir = _process_slide(mock_slide_path, tmp_path / "multi", tile_format=tile_format,
+                                     pyramid_levels=[(0, fine_tile_size)])
+    single_df = pd.read_csv(single_slide_dir / "dataset.csv")
+    multi_df = pd.read_csv(multi_slide_dir / "dataset.csv")
+    assert set(multi_df[TileKey.LEVEL]) == {LEVEL, 0}
+    assert multi_df[TileKey.TILE_ID].is_unique
+
+    # The reference level is tiled exactly as in single-level mode
+    coarse_df = multi_df[multi_df[TileKey.LEVEL] == LEVEL].reset_index(drop=True)
+    assert all(coarse_df[TileKey.TILE_SIZE] == TILE_SIZE)
+    for column in [TileKey.TILE_X, TileKey.TILE_Y, TileKey.OCCUPANCY]:
+        assert coarse_df[column].equals(single_df[column])
+    coarse_images = load_image_stack_as_tensor([str(tmp_path / "multi" / path) for path in coarse_df[TileKey.IMAGE]])
+    single_images = load_image_stack_as_tensor([str(tmp_path / "single" / path) for path in single_df[TileKey.IMAGE]])
+    assert torch.equal(coarse_images, single_images)
+
+    # Finer tiles are aligned with the reference grid, in the same level 0 coordinate frame
+    fine_df = multi_df[multi_df[TileKey.LEVEL] == 0]
+    assert all(fine_df[TileKey.TILE_SIZE] == fine_tile_size)
+    assert len(fine_df) > len(coarse_df)
+    for column in [TileKey.TILE_X, TileKey.TILE_Y]:
+        assert all((fine_df[column] - coarse_df[column][0]) % fine_tile_size == 0)
+    fine_images = load_image_stack_as_tensor([str(tmp_path / "multi" / path) for path in fine_df[TileKey.IMAGE]])
+    assert fine_images.shape == (len(fine_df), 3, fine_tile_size, fine_tile_size)
+
+
+def test_multi_level_failed_tiles(mock_slide_path: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    def failing_save_image(array_chw: np.ndarray, path: Path) -> None:
+        raise IOError("Mock write error")
+
+    monkeypatch.setattr(create_tiles_dataset, 'save_image', failing_save_image)
+    with pytest.warns(UserWarning, match=r"tile mock_slide\.level0\."):
+        slide_dir = _process_slide(mock_slide_path, tmp_path, pyramid_levels=[(0, 2 * TILE_SIZE)])
+    failed_tiles = (slide_dir / "failed_tiles.csv").read_text().splitlines()
+    assert failed_tiles[0] == "tile_id"
+    # Failed tiles of both levels are recorded, without colliding
+    assert {tile.split('.')[0] for tile in failed_tiles[1:]} == {f"level{LEVEL}", "level0"}
+    assert len(set(failed_tiles[1:])) == len(failed_tiles) - 1
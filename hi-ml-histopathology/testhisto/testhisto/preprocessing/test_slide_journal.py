@@ -0,0 +1,81 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+from pathlib import Path
+from typing import Sequence
+
+import pandas as pd
+
+from histopathology.datasets.base_dataset import TilesDataset
+from histopathology.preprocessing.slide_journal import (DATASET_CSV_FILENAME, JOURNAL_FILENAME, TILE_INDEX_FILENAME,
+                                                        merge_dataset_csv_files, read_completed_slides,
+                                                        reconcile_journal, record_completed_slide, save_tile_index)
+
+
+def _create_slide_csvs(dataset_dir: Path, slide_ids: Sequence[str], n_tiles: int = 3) -> pd.DataFrame:
+    slide_dfs = []
+    for slide_index, slide_id in enumerate(slide_ids):
+        slide_df = pd.DataFrame({'slide_id': slide_id,
+                                 'tile_id': [f"{slide_id}.{i}" for i in range(n_tiles)],
+                                 'image': [f"{slide_id}/{i}.png" for i in range(n_tiles)],
+                                 'label': slide_index % 2,
+                                 'tile_x': range(n_tiles),
+                                 'tile_y': 0,
+                                 'occupancy': 0.5})
+        (dataset_dir / slide_id).mkdir(parents=True)
+        slide_df.to_csv(dataset_dir / slide_id / DATASET_CSV_FILENAME, index=False)
+        slide_dfs.append(slide_df)
+    return pd.concat(slide_dfs, ignore_index=True)
+
+
+def test_merge_dataset_csv_files_from_journal(tmp_path: Path) -> None:
+    expected_df = _create_slide_csvs(tmp_path, ["slide_b", "slide_a"])
+    for slide_id in ["slide_b", "slide_a"]:
+        record_completed_slide(tmp_path, slide_id)
+    # CSV of a slide missing from the journal, e.g. copied over by hand, is not merged
+    _create_slide_csvs(tmp_path, ["stray_slide"])
+
+    merged_csv = merge_dataset_csv_files(tmp_path)
+    assert merged_csv == tmp_path / DATASET_CSV_FILENAME
+    pd.testing.assert_frame_equal(pd.read_csv(merged_csv), expected_df)
+
+    # Explicit slide IDs take precedence over the journal
+    merged_df = pd.read_csv(merge_dataset_csv_files(tmp_path, slide_ids=["stray_slide"]))
+    assert merged_df['slide_id'].unique().tolist() == ["stray_slide"]
+
+
+def test_reconcile_journal(tmp_path: Path) -> None:
+    _create_slide_csvs(tmp_path, ["slide_a", "slide_b"])
+    record_completed_slide(tmp_path, "slide_b")
+    (tmp_path / "slide_c").mkdir()  # partially processed slide
+    reconcile_journal(tmp_path, ["slide_a", "slide_b", "slide_c", "slide_d"])
+    assert read_completed_slides(tmp_path) == ["slide_b", "slide_a"]
+    assert (tmp_path / JOURNAL_FILENAME).read_text().splitlines() == ["slide_b", "slide_a"]
+
+
+def test_merge_dataset_csv_files_without_journal(tmp_path: Path) -> None:
+    expected_df = _create_slide_csvs(tmp_path, ["slide_a", "slide_b"])
+    merged_df = pd.read_csv(merge_dataset_csv_files(tmp_path))
+    pd.testing.assert_frame_equal(merged_df, expected_df)
+
+
+def test_save_tile_index(tmp_path: Path) -> None:
+    _create_slide_csvs(tmp_path, ["slide_a", "slide_b"])
+    for slide_id in ["slide_a", "slide_b"]:
+        record_completed_slide(tmp_path, slide_id)
+
+    index_path = save_tile_index(tmp_path)
+    assert index_path == tmp_path / TILE_INDEX_FILENAME
+    merged_csv = merge_dataset_csv_files(tmp_path)
+    pd.testing.assert_frame_equal(pd.read_parquet(index_path), pd.read_csv(merged_csv))
+
+    class MockTilesDataset(TilesDataset):
+        SPLIT_COLUMN = None
+
+    parquet_dataset = MockTilesDataset(tmp_path, dataset_csv=index_path)
+    csv_dataset = MockTilesDataset(tmp_path)
+    assert len(parquet_dataset) == len(csv_dataset) == 6
+    for index in range(len(csv_dataset)):
+        assert parquet_dataset[index] == csv_dataset[index]
@@ -0,0 +1,63 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+import time
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+import pytest
+import tifffile
+
+from histopathology.preprocessing.slide_scheduler import (SLIDE_TIMINGS_FILENAME, estimate_slide_memory, run_slides,
+                                                          save_slide_timings)
+
+
+def test_estimate_slide_memory(tmp_path: Path) -> None:
+    slide_path = tmp_path / "slide.tiff"
+    with tifffile.TiffWriter(slide_path) as tiff:
+        tiff.write(np.zeros((256, 512, 3), dtype=np.uint8), tile=(64, 64), photometric='rgb', subifds=0)
+        tiff.write(np.zeros((64, 128, 3), dtype=np.uint8), tile=(16, 16), photometric='rgb', subfiletype=1)
+
+    assert estimate_slide_memory([slide_path], level=0, overhead=1) == 256 * 512 * 3
+    assert estimate_slide_memory([slide_path], level=1, overhead=2) == 2 * 64 * 128 * 3
+    assert estimate_slide_memory([slide_path], level=0, max_rows=10, overhead=1) == 10 * 512 * 3
+    assert estimate_slide_memory([slide_path, slide_path], level=1, overhead=1) == 2 * 64 * 128 * 3
+    with pytest.warns(UserWarning):
+        assert estimate_slide_memory([tmp_path / "missing.tiff"], level=0) == 0
+
+
+def _record_interval(sample: Tuple[Path, str]) -> None:
+    output_dir, slide_id = sample
+    start_time = time.time()
+    time.sleep(0.1)
+    (output_dir / f"{slide_id}.txt").write_text(f"{start_time},{time.time()}")
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_run_slides(tmp_path: Path, parallel: bool) -> None:
+    slide_ids = ["a", "b", "c", "d"]
+    memory_estimates = [10, 40, 30, 20]
+    samples = [(tmp_path, slide_id) for slide_id in slide_ids]
+    # Only slides whose estimates sum to at most 50 may run concurrently
+    timings = run_slides(_record_interval, samples, slide_ids, memory_estimates, parallel=parallel,
+                         max_workers=4, memory_budget=50)
+
+    assert sorted(timing.slide_id for timing in timings) == slide_ids
+    assert all(timing.seconds >= 0.1 for timing in timings)
+    intervals = {slide_id: tuple(map(float, (tmp_path / f"{slide_id}.txt").read_text().split(',')))
+                 for slide_id in slide_ids}
+    if not parallel:
+        assert [timing.slide_id for timing in timings] == ["b", "c", "d", "a"]  # largest first
+    # The largest slide never runs together with the second or third largest
+    for first, second in [("b", "c"), ("b", "d")]:
+        assert intervals[first][1] <= intervals[second][0] or intervals[second][1] <= intervals[first][0]
+
+    timings_path = save_slide_timings(timings, tmp_path)
+    assert timings_path == tmp_path / SLIDE_TIMINGS_FILENAME
+    timings_df = pd.read_csv(timings_path)
+    assert sorted(timings_df['slide_id']) == slide_ids
+    assert dict(zip(timings_df['slide_id'], timings_df['memory_estimate'])) == dict(zip(slide_ids, memory_estimates))
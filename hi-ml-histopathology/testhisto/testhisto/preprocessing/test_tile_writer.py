@@ -0,0 +1,59 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+import functools
+import threading
+import time
+from typing import List
+
+import pytest
+
+from histopathology.preprocessing.tile_writer import AsyncTileWriter
+
+
+def _job(index: int) -> int:
+    # Later jobs finish first, to check that results are still returned in submission order
+    time.sleep(0.001 * (10 - index % 10))
+    if index == 7:
+        raise ValueError("Failed job")
+    return 2 * index
+
+
+@pytest.mark.parametrize("num_threads", [0, 1, 4])
+def test_async_tile_writer_order(num_threads: int) -> None:
+    n_jobs = 30
+    max_pending = 3
+    completed: List = []
+    with AsyncTileWriter(num_threads=num_threads, max_pending=max_pending) as writer:
+        for index in range(n_jobs):
+            completed.extend(writer.submit(functools.partial(_job, index), context=index))
+            if num_threads > 0:
+                assert len(writer._pending) <= max_pending
+        completed.extend(writer.drain())
+        assert writer.n_completed == n_jobs
+        assert writer.throughput > 0
+
+    assert [context for context, _, _ in completed] == list(range(n_jobs))
+    for index, result, error in completed:
+        if index == 7:
+            assert result is None
+            assert isinstance(error, ValueError)
+        else:
+            assert result == 2 * index
+            assert error is None
+
+
+def test_async_tile_writer_uses_threads() -> None:
+    main_thread = threading.get_ident()
+    with AsyncTileWriter(num_threads=2) as writer:
+        completed = writer.submit(threading.get_ident, context=None) + writer.drain()
+    assert completed[0][1] != main_thread
+
+    with AsyncTileWriter(num_threads=0) as writer:
+        completed = writer.submit(threading.get_ident, context=None) + writer.drain()
+    assert completed[0][1] == main_thread
+
+    with pytest.raises(ValueError):
+        AsyncTileWriter(num_threads=-1)
@@ -6,7 +6,7 @@
 import numpy as np
 import pytest
 
-from histopathology.preprocessing.tiling import assemble_tiles_2d, get_1d_padding, \
+from histopathology.preprocessing.tiling import assemble_tiles_2d, get_1d_padding, get_tile_views_2d, \
     pad_for_tiling_2d, tile_array_2d
 
 
@@ -28,6 +28,24 @@ def test_1d_padding(length: int, tile_size: int) -> None:
     assert n_tiles == expected_n_tiles
 
 
+@pytest.mark.fast
+@pytest.mark.parametrize("length,tile_size,stride",
+                         [(8, 4, 2), (9, 4, 2), (8, 3, 1), (4, 4, 3), (3, 4, 2), (10, 4, 6)])
+def test_1d_padding_with_stride(length: int, tile_size: int, stride: int) -> None:
+    pad_pre, pad_post = get_1d_padding(length, tile_size, stride)
+
+    assert pad_pre >= 0 and pad_post >= 0
+    assert abs(pad_post - pad_pre) <= 1, "Asymmetric padding"
+
+    padded_length = pad_pre + length + pad_post
+    assert padded_length >= tile_size
+    assert (padded_length - tile_size) % stride == 0
+    # Minimal padding: one fewer tile would not cover the array
+    assert padded_length - stride < max(length, tile_size)
+
+    assert get_1d_padding(length, tile_size, stride=tile_size) == get_1d_padding(length, tile_size)
+
+
 @pytest.mark.fast
 @pytest.mark.parametrize("width,height", [(8, 6)])
 @pytest.mark.parametrize("tile_size", [3, 4, 5])
@@ -103,6 +121,58 @@ def test_tile_array_2d_both(width: int, height: int, tile_size: int, channels_fi
         assert tuple(coords[idx]) == (expected_x, expected_y)
 
 
+@pytest.mark.fast
+@pytest.mark.parametrize("width,height", [(8, 6), (9, 13)])
+@pytest.mark.parametrize("tile_size,stride", [(4, 2), (5, 2), (3, 1), (3, 4)])
+@pytest.mark.parametrize("channels_first", [True, False])
+def test_tile_array_2d_with_stride(width: int, height: int, tile_size: int, stride: int,
+                                   channels_first: bool) -> None:
+    array = _get_2d_meshgrid(width, height, channels_first)
+
+    padded_array, (offset_w, offset_h) = pad_for_tiling_2d(array, tile_size, channels_first, stride,
+                                                           constant_values=0)
+    tiles, coords = tile_array_2d(array, tile_size, channels_first, stride=stride, constant_values=0)
+    tile_views, view_coords = get_tile_views_2d(array, tile_size, channels_first, stride=stride,
+                                                constant_values=0)
+    n_tiles_h, n_tiles_w = tile_views.shape[:2]
+
+    assert tiles.shape[0] == coords.shape[0] == n_tiles_h * n_tiles_w
+    assert np.array_equal(tiles, tile_views.reshape(tiles.shape))
+    assert np.array_equal(coords, view_coords.reshape(-1, 2))
+    assert tiles.flags.writeable
+    assert not tile_views.flags.writeable
+
+    for idx in range(tiles.shape[0]):
+        expected_x = stride * (idx % n_tiles_w) - offset_w
+        expected_y = stride * (idx // n_tiles_w) - offset_h
+        assert tuple(coords[idx]) == (expected_x, expected_y)
+        row, col = expected_y + offset_h, expected_x + offset_w
+        if channels_first:
+            expected_tile = padded_array[:, row:row + tile_size, col:col + tile_size]
+        else:
+            expected_tile = padded_array[row:row + tile_size, col:col + tile_size, :]
+        assert np.array_equal(tiles[idx], expected_tile)
+
+
+@pytest.mark.fast
+def test_tile_views_do_not_copy() -> None:
+    array = np.random.rand(3, 64, 48)
+    tile_views, _ = get_tile_views_2d(array, tile_size=16, stride=8)
+    assert tile_views.shape == (7, 5, 3, 16, 16)
+    # The views share the memory of the padded array, which is no bigger than the input
+    assert tile_views.base is not None
+    padded_array = tile_views.base
+    while padded_array.base is not None and isinstance(padded_array.base, np.ndarray):
+        padded_array = padded_array.base
+    assert padded_array.nbytes == array.nbytes
+    assert np.shares_memory(tile_views[0, 0], tile_views[0, 1])  # overlapping tiles
+
+    default_tiles, default_coords = tile_array_2d(array, tile_size=16)
+    strided_tiles, strided_coords = tile_array_2d(array, tile_size=16, stride=16)
+    assert np.array_equal(default_tiles, strided_tiles)
+    assert np.array_equal(default_coords, strided_coords)
+
+
 @pytest.mark.fast
 @pytest.mark.parametrize("width,height", [(8, 6)])
 @pytest.mark.parametrize("tile_size", [3, 4, 5])
@@ -128,3 +198,49 @@ def test_assemble_tiles_2d(width: int, height: int, tile_size: int, channels_fir
         else:
             crop = assembled_array[row:row + tile_size, col:col + tile_size, :]
         assert np.array_equal(crop, tiles[idx])
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize("channels_first", [True, False])
+def test_assemble_tiles_2d_sparse(channels_first: bool) -> None:
+    array = np.random.randint(0, 255, size=(3, 12, 16) if channels_first else (12, 16, 3), dtype=np.uint8)
+    tiles, coords = tile_array_2d(array, tile_size=4, channels_first=channels_first)
+    # Drop some tiles, keeping the corner ones so the assembled array has the same extent
+    kept = np.ones(len(tiles), dtype=bool)
+    kept[[5, 6, 9]] = False
+
+    assembled_array, offset = assemble_tiles_2d(tiles[kept], coords[kept], fill_value=0,
+                                                channels_first=channels_first, dtype=np.uint8)
+    assert assembled_array.dtype == np.uint8
+    for tile, (x, y), is_kept in zip(tiles, coords + offset, kept):
+        crop = assembled_array[:, y:y + 4, x:x + 4] if channels_first else assembled_array[y:y + 4, x:x + 4, :]
+        assert np.array_equal(crop, tile if is_kept else np.zeros_like(tile))
+
+    float_array, _ = assemble_tiles_2d(tiles[kept], coords[kept], channels_first=channels_first)
+    assert float_array.dtype == np.float64
+    assert np.isnan(float_array).sum() == (~kept).sum() * tiles[0].size
+
+    # The default NaN fill value is replaced with 0 for data types without NaN
+    uint8_array, _ = assemble_tiles_2d(tiles[kept], coords[kept], channels_first=channels_first, dtype=np.uint8)
+    assert np.array_equal(uint8_array, assembled_array)
+    mask_array, _ = assemble_tiles_2d(tiles[kept] > 0, coords[kept], channels_first=channels_first, dtype=bool)
+    assert np.array_equal(mask_array, assembled_array > 0)
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize("downsample", [1, 2, 4])
+@pytest.mark.parametrize("channels_first", [True, False])
+def test_assemble_tiles_2d_downsample(downsample: int, channels_first: bool) -> None:
+    array = np.random.randint(0, 255, size=(3, 12, 16) if channels_first else (12, 16, 3), dtype=np.uint8)
+    tiles, coords = tile_array_2d(array, tile_size=4, channels_first=channels_first)
+    full_array, full_offset = assemble_tiles_2d(tiles, coords, channels_first=channels_first, dtype=np.uint8)
+
+    assembled_array, offset = assemble_tiles_2d(tiles, coords, channels_first=channels_first, dtype=np.uint8,
+                                                downsample=downsample)
+    assert np.array_equal(offset, full_offset)
+    expected_array = full_array[:, ::downsample, ::downsample] if channels_first \
+        else full_array[::downsample, ::downsample, :]
+    assert np.array_equal(assembled_array, expected_array)
+
+    with pytest.raises(ValueError):
+        assemble_tiles_2d(tiles, coords, channels_first=channels_first, downsample=3)
@@ -21,7 +21,7 @@ from health_ml.utils.fixed_paths import OutputFolderForTests
 from histopathology.utils.metrics_utils import plot_scores_hist, resize_and_save, select_k_tiles, plot_slide, \
     plot_heatmap_overlay, plot_normalized_confusion_matrix
 from histopathology.utils.naming import ResultsKey
-from histopathology.utils.heatmap_utils import location_selected_tiles
+from histopathology.utils.heatmap_utils import get_attention_raster, location_selected_tiles
 from testhisto.utils.utils_testhisto import assert_binary_files_match, full_ml_test_data_path
 # import testhisto
 
@@ -190,6 +190,49 @@ def test_plot_heatmap_overlay(test_output_dirs: OutputFolderForTests) -> None:
     assert_binary_files_match(file, expected)
 
 
+def test_plot_heatmap_overlay_raster() -> None:
+    set_random_seed(0)
+    slide_image = np.random.rand(3, 1000, 2000)
+    fig = plot_heatmap_overlay(slide=1,  # type: ignore
+                               slide_image=slide_image,
+                               results=test_dict,  # type: ignore
+                               location_bbox=[100, 100],
+                               tile_size=224,
+                               level=0,
+                               raster=True)
+    assert isinstance(fig, matplotlib.figure.Figure)
+    ax = fig.axes[0]
+    # The heatmap is a single image on top of the slide, rather than one patch per tile
+    assert len(ax.images) == 2
+    assert len(ax.collections) == 0
+    assert ax.images[1].get_extent() == [100, 548, 548, 100]
+    assert ax.get_xlim() == (0, slide_image.shape[2])
+    assert ax.get_ylim() == (slide_image.shape[1], 0)
+
+
+@pytest.mark.parametrize("level", [0, 1])
+def test_get_attention_raster(level: int) -> None:
+    factor = {0: 1, 1: 4}[level]
+    tile_size = 10
+    location_bbox = [100, 200]
+    # Tiles on a 3 x 4 grid, with tile (row 1, col 2) in the middle missing
+    tile_coords = np.array([[0, 0], [30, 0], [10, 20], [20, 10], [0, 20]]) * factor + location_bbox
+    attentions = np.array([0.1, 0.2, 0.3, 0.4, 0.5])
+    raster, extent = get_attention_raster(tile_coords=tile_coords, attentions=attentions,
+                                          location_bbox=location_bbox, level=level, tile_size=tile_size)
+    expected_raster = np.array([[0.1, np.nan, np.nan, 0.2],
+                                [np.nan, np.nan, 0.4, np.nan],
+                                [0.5, 0.3, np.nan, np.nan]], dtype=np.float32)
+    np.testing.assert_array_equal(raster, expected_raster)
+    assert extent == (0, 40, 30, 0)
+
+    # The raster is located where the tiles are on the slide
+    raster, extent = get_attention_raster(tile_coords=tile_coords[2:], attentions=attentions[2:],
+                                          location_bbox=location_bbox, level=level, tile_size=tile_size)
+    np.testing.assert_array_equal(raster, expected_raster[1:, :3])
+    assert extent == (0, 30, 30, 10)
+
+
 @pytest.mark.parametrize("n_classes", [1, 3])
 @pytest.mark.skipif(is_windows(), reason="Rendering is different on Windows")
 def test_plot_normalized_confusion_matrix(test_output_dirs: OutputFolderForTests, n_classes: int) -> None:
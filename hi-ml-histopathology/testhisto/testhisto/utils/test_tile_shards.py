@@ -0,0 +1,48 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+import tarfile
+from pathlib import Path
+from typing import Dict
+
+import pytest
+
+from histopathology.utils.tile_shards import (TileShardWriter, get_shard_index_path, read_shard_members,
+                                              read_tile_bytes)
+
+
+def _write_shard(shard_path: Path) -> Dict[str, bytes]:
+    # Sizes below, equal to, and above the tar block size, to check the recorded offsets
+    members = {f"tile_{size}.png": bytes(range(256)) * (size // 256) + b"x" * (size % 256)
+               for size in [1, 511, 512, 513, 2000]}
+    with TileShardWriter(shard_path) as writer:
+        for name, data in members.items():
+            writer.write(name, data)
+    return members
+
+
+def test_shard_index_random_access(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    shard_path = tmp_path / "tiles.tar"
+    members = _write_shard(shard_path)
+    assert get_shard_index_path(shard_path).is_file()
+    # The shard is still a valid tar file
+    with tarfile.open(shard_path) as tar_file:
+        assert tar_file.getnames() == list(members)
+
+    names = ["tile_2000.png", "tile_1.png", "tile_513.png", "tile_1.png"]
+    expected = [members[name] for name in names]
+    # Indexed shards are read by seeking to each tile, without parsing the tar file
+    with monkeypatch.context() as patch:
+        patch.setattr(tarfile, "open", None)
+        assert read_shard_members(shard_path, names) == expected
+        assert read_tile_bytes([shard_path / "tile_512.png"]) == [members["tile_512.png"]]
+        with pytest.raises(KeyError, match="tile_0.png"):
+            read_shard_members(shard_path, ["tile_0.png"])
+
+    # Shards without an index are scanned sequentially
+    get_shard_index_path(shard_path).unlink()
+    assert read_shard_members(shard_path, names) == expected
+    with pytest.raises(KeyError, match="tile_0.png"):
+        read_shard_members(shard_path, ["tile_0.png"])
@@ -6,11 +6,32 @@
 Created using the original DeepMIL paper and code from Ilse et al., 2018
 https://github.com/AMLab-Amsterdam/AttentionDeepMIL (MIT License)
 """
-from typing import Tuple, Optional
+from typing import List, Sequence, Tuple, Optional
 from torch import nn, Tensor, transpose, mm
 import torch
 import torch.nn.functional as F
 from torch.nn import Module, TransformerEncoderLayer
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.checkpoint import checkpoint
+
+
+def pad_bags(features: Tensor, bag_sizes: Sequence[int]) -> Tuple[Tensor, Tensor]:
+    """Split the concatenated instance features of several bags and pad them to the size of the largest bag.
+
+    :param features: Features of all instances, concatenated bag by bag along the first axis: N x L.
+    :param bag_sizes: Number of instances in each of the B bags, summing up to N.
+    :return: A tuple containing the zero-padded features, B x max(bag_sizes) x L, and a boolean mask of
+    valid (i.e. non-padding) instances, B x max(bag_sizes).
+    """
+    padded_features = pad_sequence(torch.split(features, list(bag_sizes)), batch_first=True)
+    sizes = torch.as_tensor(bag_sizes, device=features.device)
+    mask = torch.arange(padded_features.shape[1], device=features.device)[None, :] < sizes[:, None]
+    return padded_features, mask
+
+
+def unpad_attentions(attention_weights: Tensor, bag_sizes: Sequence[int]) -> List[Tensor]:
+    """Split padded attention weights, B x K x max(bag_sizes), into a list of K x N_i tensors, one per bag."""
+    return [bag_attention_weights[:, :size] for bag_attention_weights, size in zip(attention_weights, bag_sizes)]
 
 
 class MeanPoolingLayer(nn.Module):
@@ -23,6 +44,20 @@ class MeanPoolingLayer(nn.Module):
         pooled_features = pooled_features.view(1, -1)
         return (attention_weights, pooled_features)
 
+    def forward_bags(self, features: Tensor, bag_sizes: Sequence[int]) -> Tuple[List[Tensor], Tensor]:
+        """Pool several bags at once, equivalently to calling `forward()` on each bag.
+
+        :param features: Features of all instances, concatenated bag by bag along the first axis: N x L.
+        :param bag_sizes: Number of instances in each of the B bags, summing up to N.
+        :return: A tuple containing the list of attention weights of each bag, 1 x N_i, and the pooled
+        features of all bags, B x 1 x L.
+        """
+        padded_features, mask = pad_bags(features.view(features.shape[0], -1), bag_sizes)
+        sizes = mask.sum(dim=1, keepdim=True)
+        pooled_features = padded_features.sum(dim=1) / sizes
+        attention_weights = (mask / sizes).unsqueeze(1)
+        return unpad_attentions(attention_weights, bag_sizes), pooled_features.unsqueeze(1)
+
 
 class MaxPoolingLayer(nn.Module):
     """Max pooling returns uniform weights and the maximum feature vector over the first axis"""
@@ -36,6 +71,22 @@ class MaxPoolingLayer(nn.Module):
         pooled_features = pooled_features.view(1, -1)
         return (attention_weights, pooled_features)
 
+    def forward_bags(self, features: Tensor, bag_sizes: Sequence[int]) -> Tuple[List[Tensor], Tensor]:
+        """Pool several bags at once, equivalently to calling `forward()` on each bag.
+
+        :param features: Features of all instances, concatenated bag by bag along the first axis: N x L.
+        :param bag_sizes: Number of instances in each of the B bags, summing up to N.
+        :return: A tuple containing the list of attention weights of each bag, 1 x N_i, and the pooled
+        features of all bags, B x 1 x L.
+        """
+        padded_features, mask = pad_bags(features.view(features.shape[0], -1), bag_sizes)
+        padded_features = padded_features.masked_fill(~mask[:, :, None], float('-inf'))
+        pooled_features, indices = padded_features.max(dim=1)                              # B x L
+        frequency = torch.zeros(mask.shape, dtype=pooled_features.dtype, device=features.device)
+        frequency.scatter_add_(1, indices, torch.ones_like(pooled_features))               # B x max(N_i)
+        attention_weights = (frequency / pooled_features.shape[1]).unsqueeze(1)
+        return unpad_attentions(attention_weights, bag_sizes), pooled_features.unsqueeze(1)
+
 
 class AttentionLayer(nn.Module):
     """ AttentionLayer: Simple attention layer
@@ -65,6 +116,29 @@ class AttentionLayer(nn.Module):
         pooled_features = mm(attention_weights, features)        # Matrix multiplication : K x L
         return(attention_weights, pooled_features)
 
+    def forward_bags(self, features: Tensor, bag_sizes: Sequence[int]) -> Tuple[List[Tensor], Tensor]:
+        """Pool several bags at once, equivalently to calling `forward()` on each bag.
+
+        :param features: Features of all instances, concatenated bag by bag along the first axis: N x L.
+        :param bag_sizes: Number of instances in each of the B bags, summing up to N.
+        :return: A tuple containing the list of attention weights of each bag, K x N_i, and the pooled
+        features of all bags, B x K x L.
+        """
+        features = features.view(-1, self.input_dims)            # N x L
+        attention_logits = self.attention(features)              # N x K
+        return _segment_attention_pooling(features, attention_logits, bag_sizes)
+
+
+def _segment_attention_pooling(features: Tensor, attention_logits: Tensor,
+                               bag_sizes: Sequence[int]) -> Tuple[List[Tensor], Tensor]:
+    """Apply a softmax over the instances of each bag, and pool the features of each bag with its weights."""
+    padded_features, mask = pad_bags(features, bag_sizes)                          # B x max(N_i) x L
+    padded_logits, _ = pad_bags(attention_logits, bag_sizes)                       # B x max(N_i) x K
+    padded_logits = padded_logits.masked_fill(~mask[:, :, None], float('-inf'))
+    attention_weights = F.softmax(padded_logits.transpose(1, 2), dim=2)            # B x K x max(N_i)
+    pooled_features = torch.bmm(attention_weights, padded_features)                # B x K x L
+    return unpad_attentions(attention_weights, bag_sizes), pooled_features
+
 
 class GatedAttentionLayer(nn.Module):
     """ GatedAttentionLayer: Gated attention layer
@@ -100,6 +174,18 @@ class GatedAttentionLayer(nn.Module):
         pooled_features = mm(attention_weights, features)        # Matrix multiplication : K x L
         return(attention_weights, pooled_features)
 
+    def forward_bags(self, features: Tensor, bag_sizes: Sequence[int]) -> Tuple[List[Tensor], Tensor]:
+        """Pool several bags at once, equivalently to calling `forward()` on each bag.
+
+        :param features: Features of all instances, concatenated bag by bag along the first axis: N x L.
+        :param bag_sizes: Number of instances in each of the B bags, summing up to N.
+        :return: A tuple containing the list of attention weights of each bag, K x N_i, and the pooled
+        features of all bags, B x K x L.
+        """
+        features = features.view(-1, self.input_dims)                            # N x L
+        attention_logits = self.attention_weights(self.attention_V(features) * self.attention_U(features))
+        return _segment_attention_pooling(features, attention_logits, bag_sizes)
+
 
 class CustomTransformerEncoderLayer(TransformerEncoderLayer):
     """Adaptation of the pytorch TransformerEncoderLayer that always outputs the attention weights.
@@ -171,9 +257,88 @@ class CustomTransformerEncoderLayer(TransformerEncoderLayer):
                               attn_mask=attn_mask,
                               key_padding_mask=key_padding_mask,
                               need_weights=True)  # Just because of this flag I had to copy all of the code...
-        x = x[0]
         return self.dropout1(x), a
 
+    def forward_chunked(self, src: Tensor,
+                        src_key_padding_mask: Optional[Tensor] = None,
+                        query_chunk_size: int = 512,
+                        first_token_only: bool = False) -> Tuple[Tensor, Tensor]:
+        """Memory-efficient equivalent of `forward()`, which computes self-attention for chunks of queries at a
+        time instead of materialising the attention weights between all pairs of elements. When computing
+        gradients, each chunk is checkpointed, i.e. its attention weights are recomputed in the backward pass
+        instead of being kept, so the memory of the backward pass is also bounded by the chunk size.
+
+        :param src: The input sequences, B x S x E (requires ``batch_first=True``).
+        :param src_key_padding_mask: Boolean mask of the padded elements of each sequence, B x S (optional).
+        :param query_chunk_size: Number of queries for which to compute attention at once, which bounds the size
+        of the attention matrices to B x num_heads x query_chunk_size x S.
+        :param first_token_only: If `True`, only compute the output of the first element of each sequence (e.g. a
+        cls token), which still attends to all elements.
+        :return: A tuple containing the output sequences, B x S x E (or B x 1 x E if `first_token_only`), and the
+        attention weights of the first element, averaged over heads, B x 1 x S.
+        """
+        x = src
+        if self.norm_first:
+            normed_x = self.norm1(x)
+            queries = normed_x[:, :1] if first_token_only else normed_x
+            sa_block_out, a = self._chunked_sa_block(queries, normed_x, src_key_padding_mask, query_chunk_size)
+            x = (x[:, :1] if first_token_only else x) + sa_block_out
+            x = x + self._ff_block(self.norm2(x))
+        else:
+            queries = x[:, :1] if first_token_only else x
+            sa_block_out, a = self._chunked_sa_block(queries, x, src_key_padding_mask, query_chunk_size)
+            x = self.norm1(queries + sa_block_out)
+            x = self.norm2(x + self._ff_block(x))
+        return x, a
+
+    # same computation as `self.self_attn`, for the given queries and keys/values from `x`, one chunk at a time
+    def _chunked_sa_block(self, queries: Tensor, x: Tensor,
+                          key_padding_mask: Optional[Tensor],
+                          query_chunk_size: int) -> Tuple[Tensor, Tensor]:
+        attn = self.self_attn
+        batch_size, seq_length, embed_dim = x.shape
+        head_dim = embed_dim // attn.num_heads
+        w_q, w_k, w_v = attn.in_proj_weight.chunk(3)
+        b_q, b_k, b_v = attn.in_proj_bias.chunk(3) if attn.in_proj_bias is not None else (None, None, None)
+
+        def split_heads(t: Tensor) -> Tensor:
+            return t.view(batch_size, -1, attn.num_heads, head_dim).transpose(1, 2)  # B x H x S x head_dim
+
+        keys = split_heads(F.linear(x, w_k, b_k))
+        values = split_heads(F.linear(x, w_v, b_v))
+        mask_bias = None
+        if key_padding_mask is not None:
+            mask_bias = torch.zeros(batch_size, 1, 1, seq_length, dtype=x.dtype, device=x.device)
+            mask_bias.masked_fill_(key_padding_mask[:, None, None, :], float('-inf'))
+
+        all_q = split_heads(F.linear(queries, w_q, b_q)) / head_dim ** 0.5
+
+        def attend(q: Tensor, keys: Tensor, values: Tensor) -> Tuple[Tensor, Tensor]:
+            logits = torch.matmul(q, keys.transpose(-2, -1))                             # B x H x chunk x S
+            if mask_bias is not None:
+                logits = logits + mask_bias
+            weights = logits.softmax(dim=-1)
+            first_token_attention = weights[:, :, :1].mean(dim=1)                         # B x 1 x S
+            weights = F.dropout(weights, p=attn.dropout, training=self.training)
+            output = torch.matmul(weights, values).transpose(1, 2).reshape(batch_size, -1, embed_dim)
+            return output, first_token_attention
+
+        use_checkpoint = torch.is_grad_enabled() and (all_q.requires_grad or keys.requires_grad)
+        outputs = []
+        first_token_attention = None
+        for start in range(0, queries.shape[1], query_chunk_size):
+            q = all_q[:, :, start:start + query_chunk_size]
+            if use_checkpoint:
+                # The random state is restored when recomputing the chunk, so dropout masks are identical
+                output, chunk_attention = checkpoint(attend, q, keys, values)
+            else:
+                output, chunk_attention = attend(q, keys, values)
+            if first_token_attention is None:
+                first_token_attention = chunk_attention
+            outputs.append(output)
+        output = attn.out_proj(torch.cat(outputs, dim=1))
+        return self.dropout1(output), first_token_attention  # type: ignore
+
 
 class TransformerPooling(Module):
     """Create a Transformer encoder module consisting of multiple Transformer encoder layers.
@@ -186,12 +351,21 @@ class TransformerPooling(Module):
         num_layers: Number of Transformer encoder layers.
         num_heads: Number of attention heads per layer.
         dim_representation: Dimension of input encoding.
+        memory_efficient: If ``True``, compute self-attention for chunks of tiles at a time, and only for the cls
+            token in the last layer, so that peak memory at inference grows linearly rather than quadratically with
+            the bag size. The outputs are the same as in the default mode. When training, chunks are checkpointed
+            (their attention weights are recomputed in the backward pass), so that peak memory also grows linearly
+            with the bag size, at the cost of extra computation.
+        query_chunk_size: Number of tiles for which to compute self-attention at once in memory-efficient mode.
     """
-    def __init__(self, num_layers: int, num_heads: int, dim_representation: int) -> None:
+    def __init__(self, num_layers: int, num_heads: int, dim_representation: int,
+                 memory_efficient: bool = False, query_chunk_size: int = 512) -> None:
         super(TransformerPooling, self).__init__()
         self.num_layers = num_layers
         self.num_heads = num_heads
         self.dim_representation = dim_representation
+        self.memory_efficient = memory_efficient
+        self.query_chunk_size = query_chunk_size
 
         self.cls_token = nn.Parameter(torch.zeros([1, dim_representation]))
 
@@ -206,15 +380,35 @@ class TransformerPooling(Module):
                                               batch_first=True))
         self.transformer_encoder_layers = torch.nn.ModuleList(self.transformer_encoder_layers)  # type: ignore
 
+    def _encode_cls_token(self, features: Tensor,
+                          padding_mask: Optional[Tensor] = None) -> Tuple[Tensor, Tensor]:
+        """Pass sequences starting with the cls token through the encoder layers.
+
+        :param features: The input sequences, B x S x L.
+        :param padding_mask: Boolean mask of the padded elements of each sequence, B x S (optional).
+        :return: A tuple containing the output features of the cls token, B x 1 x L, and its attention weights
+        in the last layer, B x 1 x S.
+        """
+        if not self.memory_efficient:
+            for i in range(self.num_layers):
+                features, attention_weights = self.transformer_encoder_layers[i](
+                    features, src_key_padding_mask=padding_mask)
+            return features[:, :1], attention_weights[:, :1]  # type: ignore
+
+        for i in range(self.num_layers):
+            # Only the output of the cls token is needed from the last layer
+            features, attention_weights = self.transformer_encoder_layers[i].forward_chunked(
+                features, padding_mask, query_chunk_size=self.query_chunk_size,
+                first_token_only=(i == self.num_layers - 1))
+        return features[:, :1], attention_weights  # type: ignore
+
     def forward(self, features: Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         # Append cls token
         features = torch.vstack([self.cls_token, features]).unsqueeze(0)
 
-        for i in range(self.num_layers):
-            features, attention_weights = self.transformer_encoder_layers[i](features)
-
         # Extract cls token
-        pooled_features = features[:, 0]
+        pooled_features, attention_weights = self._encode_cls_token(features)
+        pooled_features = pooled_features[:, 0]
 
         # Get attention weights with respect to the cls token, without the element where it attends to itself
 
@@ -225,3 +419,37 @@ class TransformerPooling(Module):
         attention_weights += self_attention_cls_token / attention_weights.shape[-1]
 
         return (attention_weights, pooled_features)
+
+    def forward_bags(self, features: Tensor, bag_sizes: Sequence[int]) -> Tuple[List[Tensor], Tensor]:
+        """Pool several bags at once, equivalently to calling `forward()` on each bag, by padding the bags
+        and masking the padding from self-attention.
+
+        :param features: Features of all instances, concatenated bag by bag along the first axis: N x L.
+        :param bag_sizes: Number of instances in each of the B bags, summing up to N.
+        :return: A tuple containing the list of attention weights of each bag, 1 x N_i, and the pooled
+        features of all bags, B x 1 x L.
+        """
+        padded_features, mask = pad_bags(features, bag_sizes)                         # B x max(N_i) x L
+        cls_tokens = self.cls_token.expand(len(bag_sizes), 1, -1)
+        padded_features = torch.cat([cls_tokens, padded_features], dim=1)             # B x (1 + max(N_i)) x L
+        padding_mask = F.pad(~mask, (1, 0), value=False)                              # True where padded
+
+        pooled_features, attention_weights = self._encode_cls_token(padded_features, padding_mask)  # B x 1 x L
+        self_attention_cls_token = attention_weights[:, 0, :1]                        # type: ignore
+        attention_weights = attention_weights[:, :1, 1:]                              # type: ignore
+        sizes = torch.as_tensor(bag_sizes, device=features.device)[:, None, None]
+        attention_weights = attention_weights + self_attention_cls_token[:, :, None] / sizes
+        return unpad_attentions(attention_weights, bag_sizes), pooled_features
+
+    def get_screening_attention(self, features: Tensor) -> Tensor:
+        """Cheap approximation of the attention weights of `forward()`, for ranking the instances of a bag: the
+        attention of the cls token in the first encoder layer only. Since only the cls token query is computed,
+        the cost grows linearly rather than quadratically with the bag size.
+
+        :param features: Features of the instances of one bag, N x L.
+        :return: The attention weights of the cls token to each instance, 1 x N.
+        """
+        features = torch.vstack([self.cls_token, features.view(-1, self.dim_representation)]).unsqueeze(0)
+        _, attention_weights = self.transformer_encoder_layers[0].forward_chunked(  # type: ignore
+            features, query_chunk_size=self.query_chunk_size, first_token_only=True)
+        return attention_weights[:, 0, 1:]
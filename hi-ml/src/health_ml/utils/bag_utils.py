@@ -41,11 +41,19 @@ class BagSampler(Sampler[List[int]]):
             seed.
         """
         self.unique_bag_ids, self.bag_indices = np.unique(bag_ids, return_inverse=True)
+        self._build_bag_offsets()
         self.shuffle_bags = shuffle_bags
         self.shuffle_samples = shuffle_samples
         self.max_bag_size = max_bag_size
         self.generator = generator
 
+    def _build_bag_offsets(self) -> None:
+        # CSR layout: the sample indices of bag `i` are `sorted_indices[bag_offsets[i]:bag_offsets[i + 1]]`,
+        # in increasing order thanks to the stable sort, so each bag is retrieved in O(bag size)
+        self.sorted_indices = np.argsort(self.bag_indices, kind='stable')
+        bag_sizes = np.bincount(self.bag_indices, minlength=len(self.unique_bag_ids))
+        self.bag_offsets = np.concatenate([[0], np.cumsum(bag_sizes)])
+
     def __iter__(self) -> Iterator[List[int]]:
         generator = self.generator or _create_generator()
         n_bags = len(self.unique_bag_ids)
@@ -56,7 +64,7 @@ class BagSampler(Sampler[List[int]]):
 
     def get_bag(self, bag_index: int, generator: Optional[torch.Generator] = None) \
             -> List[int]:
-        bag, = np.where(self.bag_indices == bag_index)
+        bag = self.sorted_indices[self.bag_offsets[bag_index]:self.bag_offsets[bag_index + 1]]
         if self.shuffle_samples:
             if generator is None:
                 generator = self.generator or _create_generator()
@@ -86,6 +94,8 @@ class BagSampler(Sampler[List[int]]):
             generator = torch.Generator()
             generator.set_state(d['generator'])
         self.generator = generator
+        if 'bag_offsets' not in d:  # restoring a sampler pickled before bag offsets were introduced
+            self._build_bag_offsets()
 
 
 class BagDataset(Dataset):
@@ -99,7 +109,8 @@ class BagDataset(Dataset):
                  generator: Optional[torch.Generator] = None,
                  collate_fn: Callable[[List], Any] = default_collate) -> None:
         """
-        :param base_dataset: The source dataset whose samples will be grouped in bags.
+        :param base_dataset: The source dataset whose samples will be grouped in bags. If it implements
+        `__getitems__(indices)`, all samples of a bag are fetched with a single call.
         :param bag_ids: The bag IDs for each sample, of the same length as the dataset.
         :param shuffle_samples: Whether the instances in each bag should be shuffled.
         :param max_bag_size: Upper bound on number of instances in each loaded bag. If 0 (default),
@@ -125,13 +136,39 @@ class BagDataset(Dataset):
                                       generator=generator)
         self.collate_fn = collate_fn
         self.bag_ids = bag_ids
+        self.shuffle_seed: Optional[int] = None
 
     def __len__(self) -> int:
         return len(self.bag_sampler)
 
+    def set_shuffle_seed(self, seed: Optional[int]) -> None:
+        """Set the seed from which the samples of each bag are shuffled.
+
+        If a seed is set, each bag is shuffled with a generator derived from the seed and the bag index,
+        instead of drawing from the sampler's shared generator in loading order. Shuffling is then
+        reproducible regardless of the order and of the process in which bags are loaded, e.g. by
+        multiple `DataLoader` workers. A new seed should be set for every epoch to vary the shuffling.
+
+        :param seed: The shuffling seed, or `None` (default) to use the sampler's generator.
+        """
+        self.shuffle_seed = seed
+
+    def _get_bag_generator(self, index: int) -> Optional[torch.Generator]:
+        shuffle_seed = getattr(self, 'shuffle_seed', None)  # may be missing in datasets pickled before
+        if shuffle_seed is None:
+            return None
+        bag_seed, = np.random.SeedSequence([shuffle_seed, index]).generate_state(1, dtype=np.uint64)
+        generator = torch.Generator()
+        generator.manual_seed(int(bag_seed))
+        return generator
+
     def __getitem__(self, index: int) -> Any:
-        bag_indices = self.bag_sampler.get_bag(index)
-        bag_samples = [self.base_dataset[i] for i in bag_indices]
+        bag_indices = self.bag_sampler.get_bag(index, self._get_bag_generator(index))
+        if hasattr(self.base_dataset, '__getitems__'):
+            # Bulk fetch, e.g. to slice all samples of the bag from a columnar dataset at once
+            bag_samples = self.base_dataset.__getitems__(bag_indices)  # type: ignore
+        else:
+            bag_samples = [self.base_dataset[i] for i in bag_indices]
         return self.collate_fn(bag_samples)
 
 
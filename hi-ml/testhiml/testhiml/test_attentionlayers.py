@@ -1,7 +1,9 @@
+import math
 import pytest
 from typing import Type, Union
 
-from torch import nn, rand, sum, allclose, ones_like
+from torch import Tensor, nn, rand, sum, allclose, manual_seed, ones_like
+from torch.autograd.graph import saved_tensors_hooks
 
 from health_ml.networks.layers.attention_layers import (AttentionLayer, GatedAttentionLayer,
                                                         MeanPoolingLayer, TransformerPooling,
@@ -64,3 +66,95 @@ def test_transformer_pooling(num_layers: int, num_heads: int, dim_in: int, batch
                                              num_heads=num_heads,
                                              dim_representation=dim_in).eval()
     _test_attention_layer(transformer_pooling, dim_in=dim_in, dim_att=1, batch_size=batch_size)
+
+
+@pytest.mark.parametrize("num_layers", [1, 3])
+@pytest.mark.parametrize("query_chunk_size", [1, 4, 100])
+@pytest.mark.parametrize("norm_first", [False, True])
+def test_transformer_pooling_memory_efficient(num_layers: int, query_chunk_size: int, norm_first: bool) -> None:
+    transformer_pooling = TransformerPooling(num_layers=num_layers, num_heads=2, dim_representation=8).eval()
+    for layer in transformer_pooling.transformer_encoder_layers:
+        layer.norm_first = norm_first
+    features = rand(10, 8)
+    expected_attn_weights, expected_pooled_features = transformer_pooling(features)
+
+    transformer_pooling.memory_efficient = True
+    transformer_pooling.query_chunk_size = query_chunk_size
+    _test_attention_layer(transformer_pooling, dim_in=8, dim_att=1, batch_size=10)
+    attn_weights, pooled_features = transformer_pooling(features)
+    assert attn_weights.shape == expected_attn_weights.shape
+    assert allclose(attn_weights, expected_attn_weights, atol=1e-6)
+    assert allclose(pooled_features, expected_pooled_features, atol=1e-6)
+
+    # Gradients flow through the chunked attention in training mode
+    transformer_pooling.train()
+    features.requires_grad_(True)
+    sum(transformer_pooling(features)[1]).backward()
+    assert features.grad is not None
+
+
+@pytest.mark.parametrize("memory_efficient", [False, True])
+def test_transformer_pooling_memory_efficient_backward(memory_efficient: bool) -> None:
+    manual_seed(0)
+    transformer_pooling = TransformerPooling(num_layers=2, num_heads=2, dim_representation=8).eval()
+    bag_size = 500
+    features = rand(bag_size, 8, requires_grad=True)
+    sum(transformer_pooling(features)[1]).backward()
+    expected_grad = features.grad.clone()  # type: ignore
+    features.grad = None
+
+    # Sizes of the distinct storages saved for the backward pass
+    saved_storages = {}
+
+    def pack_hook(tensor: Tensor) -> Tensor:
+        saved_storages[tensor.storage().data_ptr()] = tensor.storage().size()
+        return tensor
+
+    transformer_pooling.memory_efficient = memory_efficient
+    transformer_pooling.query_chunk_size = 16
+    with saved_tensors_hooks(pack_hook, lambda tensor: tensor):
+        _, pooled_features = transformer_pooling(features)
+    sum(pooled_features).backward()
+    assert allclose(features.grad, expected_grad, atol=1e-6)  # type: ignore
+    if memory_efficient:
+        # Chunks are checkpointed, so no attention weights between all pairs of tiles are kept
+        assert math.fsum(saved_storages.values()) < bag_size ** 2 / 2
+    else:
+        assert max(saved_storages.values()) > bag_size ** 2
+
+
+@pytest.mark.parametrize("num_layers", [1, 3])
+def test_transformer_pooling_screening_attention(num_layers: int) -> None:
+    transformer_pooling = TransformerPooling(num_layers=num_layers, num_heads=2, dim_representation=8,
+                                             query_chunk_size=4).eval()
+    features = rand(10, 8)
+    attn_weights = transformer_pooling.get_screening_attention(features)
+    assert attn_weights.shape == (1, 10)
+    if num_layers == 1:
+        # Same as the attention of forward(), before the attention of the cls token to itself is redistributed
+        expected_attn_weights, _ = transformer_pooling(features)
+        assert allclose(attn_weights + (1 - sum(attn_weights)) / 10, expected_attn_weights, atol=1e-6)
+    else:
+        assert 0 < sum(attn_weights) <= 1
+
+
+@pytest.mark.parametrize('pooling_layer', [AttentionLayer(input_dims=8, hidden_dims=4, attention_dims=3),
+                                           GatedAttentionLayer(input_dims=8, hidden_dims=4, attention_dims=3),
+                                           MeanPoolingLayer(),
+                                           MaxPoolingLayer(),
+                                           TransformerPooling(num_layers=2, num_heads=2, dim_representation=8).eval(),
+                                           TransformerPooling(num_layers=2, num_heads=2, dim_representation=8,
+                                                              memory_efficient=True, query_chunk_size=4).eval()])
+def test_pooling_forward_bags(pooling_layer: nn.Module) -> None:
+    bag_sizes = [3, 1, 6, 2]
+    features = rand(12, 8)  # N = sum(bag_sizes)
+    attn_weights_list, pooled_features = pooling_layer.forward_bags(features, bag_sizes)
+
+    assert len(attn_weights_list) == len(bag_sizes)
+    for bag_features, attn_weights, bag_pooled_features in zip(features.split(bag_sizes), attn_weights_list,
+                                                               pooled_features):
+        expected_attn_weights, expected_pooled_features = pooling_layer(bag_features)
+        assert attn_weights.shape == expected_attn_weights.shape
+        assert allclose(attn_weights, expected_attn_weights, atol=1e-6)
+        assert allclose(bag_pooled_features.view(expected_pooled_features.shape), expected_pooled_features,
+                        atol=1e-6)
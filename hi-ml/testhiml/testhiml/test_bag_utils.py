@@ -3,12 +3,13 @@ import pytest
 from collections import Counter
 from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Union
 
+import numpy as np
 import torch
 from pytorch_lightning import LightningModule, Trainer
 from torch.utils.data import DataLoader, Dataset
 
 
-from health_ml.utils.bag_utils import (BagSampler, create_bag_dataloader, multibag_collate)
+from health_ml.utils.bag_utils import (BagDataset, BagSampler, create_bag_dataloader, multibag_collate)
 
 # Run GPU tests only if available
 GPUS = [0, -1] if torch.cuda.is_available() else [0]  # type: ignore
@@ -112,6 +113,29 @@ def test_bag_sampler_pickling() -> None:
                        torch.rand([1000], generator=restored_sampler.generator))
 
 
+@pytest.mark.parametrize('max_bag_size', [0, 3])
+def test_bag_sampler_bag_offsets(max_bag_size: int) -> None:
+    import pickle
+
+    bag_ids = torch.randint(20, size=(500,), generator=get_generator(0)).tolist()
+    sampler = BagSampler(bag_ids, max_bag_size=max_bag_size)
+    restored_sampler = pickle.loads(pickle.dumps(sampler))
+    bag_indices = np.asarray(bag_ids)
+    for bag_index, bag_id in enumerate(sampler.unique_bag_ids):
+        expected_bag = np.where(bag_indices == bag_id)[0].tolist()
+        if max_bag_size > 0:
+            expected_bag = expected_bag[:max_bag_size]
+        assert sampler.get_bag(bag_index) == expected_bag
+        assert restored_sampler.get_bag(bag_index) == expected_bag
+
+    # Samplers pickled without bag offsets recompute them when restored
+    legacy_state = sampler.__getstate__()
+    del legacy_state['sorted_indices'], legacy_state['bag_offsets']
+    legacy_sampler = BagSampler.__new__(BagSampler)
+    legacy_sampler.__setstate__(legacy_state)
+    assert list(legacy_sampler) == list(sampler)
+
+
 class MockMILDataset(Dataset):
     # TODO: Extend tests to also support tuple datasets (e.g. TensorDataset)
     def __init__(self, n_samples: int, n_classes: int, n_bags: int, input_shape: Sequence[int]) -> None:
@@ -153,6 +177,38 @@ def test_multibag_collate() -> None:
                    for idx in range(batch_size))
 
 
+class BulkFetchDataset(Dataset):
+    """Wraps a dataset to additionally support bulk fetching via `__getitems__`."""
+    def __init__(self, base_dataset: MockMILDataset) -> None:
+        self.base_dataset = base_dataset
+        self.fetched_bags: List[List[int]] = []
+
+    def __len__(self) -> int:
+        return len(self.base_dataset)
+
+    def __getitem__(self, index: int) -> Dict:
+        return self.base_dataset[index]
+
+    def __getitems__(self, indices: List[int]) -> List[Dict]:
+        self.fetched_bags.append(indices)
+        return [self.base_dataset[index] for index in indices]
+
+
+def test_bag_dataset_bulk_fetch() -> None:
+    dataset = MockMILDataset(n_samples=100, n_classes=10, n_bags=8, input_shape=(1, 4, 4))
+    bulk_dataset = BulkFetchDataset(dataset)
+    bag_ids = dataset.bag_ids.tolist()
+    bag_dataset = BagDataset(dataset, bag_ids, shuffle_samples=True, generator=get_generator(0))  # type: ignore
+    bulk_bag_dataset = BagDataset(bulk_dataset, bag_ids, shuffle_samples=True,  # type: ignore
+                                  generator=get_generator(0))
+
+    for index in range(len(bag_dataset)):
+        bag, bulk_bag = bag_dataset[index], bulk_bag_dataset[index]
+        assert bag.keys() == bulk_bag.keys()
+        assert all(torch.equal(bag[key], bulk_bag[key]) for key in bag)
+    assert len(bulk_dataset.fetched_bags) == len(bag_dataset)
+
+
 @pytest.mark.parametrize('shuffle_bags', [False, True])
 @pytest.mark.parametrize('shuffle_samples', [False, True])
 @pytest.mark.parametrize('seed', [None, 0])